@@ -2,6 +2,8 @@
 ASGI config for expense_sharing project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests for the live balance stream go to the SSE app; everything else is
+handled by Django.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/5.1/howto/deployment/asgi/
@@ -13,4 +15,14 @@ from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'expense_sharing.settings')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+# Imported after Django is set up by get_asgi_application().
+from expenses_app.sse import SSE_PATH, balance_stream  # noqa: E402
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'http' and scope['path'] == SSE_PATH:
+        await balance_stream(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -45,12 +45,27 @@ INSTALLED_APPS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
+        'expenses_app.authentication.SignedTokenAuthentication',
         'rest_framework.authentication.TokenAuthentication',
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'expenses_app.renderers.FastJSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
 }
 
+# Token type issued by login when the client doesn't ask: 'key' (authtoken row) or 'signed'
+AUTH_TOKEN_TYPE = 'key'
+SIGNED_TOKEN_TTL = 60 * 60 * 24 * 7
+SIGNED_TOKEN_VERSION_CACHE_TTL = 60
+
+# Bulk registration (see expenses_app.provisioning)
+BULK_USERS_MAX = 5000
+PASSWORD_HASH_WORKERS = None  # hashing processes per web process; None uses every CPU
+
 
 MIDDLEWARE = [
+    'expenses_app.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -58,8 +73,37 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'expenses_app.middleware.ProfilerMiddleware',
 ]
 
+# Duplicate expense detection (see expenses_app.duplicates): expenses with the same
+# creator, amount, participants and category created within the window are duplicates.
+# 'reject' answers 409 Conflict, 'flag' creates the expense and reports the duplicate.
+DUPLICATE_WINDOW_SECONDS = 600
+DUPLICATE_EXPENSE_ACTION = 'reject'
+
+# Currencies (ISO 4217). FX rates are stored relative to FX_BASE_CURRENCY and
+# reports are converted to REPORTING_CURRENCY unless a request asks otherwise.
+DEFAULT_CURRENCY = 'USD'
+FX_BASE_CURRENCY = 'USD'
+REPORTING_CURRENCY = 'USD'
+FX_RATE_MAX_AGE_DAYS = 7  # how far back a missing day's rate may be taken from
+FX_RATE_CACHE_TTL = 300
+
+# Live balance stream (see expenses_app.sse)
+SSE_QUEUE_SIZE = 100
+SSE_HEARTBEAT_SECONDS = 15
+
+# On-demand request profiling (see expenses_app.middleware.ProfilerMiddleware)
+PROFILER_DIR = BASE_DIR / 'profiles'
+PROFILER_MAX_DUMPS = 50
+PROFILER_TOKEN_MAX_AGE = 600
+PROFILER_SAMPLE_INTERVAL = None  # seconds between samples, e.g. 0.005; None disables sampling
+
+# Incremental backups (see expenses_app.backup) re-read rows whose timestamp cursor is this many
+# seconds before the previous backup's, to catch transactions that committed after it was taken
+BACKUP_CURSOR_OVERLAP = 300
+
 ROOT_URLCONF = 'expense_sharing.urls'
 
 TEMPLATES = [
@@ -133,3 +177,10 @@ STATIC_URL = 'static/'
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 AUTH_USER_MODEL = 'expenses_app.User'
+
+# Token buckets per user for expensive endpoints (throttle_scope): burst size and tokens per second
+TOKEN_BUCKET_RATES = {
+    'reports': {'capacity': 10, 'refill_rate': 0.5},
+}
+# Distinct balance sheet computations allowed at once; identical requests share one, others get 503
+COALESCE_MAX_IN_FLIGHT = 4
@@ -1,6 +1,26 @@
 from django.apps import AppConfig
+from django.db.models.signals import post_delete, post_migrate, post_save, pre_save
+
+
+def _ensure_search_index(using, **kwargs):
+    from django.db import connections
+    from .search import ensure_fts_index
+    ensure_fts_index(connections[using])
 
 
 class ExpensesAppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'expenses_app'
+
+    def ready(self):
+        post_migrate.connect(_ensure_search_index, sender=self)
+        # Deactivated users lose their signed tokens at once
+        from .authentication import remember_active_state, revoke_on_deactivation
+        User = self.get_model('User')
+        pre_save.connect(remember_active_state, sender=User)
+        post_save.connect(revoke_on_deactivation, sender=User)
+        # Incremental backups replay these deletions from their tombstones
+        from rest_framework.authtoken.models import Token
+        from .backup import record_deletion
+        post_delete.connect(record_deletion, sender=User)
+        post_delete.connect(record_deletion, sender=Token)
@@ -0,0 +1,154 @@
+"""
+Archival of old expenses.
+
+``archive`` moves expenses created before a cutoff from the live tables
+into ArchivedExpense, one id-ordered batch per transaction, so the live
+table and its indexes only hold recent history. The balances the archived
+expenses contribute are carried forward in the same transaction:
+
+* OpeningBalance: each user's paid and owed totals, like UserBalance;
+* OpeningDebt: what each pair of users owes one another.
+
+Both are written with the bulk upserts the projections use, so balance
+endpoints add a few opening rows instead of scanning the archive. Rows are
+dated with the day each expense was created, the day its amounts are
+converted at while it is live, so reports in another currency are the
+same before and after archiving. The ledger is not touched: archiving
+changes where expenses are stored, not anyone's balance.
+
+Archived expenses stay readable through ``?include_archived=1`` on the
+expense lists.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Sum
+
+from . import fx
+from .ledger import expense_state
+from .models import ArchivedExpense, Expense, OpeningBalance, OpeningDebt
+from .projections import BalanceProjection, _TotalsProjection
+
+
+DEFAULT_BATCH_SIZE = 1000
+
+COLUMNS = (
+    'id', 'total_amount', 'currency', 'split_method', 'created_by_id', 'split_details', 'category',
+    'description', 'created_at', 'version', 'recurring_id', 'occurrence',
+)
+
+
+class _OpeningBalances(BalanceProjection):
+    """
+    Per-user totals of archived expenses, keyed by creation day; set
+    ``as_of`` before applying each expense.
+    """
+
+    name = None
+    model = OpeningBalance
+    key_fields = ('user_id', 'currency', 'as_of')
+    touched_fields = ('updated_at',)
+    as_of = None
+
+    def _add(self, key, *deltas):
+        super()._add(key + (self.as_of,), *deltas)
+
+
+class _OpeningDebts(_TotalsProjection):
+    """
+    Pairwise debts of archived expenses, keyed by creation day; set
+    ``as_of`` before applying each expense.
+    """
+
+    model = OpeningDebt
+    key_fields = ('user_id', 'counterparty_id', 'currency', 'as_of')
+    value_fields = ('amount',)
+    touched_fields = ('updated_at',)
+    as_of = None
+
+    def apply_state(self, state, sign):
+        creditor = int(state['created_by'])
+        currency = state['currency']
+        for debtor, amount in state['shares'].items():
+            debtor = int(debtor)
+            if debtor == creditor:
+                continue
+            amount = sign * Decimal(amount)
+            self._add((creditor, debtor, currency, self.as_of), amount)
+            self._add((debtor, creditor, currency, self.as_of), -amount)
+
+
+def archive_batch(cutoff, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Archive the oldest batch of expenses created before a cutoff.
+
+    :param cutoff: Aware datetime; expenses created before it are archived
+    :param batch_size: Expenses moved in the transaction
+    :return: Number of expenses archived
+    """
+    Participant = Expense.participants.through
+    ArchivedParticipant = ArchivedExpense.participants.through
+    balances = _OpeningBalances()
+    debts = _OpeningDebts()
+    with transaction.atomic():
+        rows = list(
+            Expense.objects.select_for_update().filter(created_at__lt=cutoff)
+            .order_by('id').values_list(*COLUMNS)[:batch_size]
+        )
+        if not rows:
+            return 0
+        ids = [row[0] for row in rows]
+        participants = list(Participant.objects.filter(expense_id__in=ids).values_list('expense_id', 'user_id'))
+
+        archived = [ArchivedExpense(**dict(zip(COLUMNS, row))) for row in rows]
+        ArchivedExpense.objects.bulk_create(archived)
+        ArchivedParticipant.objects.bulk_create(
+            [ArchivedParticipant(archivedexpense_id=expense_id, user_id=user_id) for expense_id, user_id in participants]
+        )
+        for expense in archived:
+            # Converted at the rate of the day it was created, as when live
+            balances.as_of = debts.as_of = fx._day(expense.created_at)
+            state = expense_state(expense)
+            balances.apply_state(state, 1)
+            debts.apply_state(state, 1)
+        balances.flush()
+        debts.flush()
+
+        Expense.objects.filter(id__in=ids).delete()
+    return len(rows)
+
+
+def archive(cutoff, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Archive every expense created before a cutoff.
+
+    :param cutoff: Aware datetime
+    :param batch_size: Expenses moved per transaction
+    :return: Number of expenses archived
+    """
+    archived = 0
+    while True:
+        count = archive_batch(cutoff, batch_size)
+        if not count:
+            return archived
+        archived += count
+
+
+def opening_debts(user_id, currency):
+    """
+    What every other user owes a user over archived expenses.
+
+    :param user_id: User
+    :param currency: Currency to convert into
+    :return: dict mapping counterparty ids to Decimal amounts
+    """
+    rows = list(
+        OpeningDebt.objects.filter(user_id=user_id).order_by()
+        .values('counterparty_id', 'currency', 'as_of').annotate(total=Sum('amount'))
+    )
+    converter = fx.Converter(currency, {row['as_of'] for row in rows})
+    debts = defaultdict(Decimal)
+    for row in rows:
+        debts[row['counterparty_id']] += row['total'] * converter.factor(row['currency'], row['as_of'])
+    return debts
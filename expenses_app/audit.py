@@ -0,0 +1,244 @@
+"""
+Consistency audit of expenses.
+
+``audit`` reads expenses in id order, one keyset-paginated chunk per short
+query (no long-running transaction, so writers are never held up), and
+checks each chunk in a process pool. Checks on each expense:
+
+* ``invalid_share``: a share is not a number;
+* ``split_sum``: the shares differ from ``total_amount`` by more than the
+  tolerance;
+* ``split_drift``: the shares differ from ``total_amount`` by a non-zero
+  amount within the tolerance, typically left by Decimal division;
+* ``share_without_participant``: a share belongs to a user who is not a
+  participant;
+* ``participant_without_share``: a participant other than the creator has
+  no share.
+
+Workers also return paid and owed totals per user and currency, and once
+every chunk is checked they are added to the payment totals and the
+balances carried forward from archived expenses, and compared with the
+balance projection (``balance`` issues), which is caught up with the ledger
+first. That comparison is only exact if nothing was written during the
+audit.
+
+The report is JSON Lines: one ``issue`` object per problem and a final
+``summary``. After every chunk a checkpoint records the last id and the
+running totals, so an interrupted audit resumes where it stopped.
+"""
+import collections
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from decimal import Decimal, InvalidOperation
+
+from django.db.models import Sum
+
+from .models import Expense, OpeningBalance, Payment, UserBalance
+from .projections import BalanceProjection, catch_up
+
+
+ZERO = Decimal('0')
+# Precision of the balance projection's columns.
+PROJECTED = Decimal('0.000001')
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_TOLERANCE = Decimal('0.01')
+
+
+def check_chunk(rows, tolerance):
+    """
+    Check a chunk of expenses. Runs in a worker process and uses no database.
+
+    :param rows: List of (id, total_amount, currency, created_by, split_details, participant ids)
+    :param tolerance: Largest split difference reported as drift rather than a mismatch
+    :return: (list of issue dicts, dict mapping "user:currency" to [paid, owed] strings)
+    """
+    issues = []
+    totals = collections.defaultdict(lambda: [ZERO, ZERO])
+    for expense_id, total_amount, currency, created_by, split_details, participants in rows:
+        totals[f'{created_by}:{currency}'][0] += total_amount
+        shares = {}
+        for user_id, amount in split_details.items():
+            try:
+                shares[str(user_id)] = Decimal(amount)
+            except (InvalidOperation, TypeError, ValueError):
+                issues.append({'expense_id': expense_id, 'check': 'invalid_share', 'detail': {'user': user_id, 'share': amount}})
+        for user_id, amount in shares.items():
+            totals[f'{user_id}:{currency}'][1] += amount.quantize(PROJECTED)
+
+        difference = sum(shares.values(), ZERO) - total_amount
+        if abs(difference) > tolerance:
+            issues.append({'expense_id': expense_id, 'check': 'split_sum', 'detail': {'difference': str(difference)}})
+        elif difference:
+            issues.append({'expense_id': expense_id, 'check': 'split_drift', 'detail': {'difference': str(difference)}})
+
+        members = {str(user_id) for user_id in participants}
+        outsiders = sorted(set(shares) - members)
+        if outsiders:
+            issues.append({'expense_id': expense_id, 'check': 'share_without_participant', 'detail': {'users': outsiders}})
+        missing = sorted(members - set(shares) - {str(created_by)})
+        if missing:
+            issues.append({'expense_id': expense_id, 'check': 'participant_without_share', 'detail': {'users': missing}})
+    return issues, {key: [str(paid), str(owed)] for key, (paid, owed) in totals.items()}
+
+
+def read_chunks(after, chunk_size):
+    """
+    Yield expenses with their participants in id order.
+
+    :param after: Only read expenses with a greater id
+    :param chunk_size: Expenses per query
+    :return: Iterator of lists of rows for ``check_chunk``
+    """
+    Participant = Expense.participants.through
+    while True:
+        rows = list(
+            Expense.objects.filter(id__gt=after).order_by('id')
+            .values_list('id', 'total_amount', 'currency', 'created_by_id', 'split_details')[:chunk_size]
+        )
+        if not rows:
+            return
+        participants = collections.defaultdict(list)
+        for expense_id, user_id in (
+            Participant.objects.filter(expense_id__gte=rows[0][0], expense_id__lte=rows[-1][0])
+            .values_list('expense_id', 'user_id')
+        ):
+            participants[expense_id].append(user_id)
+        yield [row + (participants[row[0]],) for row in rows]
+        after = rows[-1][0]
+
+
+def balance_issues(totals, tolerance):
+    """
+    Compare recomputed totals, with payments and archived balances added,
+    with the balance projection.
+
+    :param totals: dict mapping "user:currency" to [paid, owed] Decimals
+                   over the expenses
+    :param tolerance: Largest difference that is not reported
+    :return: list of issue dicts
+    """
+    issues = []
+    totals = {key: list(values) for key, values in totals.items()}
+    for field, index in (('payer', 0), ('payee', 1)):
+        for user_id, currency, amount in Payment.objects.order_by().values_list(field, 'currency').annotate(Sum('amount')):
+            totals.setdefault(f'{user_id}:{currency}', [ZERO, ZERO])[index] += amount
+    for user_id, currency, paid, owed in OpeningBalance.objects.order_by().values_list('user_id', 'currency').annotate(Sum('paid'), Sum('owed')):
+        entry = totals.setdefault(f'{user_id}:{currency}', [ZERO, ZERO])
+        entry[0] += paid
+        entry[1] += owed
+    catch_up(BalanceProjection.name)
+    stored = {
+        f'{user_id}:{currency}': (paid, owed)
+        for user_id, currency, paid, owed in UserBalance.objects.values_list('user_id', 'currency', 'paid', 'owed').iterator()
+    }
+    for key in sorted(set(totals) | set(stored)):
+        expected = totals.get(key, (ZERO, ZERO))
+        actual = stored.get(key, (ZERO, ZERO))
+        if any(abs(a - b) > tolerance for a, b in zip(expected, actual)):
+            user_id, currency = key.split(':')
+            issues.append({'expense_id': None, 'check': 'balance', 'detail': {
+                'user': int(user_id),
+                'currency': currency,
+                'expected': {'paid': str(expected[0]), 'owed': str(expected[1])},
+                'projected': {'paid': str(actual[0]), 'owed': str(actual[1])},
+            }})
+    return issues
+
+
+class Checkpoint:
+    """
+    Audit progress stored as JSON next to the report.
+
+    :param path: Checkpoint file path
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.last_id = 0
+        self.checked = 0
+        self.counts = collections.Counter()
+        self.totals = {}
+
+    def load(self):
+        with open(self.path) as handle:
+            state = json.load(handle)
+        self.last_id = state['last_id']
+        self.checked = state['checked']
+        self.counts = collections.Counter(state['counts'])
+        self.totals = {key: [Decimal(paid), Decimal(owed)] for key, (paid, owed) in state['totals'].items()}
+
+    def save(self):
+        temporary = f'{self.path}.tmp'
+        with open(temporary, 'w') as handle:
+            json.dump({
+                'last_id': self.last_id,
+                'checked': self.checked,
+                'counts': self.counts,
+                'totals': {key: [str(paid), str(owed)] for key, (paid, owed) in self.totals.items()},
+            }, handle)
+        os.replace(temporary, self.path)
+
+    def add(self, rows, issues, totals):
+        self.last_id = rows[-1][0]
+        self.checked += len(rows)
+        self.counts.update(issue['check'] for issue in issues)
+        for key, (paid, owed) in totals.items():
+            entry = self.totals.setdefault(key, [ZERO, ZERO])
+            entry[0] += Decimal(paid)
+            entry[1] += Decimal(owed)
+
+
+def audit(report, checkpoint_path, resume=False, chunk_size=DEFAULT_CHUNK_SIZE, workers=None,
+          tolerance=DEFAULT_TOLERANCE, balances=True, progress=None):
+    """
+    Audit every expense and write the report.
+
+    :param report: Report file path
+    :param checkpoint_path: Checkpoint file path
+    :param resume: Continue from the checkpoint, appending to the report
+    :param chunk_size: Expenses per chunk
+    :param workers: Worker processes, defaults to the number of CPUs
+    :param tolerance: Largest difference treated as rounding
+    :param balances: Compare the totals with the balance projection at the end
+    :param progress: Optional callable receiving the checkpoint after each chunk
+    :return: Summary dict
+    """
+    checkpoint = Checkpoint(checkpoint_path)
+    if resume:
+        checkpoint.load()
+    workers = workers or os.cpu_count() or 1
+    with open(report, 'a' if resume else 'w') as out, ProcessPoolExecutor(max_workers=workers) as pool:
+        def write(issues):
+            for issue in issues:
+                out.write(json.dumps({'type': 'issue', **issue}) + '\n')
+
+        # Results are consumed in submission order so the checkpoint only
+        # ever covers a prefix of the ids; a few chunks are kept queued per
+        # worker so none of them sits idle.
+        pending = collections.deque()
+
+        def drain_one():
+            rows, future = pending.popleft()
+            issues, totals = future.result()
+            write(issues)
+            checkpoint.add(rows, issues, totals)
+            out.flush()
+            checkpoint.save()
+            if progress is not None:
+                progress(checkpoint)
+
+        for rows in read_chunks(checkpoint.last_id, chunk_size):
+            pending.append((rows, pool.submit(check_chunk, rows, tolerance)))
+            if len(pending) >= workers * 2:
+                drain_one()
+        while pending:
+            drain_one()
+
+        if balances:
+            issues = balance_issues(checkpoint.totals, tolerance)
+            write(issues)
+            checkpoint.counts.update(issue['check'] for issue in issues)
+        summary = {'type': 'summary', 'checked': checkpoint.checked, 'last_id': checkpoint.last_id, 'issues': dict(checkpoint.counts)}
+        out.write(json.dumps(summary) + '\n')
+    return summary
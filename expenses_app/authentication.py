@@ -0,0 +1,212 @@
+"""
+Stateless signed auth tokens.
+
+A signed token looks like ``s1.<user id>.<version>.<expiry>.<signature>``
+where the signature is an HMAC-SHA256 of the other fields keyed from
+``SECRET_KEY``. Verifying one needs no database access: the only state is
+the user's token version, which is cached for
+``SIGNED_TOKEN_VERSION_CACHE_TTL`` seconds. Bumping the version revokes
+every token issued before it, in this process immediately and in other
+processes once their cached copy expires. Deactivating a user bumps the
+version too, and an inactive user's cached version never matches a token,
+so deactivation also applies to views that never load the User row.
+
+Plain ``authtoken`` keys are not signed tokens, so SignedTokenAuthentication
+ignores them and lets TokenAuthentication handle them as before.
+"""
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import F
+from django.utils.crypto import constant_time_compare, salted_hmac
+from django.utils.functional import SimpleLazyObject
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+
+from . import metrics
+from .models import TokenVersion, User
+
+
+SIGNED_TOKEN_PREFIX = 's1'
+SIGNING_SALT = 'expenses_app.authentication.SignedToken'
+VERSION_CACHE_KEY = 'token-version:{}'
+# Cached for inactive or deleted users; no token carries it
+NO_VERSION = -1
+
+
+def _signature(user_id, version, expires):
+    message = f'{user_id}.{version}.{expires}'
+    return salted_hmac(SIGNING_SALT, message, algorithm='sha256').hexdigest()
+
+
+def get_token_version(user_id):
+    """
+    Return the current token version for a user, using the cache.
+
+    :param user_id: Primary key of the user
+    :return: Current version number, or ``NO_VERSION`` if the user is inactive or deleted
+    """
+    key = VERSION_CACHE_KEY.format(user_id)
+    version = cache.get(key)
+    metrics.record_cache_lookup('token_version', version is not None)
+    if version is None:
+        row = User.objects.filter(pk=user_id).values_list('is_active', 'token_version__version').first()
+        if row is None or not row[0]:
+            version = NO_VERSION
+        else:
+            version = row[1] or 0
+        cache.set(key, version, settings.SIGNED_TOKEN_VERSION_CACHE_TTL)
+    return version
+
+
+def issue_signed_token(user, ttl=None):
+    """
+    Create a signed auth token for a user.
+
+    :param user: User instance
+    :param ttl: Lifetime in seconds, defaults to ``SIGNED_TOKEN_TTL``
+    :return: Token string
+    """
+    version = get_token_version(user.pk)
+    expires = int(time.time()) + (ttl if ttl is not None else settings.SIGNED_TOKEN_TTL)
+    return f'{SIGNED_TOKEN_PREFIX}.{user.pk}.{version}.{expires}.{_signature(user.pk, version, expires)}'
+
+
+def revoke_signed_tokens(user):
+    """
+    Invalidate every signed token issued to a user so far.
+
+    :param user: User instance
+    :return: The new token version
+    """
+    with transaction.atomic():
+        TokenVersion.objects.get_or_create(user=user)
+        TokenVersion.objects.filter(user=user).update(version=F('version') + 1)
+        version = TokenVersion.objects.get(user=user).version
+    cache.set(VERSION_CACHE_KEY.format(user.pk), version, settings.SIGNED_TOKEN_VERSION_CACHE_TTL)
+    return version
+
+
+def remember_active_state(sender, instance, **kwargs):
+    """
+    ``pre_save`` receiver for User noting whether a saved user is being
+    deactivated.
+    """
+    instance._deactivating = (
+        instance.pk is not None and not instance.is_active
+        and User.objects.filter(pk=instance.pk, is_active=True).exists()
+    )
+
+
+def revoke_on_deactivation(sender, instance, created, **kwargs):
+    """
+    ``post_save`` receiver for User revoking the signed tokens of a user
+    who was just deactivated.
+    """
+    if getattr(instance, '_deactivating', False):
+        instance._deactivating = False
+        revoke_signed_tokens(instance)
+        # The next lookup reads the inactive state and caches NO_VERSION
+        cache.delete(VERSION_CACHE_KEY.format(instance.pk))
+
+
+def verify_signed_token(token):
+    """
+    Check a signed token without touching the database.
+
+    :param token: Token string
+    :return: The user id the token was issued to
+    :raises AuthenticationFailed: If the token is malformed, forged, expired or revoked
+    """
+    parts = token.split('.')
+    if len(parts) != 5 or parts[0] != SIGNED_TOKEN_PREFIX:
+        raise exceptions.AuthenticationFailed('Invalid token.')
+    _, user_id, version, expires, signature = parts
+    if not (user_id.isdigit() and version.isdigit() and expires.isdigit()):
+        raise exceptions.AuthenticationFailed('Invalid token.')
+    if not constant_time_compare(signature, _signature(user_id, version, expires)):
+        raise exceptions.AuthenticationFailed('Invalid token.')
+    if int(expires) < time.time():
+        raise exceptions.AuthenticationFailed('Token has expired.')
+    if int(version) != get_token_version(int(user_id)):
+        raise exceptions.AuthenticationFailed('Token has been revoked.')
+    return int(user_id)
+
+
+def user_id_for_token(token):
+    """
+    Resolve either kind of token to a user id, for code outside DRF views.
+
+    :param token: Signed token or authtoken key
+    :return: The user id
+    :raises AuthenticationFailed: If the token is not valid
+    """
+    if token.startswith(SIGNED_TOKEN_PREFIX + '.'):
+        return verify_signed_token(token)
+    user_id = Token.objects.filter(key=token, user__is_active=True).values_list('user_id', flat=True).first()
+    if user_id is None:
+        raise exceptions.AuthenticationFailed('Invalid token.')
+    return user_id
+
+
+class SignedTokenUser(SimpleLazyObject):
+    """
+    Lazily loaded user for a verified signed token.
+
+    The id and authentication state are known from the token, so
+    permission checks and ``request.user.id`` need no query; the User row
+    is fetched only when any other attribute is used.
+    """
+
+    def __init__(self, user_id):
+        super().__init__(lambda: self._load(user_id))
+        self.__dict__['_user_id'] = user_id
+
+    @staticmethod
+    def _load(user_id):
+        try:
+            return User.objects.get(pk=user_id, is_active=True)
+        except User.DoesNotExist:
+            raise exceptions.AuthenticationFailed('User inactive or deleted.')
+
+    @property
+    def id(self):
+        return self.__dict__['_user_id']
+
+    pk = id
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def __bool__(self):
+        return True
+
+
+class SignedTokenAuthentication(TokenAuthentication):
+    """
+    Authentication class accepting signed tokens in the ``Token`` header.
+
+    Uses the same ``Authorization: Token <value>`` header as DRF's
+    TokenAuthentication and returns None for anything that is not a signed
+    token, so both classes can be listed and old keys keep working.
+    """
+
+    def authenticate(self, request):
+        auth = get_authorization_header(request).split()
+        if len(auth) != 2 or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        try:
+            token = auth[1].decode()
+        except UnicodeError:
+            return None
+        if not token.startswith(SIGNED_TOKEN_PREFIX + '.'):
+            return None
+        return SignedTokenUser(verify_signed_token(token)), token
@@ -0,0 +1,487 @@
+"""
+Streaming backup format used by the ``backup`` and ``restore`` commands.
+
+A backup is a gzip-compressed text file with one JSON document per line:
+
+* a header ``{"format": ..., "since": {...}, "upto": {...}}`` giving, per
+  table, the exclusive lower and inclusive upper cursor of the rows it holds;
+* for every table, a ``{"table": name, "columns": [...]}`` line followed by
+  one JSON array per row;
+* in incremental backups, ``{"table": name, "delete": column, "columns":
+  [column]}`` lines followed by one ``[value]`` per row to delete, placed
+  before the rows of that table.
+
+Rows are read in primary-key order with keyset pagination and written as
+they are read, and restore inserts them in chunked transactions, so memory
+use stays constant regardless of table size.
+
+Incremental backups pass the header of the previous backup as ``since``
+and contain the rows created after it. Token versions and recurring
+expense templates are small and always copied in full. Expenses can be
+edited and deleted, and every such change is a ledger event, so the
+ledger events since the previous backup give the rest:
+
+* expenses edited since are written again and upserted on restore; their
+  participant rows are deleted and written again, so removed participants
+  stay removed;
+* expenses deleted since are written as deletes, and so are expenses
+  archived since, which restore then finds only in the archive.
+
+Every backup records its last ledger event in the ``backup`` projection
+checkpoint, and ``replay_projections --compact`` keeps the events after
+it, so an incremental backup taken from the latest backup still finds
+them. Incremental backups from an older backup may miss edits and
+deletes once the ledger has been compacted.
+
+Archived expenses are copied by archival time, together with their
+participants. Opening balances and debts are copied by ``updated_at``,
+which moves whenever an archive run adds to a row, and are upserted.
+
+Users are copied by ``updated_at`` and upserted, so deactivations and
+password changes reach incremental backups; changes made with
+``QuerySet.update()`` do not move ``updated_at`` and are only in full
+backups. Deleted users and authtoken keys leave a Tombstone, written as a
+delete by the next incremental backup. Timestamps are taken before the
+transaction commits, so a row can become visible after a backup has read
+past its timestamp: timestamp cursors start ``BACKUP_CURSOR_OVERLAP``
+seconds before the previous backup's, and the rows read twice are skipped
+or upserted on restore.
+
+Other tables are append-only. Projection tables are derived from the
+ledger and are not backed up; run ``replay_projections --rebuild`` after
+a restore.
+"""
+import datetime
+import gzip
+import itertools
+import json
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Q
+from rest_framework.authtoken.models import Token
+
+from .models import (
+    ArchivedExpense, Expense, LedgerEvent, OpeningBalance, OpeningDebt, Payment, ProjectionCheckpoint,
+    RecurringExpense, Tombstone, TokenVersion, User, UserChange,
+)
+from .projections import BACKUP_CHECKPOINT
+
+
+FORMAT = 'expenses-backup/3'
+# Formats restore still reads; version 1 had no delete sections and
+# version 2 copied users by id
+FORMATS = (FORMAT, 'expenses-backup/2', 'expenses-backup/1')
+# Keeps ``IN`` lists under SQLite's bound-parameter limit.
+LOOKUP_BATCH = 900
+
+
+class Table:
+    """
+    Backup settings for one model.
+
+    :param name: Table name used in the backup file
+    :param model: Model class
+    :param cursor: Field used for ordering and incremental cursors, or
+                   None to copy the whole table every time
+    :param upsert: Update existing rows on restore instead of skipping them
+    :param changes: Function of (since, upto) headers returning ``(changed,
+                    deleted)`` primary keys of rows written before ``since``
+                    that changed since: changed rows are written again,
+                    deleted ones as deletes
+    :param parent: (table name, column) for rows belonging to a row of an
+                   earlier table; they are copied along with the parent
+                   rows in the backup's cursor range, and the rows of
+                   changed parents are replaced
+    """
+
+    def __init__(self, name, model, cursor='pk', upsert=False, changes=None, parent=None):
+        self.name = name
+        self.model = model
+        self.cursor = cursor
+        self.upsert = upsert
+        self.changes = changes
+        self.parent = parent
+
+    @property
+    def fields(self):
+        return [field for field in self.model._meta.concrete_fields]
+
+    @property
+    def columns(self):
+        return [field.attname for field in self.fields]
+
+
+def _batches(items, size=LOOKUP_BATCH):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def _expense_changes(since, upto):
+    """
+    Expenses backed up before ``since`` that were edited, deleted or
+    archived since. Edits and deletes are read from the ledger events
+    between the two backups; archiving writes no events, so archived
+    expenses are read from the archive by archival time.
+
+    :return: (ids of edited expenses that still exist, ids of deleted or archived expenses)
+    """
+    last_expense = since.get('expense')
+    if last_expense is None:
+        return [], []
+    touched = set()
+    first_event, last_event = since.get('ledger_event'), upto.get('ledger_event')
+    if last_event is not None:
+        events = LedgerEvent.objects.filter(
+            id__lte=last_event, expense_id__lte=last_expense,
+            kind__in=[LedgerEvent.EXPENSE_EDITED, LedgerEvent.EXPENSE_DELETED],
+        )
+        if first_event is not None:
+            events = events.filter(id__gt=first_event)
+        touched.update(events.values_list('expense_id', flat=True).distinct())
+    archives = TABLE_NAMED['archived_expense']
+    first_archived, last_archived = since.get(archives.name), upto.get(archives.name)
+    if last_archived is not None:
+        archived = ArchivedExpense.objects.filter(id__lte=last_expense, archived_at__lte=_cursor_value(archives, last_archived))
+        if first_archived is not None:
+            archived = archived.filter(archived_at__gt=_lower_bound(archives, first_archived))
+        touched.update(archived.values_list('id', flat=True))
+    existing = set()
+    for batch in _batches(sorted(touched)):
+        existing.update(Expense.objects.filter(id__in=batch).values_list('id', flat=True))
+    return sorted(existing), sorted(touched - existing)
+
+
+def _deletions(model):
+    """
+    Build the ``changes`` function of a table whose deleted rows leave a
+    Tombstone.
+
+    :param model: Model class of the table
+    :return: Function returning no changed rows and the primary keys
+             deleted between the two backups
+    """
+    label = model._meta.label_lower
+    pk = model._meta.pk
+
+    def changes(since, upto):
+        tombstones = TABLE_NAMED['tombstone']
+        first, last = since.get(tombstones.name), upto.get(tombstones.name)
+        if last is None:
+            return [], []
+        deleted = Tombstone.objects.filter(model=label, deleted_at__lte=_cursor_value(tombstones, last))
+        if first is not None:
+            deleted = deleted.filter(deleted_at__gt=_lower_bound(tombstones, first))
+        return [], sorted({pk.to_python(key) for key in deleted.values_list('key', flat=True)})
+    return changes
+
+
+def record_deletion(sender, instance, **kwargs):
+    """
+    ``post_delete`` receiver leaving a Tombstone for a deleted row.
+    """
+    Tombstone.objects.create(model=sender._meta.label_lower, key=str(instance.pk))
+
+
+# Parents come before children so restore never references a missing row.
+TABLES = [
+    Table('user', User, cursor='updated_at', upsert=True, changes=_deletions(User)),
+    Table('recurring_expense', RecurringExpense, cursor=None, upsert=True),
+    Table('recurring_expense_participant', RecurringExpense.participants.through, cursor=None),
+    Table('expense', Expense, upsert=True, changes=_expense_changes),
+    Table('expense_participant', Expense.participants.through, cursor=None, parent=('expense', 'expense_id')),
+    Table('payment', Payment),
+    # Archived rows keep their old ids, so new ones are found by archival time.
+    Table('archived_expense', ArchivedExpense, cursor='archived_at'),
+    Table(
+        'archived_expense_participant', ArchivedExpense.participants.through,
+        cursor=None, parent=('archived_expense', 'archivedexpense_id'),
+    ),
+    # Archive runs add to existing opening rows, which moves ``updated_at``.
+    Table('opening_balance', OpeningBalance, cursor='updated_at', upsert=True),
+    Table('opening_debt', OpeningDebt, cursor='updated_at', upsert=True),
+    Table('token', Token, cursor='created', changes=_deletions(Token)),
+    Table('token_version', TokenVersion, cursor=None, upsert=True),
+    Table('ledger_event', LedgerEvent),
+    Table('user_change', UserChange),
+    Table('tombstone', Tombstone, cursor='deleted_at'),
+]
+TABLE_NAMED = {table.name: table for table in TABLES}
+
+
+def _encode(value):
+    if isinstance(value, Decimal):
+        return str(value)
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    raise TypeError(f'Cannot encode {type(value).__name__}')
+
+
+def _dumps(value):
+    return json.dumps(value, default=_encode, separators=(',', ':'))
+
+
+def _cursor_value(table, value):
+    """
+    Convert a cursor value read from a header back to a Python value.
+
+    :param table: Table the cursor belongs to
+    :param value: JSON value from a header
+    :return: Value usable in a queryset filter
+    """
+    if value is None or table.cursor == 'pk':
+        return value
+    return table.model._meta.get_field(table.cursor).to_python(value)
+
+
+def _lower_bound(table, value):
+    """
+    Exclusive lower cursor bound of an incremental backup, moved
+    ``BACKUP_CURSOR_OVERLAP`` seconds back for timestamp cursors.
+
+    :param table: Table the cursor belongs to
+    :param value: JSON value from the previous backup's header
+    :return: Value usable in a queryset filter
+    """
+    value = _cursor_value(table, value)
+    if isinstance(value, datetime.datetime):
+        value -= datetime.timedelta(seconds=settings.BACKUP_CURSOR_OVERLAP)
+    return value
+
+
+def read_header(path):
+    """
+    Read the header line of a backup file.
+
+    :param path: Backup file path
+    :return: Header dict
+    :raises ValueError: If the file is not a backup in this format
+    """
+    with gzip.open(path, 'rt', encoding='utf-8') as handle:
+        header = json.loads(handle.readline() or '{}')
+    if header.get('format') not in FORMATS:
+        raise ValueError(f'{path} is not a {FORMAT} file')
+    return header
+
+
+def dump(path, since=None, chunk_size=2000):
+    """
+    Write a backup file.
+
+    :param path: Destination path
+    :param since: Header of a previous backup for an incremental backup
+    :param chunk_size: Rows fetched per query
+    :return: dict mapping table names to the number of rows written
+    :raises ValueError: If ``since`` is the header of an older format
+    """
+    if since and since.get('format') != FORMAT:
+        raise ValueError(f'Incremental backups need a {FORMAT} backup to start from; take a full backup first')
+    since = (since or {}).get('upto', {})
+    upto = {}
+    for table in TABLES:
+        if table.cursor is not None:
+            field = table.model._meta.pk.attname if table.cursor == 'pk' else table.cursor
+            last = table.model.objects.order_by(f'-{table.cursor}').values_list(field, flat=True).first()
+            upto[table.name] = last if last is not None else since.get(table.name)
+
+    changes = {table.name: table.changes(since, upto) for table in TABLES if since and table.changes}
+
+    counts = {}
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as handle:
+        handle.write(_dumps({
+            'format': FORMAT,
+            'created_at': datetime.datetime.now(datetime.timezone.utc),
+            'incremental': bool(since),
+            'since': since,
+            'upto': upto,
+        }) + '\n')
+        for table in TABLES:
+            columns = table.columns
+            changed, deleted = changes.get(table.name, ([], []))
+            column = table.model._meta.pk.attname
+            replaced = []
+            if table.parent is not None:
+                # Rows of changed parents are deleted, then written again
+                column = table.parent[1]
+                replaced = deleted = changes.get(table.parent[0], ([], []))[0]
+            if deleted:
+                handle.write(_dumps({'table': table.name, 'delete': column, 'columns': [column]}) + '\n')
+                for value in deleted:
+                    handle.write(_dumps([value]) + '\n')
+                counts[f'{table.name} deletes'] = len(deleted)
+
+            handle.write(_dumps({'table': table.name, 'columns': columns}) + '\n')
+            counts[table.name] = 0
+            if table.parent is not None:
+                rows = _iter_children(table, columns, since, upto, chunk_size)
+            else:
+                rows = _iter_rows(table, columns, since.get(table.name), upto.get(table.name), chunk_size)
+            if changed:
+                rows = itertools.chain(rows, _iter_rows_of(table, columns, 'pk', changed))
+            if replaced:
+                rows = itertools.chain(rows, _iter_rows_of(table, columns, table.parent[1], replaced))
+            for row in rows:
+                handle.write(_dumps(row) + '\n')
+                counts[table.name] += 1
+    ProjectionCheckpoint.objects.update_or_create(
+        name=BACKUP_CHECKPOINT, defaults={'offset': upto.get('ledger_event') or 0},
+    )
+    return counts
+
+
+def _iter_rows_of(table, columns, field, values):
+    """
+    Yield the rows of a table whose field holds one of the values, one
+    batch of values per query.
+    """
+    for batch in _batches(values):
+        yield from table.model.objects.filter(**{f'{field}__in': batch}).order_by('pk').values_list(*columns)
+
+
+def _iter_children(table, columns, since, upto, chunk_size):
+    """
+    Yield the rows of a child table whose parent row is in the backup's
+    range of the parent's cursor, in primary-key order, one chunk per query.
+
+    :param table: Table with a ``parent``
+    :param columns: Column attnames to read
+    :param since: ``upto`` cursors of the previous backup
+    :param upto: Cursors of this backup
+    :param chunk_size: Rows per query
+    """
+    parent = TABLE_NAMED[table.parent[0]]
+    upper = upto.get(parent.name)
+    if upper is None:
+        return
+    field = next(field for field in table.fields if field.attname == table.parent[1])
+    cursor = field.attname if parent.cursor == 'pk' else f'{field.name}__{parent.cursor}'
+    queryset = table.model.objects.filter(**{f'{cursor}__lte': _cursor_value(parent, upper)})
+    if since.get(parent.name) is not None:
+        queryset = queryset.filter(**{f'{cursor}__gt': _lower_bound(parent, since[parent.name])})
+    pk_index = columns.index(table.model._meta.pk.attname)
+    last_pk = None
+    while True:
+        page = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        rows = list(page.order_by('pk').values_list(*columns)[:chunk_size])
+        if not rows:
+            return
+        yield from rows
+        last_pk = rows[-1][pk_index]
+
+
+def _iter_rows(table, columns, lower, upper, chunk_size):
+    """
+    Yield rows of a table in cursor order, one chunk per query.
+
+    :param table: Table to read
+    :param columns: Column attnames to read
+    :param lower: Exclusive lower cursor bound, or None
+    :param upper: Inclusive upper cursor bound, or None
+    :param chunk_size: Rows per query
+    """
+    queryset = table.model.objects.all()
+    if table.cursor is None:
+        yield from queryset.order_by('pk').values_list(*columns).iterator(chunk_size=chunk_size)
+        return
+    if upper is None:
+        return
+    pk_index = columns.index(table.model._meta.pk.attname)
+    if table.cursor == 'pk':
+        cursor, cursor_index = 'pk', pk_index
+    else:
+        cursor, cursor_index = table.cursor, columns.index(table.cursor)
+    queryset = queryset.filter(**{f'{cursor}__lte': _cursor_value(table, upper)}).order_by(cursor, 'pk')
+    lower = _lower_bound(table, lower)
+    last_pk = None
+    while True:
+        page = queryset
+        if last_pk is not None and cursor != 'pk':
+            # Rows sharing the last cursor value continue by primary key.
+            page = page.filter(Q(**{f'{cursor}__gt': lower}) | Q(**{cursor: lower, 'pk__gt': last_pk}))
+        elif lower is not None:
+            page = page.filter(**{f'{cursor}__gt': lower})
+        rows = list(page.values_list(*columns)[:chunk_size])
+        if not rows:
+            return
+        yield from rows
+        lower, last_pk = rows[-1][cursor_index], rows[-1][pk_index]
+
+
+def load(path, chunk_size=2000):
+    """
+    Restore a backup file, full or incremental.
+
+    Rows already present (same primary key) are skipped, except for tables
+    marked ``upsert`` whose rows are updated, so a backup can be restored
+    more than once. Delete sections remove their rows, with cascades.
+
+    :param path: Backup file path
+    :param chunk_size: Rows inserted per transaction
+    :return: dict mapping table names to the number of rows read
+    """
+    counts = {}
+    with gzip.open(path, 'rt', encoding='utf-8') as handle:
+        header = json.loads(handle.readline() or '{}')
+        if header.get('format') not in FORMATS:
+            raise ValueError(f'{path} is not a {FORMAT} file')
+        table = fields = delete = None
+        batch = []
+        for line in handle:
+            item = json.loads(line)
+            if isinstance(item, dict):
+                _flush(table, batch, delete)
+                batch = []
+                table = TABLE_NAMED[item['table']]
+                by_attname = {field.attname: field for field in table.fields}
+                fields = [by_attname[column] for column in item['columns']]
+                delete = item.get('delete')
+                key = f'{table.name} deletes' if delete else table.name
+                limit = min(chunk_size, LOOKUP_BATCH) if delete else chunk_size
+                counts[key] = 0
+                continue
+            if delete:
+                batch.append(fields[0].to_python(item[0]))
+            else:
+                batch.append(table.model(**{
+                    field.attname: field.to_python(value) if value is not None else None
+                    for field, value in zip(fields, item)
+                }))
+            counts[key] += 1
+            if len(batch) >= limit:
+                _flush(table, batch, delete)
+                batch = []
+        _flush(table, batch, delete)
+    _reset_sequences()
+    return counts
+
+
+def _flush(table, batch, delete=None):
+    if not batch:
+        return
+    with transaction.atomic():
+        if delete:
+            table.model.objects.filter(**{f'{delete}__in': batch}).delete()
+        elif table.upsert:
+            update_fields = [field.name for field in table.fields if not field.primary_key]
+            table.model.objects.bulk_create(
+                batch,
+                update_conflicts=True,
+                update_fields=update_fields,
+                unique_fields=[table.model._meta.pk.name],
+            )
+        else:
+            table.model.objects.bulk_create(batch, ignore_conflicts=True)
+
+
+def _reset_sequences():
+    """
+    Move auto-increment sequences past the restored ids (no-op on SQLite).
+    """
+    statements = connection.ops.sequence_reset_sql(no_style(), [table.model for table in TABLES])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
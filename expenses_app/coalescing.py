@@ -0,0 +1,272 @@
+"""
+Single-flight sharing of expensive streamed responses.
+
+Identical requests that arrive while a response is still being produced
+join it instead of starting their own computation. The response body is a
+``Flight``: its source generator runs once, each chunk is kept, and every
+reader replays the kept chunks and then pulls the next one from the source
+(whichever reader gets there first produces it, under the flight's lock).
+Chunks are dropped once every live reader has read them, so memory holds
+only the chunks between the slowest and the fastest reader.
+
+A request can only join while the flight still has its first chunk. A
+flight leaves the registry when its first chunk is dropped, when its
+source is exhausted or when every reader has gone, so a request arriving
+after that computes fresh data.
+
+The number of distinct flights running at once, joinable or not, is
+capped; a request that would start one more gets a 503 with
+``Retry-After`` instead of queueing.
+"""
+import threading
+
+from django.conf import settings
+from rest_framework import exceptions, status
+
+from . import metrics
+
+
+COALESCED_REQUESTS = metrics.registry.counter(
+    'coalesced_requests_total',
+    'Requests to coalesced endpoints, by outcome (leader/follower/rejected).',
+    ('endpoint', 'outcome'),
+)
+
+
+class Overloaded(exceptions.APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = 'Too many reports are being generated. Try again shortly.'
+    default_code = 'overloaded'
+    # Sent as Retry-After by DRF's exception handler.
+    wait = 5
+
+
+class Flight:
+    """
+    A generator whose output is shared by every reader.
+
+    Chunks are kept only until every live reader has consumed them, so a
+    flight holds the gap between its fastest and slowest reader rather than
+    the whole response. Once the first chunk is dropped the output can no
+    longer be replayed from the start, so the flight stops taking readers
+    and ``on_evict`` is called.
+
+    :param source: Iterator of bytes chunks
+    :param on_done: Called once when the source is exhausted, fails or is
+                    abandoned by every reader
+    :param on_evict: Called once when the first chunk is dropped
+    """
+
+    def __init__(self, source, on_done, on_evict=None):
+        self.source = source
+        self.on_done = on_done
+        self.on_evict = on_evict
+        # chunks[i] is chunk number first + i
+        self.chunks = []
+        self.first = 0
+        self.done = False
+        self.error = None
+        self.readers = set()
+        self.lock = threading.Lock()
+
+    def _finish(self, error=None):
+        self.done = True
+        self.error = error
+        self.source = None
+        self.on_done(self)
+
+    def _evict(self):
+        """
+        Drop the chunks every live reader is past.
+        """
+        if not self.readers:
+            return
+        low = min(reader.index for reader in self.readers)
+        if low <= self.first:
+            return
+        del self.chunks[:low - self.first]
+        if self.first == 0 and self.on_evict is not None:
+            self.on_evict(self)
+        self.first = low
+
+    def reader(self):
+        """
+        :return: Reader iterating over the whole output from the first chunk,
+                 or None if the first chunk was already dropped
+        """
+        with self.lock:
+            if self.first:
+                return None
+            reader = Reader(self)
+            self.readers.add(reader)
+        return reader
+
+    def release(self, reader):
+        """
+        Called when a reader is closed; stops the source once nobody reads it.
+
+        :param reader: The closed Reader
+        """
+        with self.lock:
+            self.readers.discard(reader)
+            self._evict()
+            if self.readers or self.done:
+                return
+            close = getattr(self.source, 'close', None)
+            self._finish(exceptions.APIException('The response was abandoned.'))
+        if close is not None:
+            close()
+
+    def chunk(self, reader):
+        """
+        Return a reader's next chunk, producing it if no reader has yet.
+
+        :param reader: Reader asking for its chunk ``reader.index``
+        :return: bytes, or None after the last chunk
+        """
+        with self.lock:
+            index = reader.index
+            end = self.first + len(self.chunks)
+            if index == end and not self.done:
+                try:
+                    self.chunks.append(next(self.source))
+                    end += 1
+                except StopIteration:
+                    self._finish()
+                except Exception as exc:
+                    self._finish(exc)
+                    raise
+            if index < end:
+                chunk = self.chunks[index - self.first]
+                reader.index += 1
+                self._evict()
+                return chunk
+            if self.error is not None:
+                raise self.error
+            return None
+
+
+class Reader:
+    """
+    One response's iterator over a flight.
+
+    StreamingHttpResponse calls ``close`` when the response is finished or
+    dropped, even if it was never iterated.
+    """
+
+    def __init__(self, flight):
+        self.flight = flight
+        self.index = 0
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self.flight.chunk(self)
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.flight.release(self)
+
+
+class SingleFlight:
+    """
+    Registry of in-flight responses for one endpoint.
+
+    :param name: Endpoint name used in metrics
+    :param max_in_flight: Distinct flights allowed at once, defaults to
+                          ``COALESCE_MAX_IN_FLIGHT``
+    """
+
+    def __init__(self, name, max_in_flight=None):
+        self.name = name
+        self.max_in_flight = max_in_flight
+        self._lock = threading.Lock()
+        # Joinable flights by key, and every flight still running
+        self._flights = {}
+        self._running = set()
+
+    def _detach(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def _discard(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+            self._running.discard(flight)
+
+    def join(self, key):
+        """
+        Return a reader of the flight in progress for a key, if any.
+
+        :param key: Hashable description of the request
+        :return: Iterator of bytes, or None
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+        reader = flight.reader() if flight is not None else None
+        if reader is not None:
+            COALESCED_REQUESTS.inc(self.name, 'follower')
+        return reader
+
+    def reserve(self):
+        """
+        Fail early if no new flight could be started.
+
+        :raises Overloaded: If the in-flight cap is reached
+        """
+        limit = self.max_in_flight or settings.COALESCE_MAX_IN_FLIGHT
+        with self._lock:
+            if len(self._running) >= limit:
+                COALESCED_REQUESTS.inc(self.name, 'rejected')
+                raise Overloaded()
+
+    def start(self, key, source):
+        """
+        Share a new computation under a key.
+
+        If another request started the same key meanwhile, the new source is
+        dropped and its flight joined instead.
+
+        :param key: Hashable description of the request
+        :param source: Iterator of bytes chunks
+        :return: Iterator of bytes
+        :raises Overloaded: If the in-flight cap is reached
+        """
+        limit = self.max_in_flight or settings.COALESCE_MAX_IN_FLIGHT
+        while True:
+            with self._lock:
+                flight = self._flights.get(key)
+                if flight is None:
+                    if len(self._running) >= limit:
+                        COALESCED_REQUESTS.inc(self.name, 'rejected')
+                        raise Overloaded()
+                    flight = self._flights[key] = Flight(
+                        source, lambda done: self._discard(key, done), lambda evicted: self._detach(key, evicted),
+                    )
+                    self._running.add(flight)
+                    outcome = 'leader'
+                else:
+                    outcome = 'follower'
+            # Taken outside the registry lock: flights call back into it under their own.
+            reader = flight.reader()
+            if reader is not None:
+                break
+            # The flight dropped its first chunk meanwhile and left the registry.
+        if outcome == 'follower':
+            close = getattr(source, 'close', None)
+            if close is not None:
+                close()
+        COALESCED_REQUESTS.inc(self.name, outcome)
+        return reader
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._running)
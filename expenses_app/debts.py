@@ -0,0 +1,137 @@
+"""
+Pairwise net debts between users.
+
+``DebtMatrix`` makes one pass over the shares of the selected expenses: a
+share of a user other than the expense creator is a debt of that user to
+the creator. Debts carried forward from archived expenses are added, and
+payments then settle debts: paying someone reduces what the payer owes
+them. Debts in both directions between two users cancel, so each
+pair keeps a single signed total, and only pairs that interacted are
+stored; the matrix of thousands of users costs memory proportional to the
+number of pairs that actually share expenses.
+
+The result is exposed as an edge list or in compressed sparse row form,
+with users renumbered densely so the arrays stay small.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import F, Q
+from django.db.models.functions import TruncDate
+from rest_framework import serializers
+
+from . import fx
+from .models import Expense, OpeningDebt, Payment
+
+
+CENT = Decimal('0.01')
+LAYOUTS = ('edges', 'csr')
+
+
+class DebtMatrixParamsSerializer(serializers.Serializer):
+    """
+    Serializer validating the debt matrix query parameters.
+
+    - ``users``: comma-separated user ids to restrict the matrix to, all
+      users by default
+    - ``layout``: ``edges`` (default) or ``csr``
+    """
+
+    users = serializers.CharField(required=False)
+    layout = serializers.ChoiceField(choices=LAYOUTS, default='edges')
+
+    def validate_users(self, value):
+        try:
+            users = {int(user_id) for user_id in value.split(',') if user_id.strip()}
+        except ValueError:
+            raise serializers.ValidationError("users must be a comma-separated list of ids")
+        if not users:
+            raise serializers.ValidationError("users must not be empty")
+        return users
+
+
+class DebtMatrix:
+    """
+    Net debts between every pair of users, in one currency.
+
+    :param currency: Reporting currency
+    :param user_ids: Only count debts between these users, defaults to all
+    """
+
+    def __init__(self, currency, user_ids=None):
+        self.currency = currency
+        expenses = Expense.objects.order_by()
+        payments = Payment.objects.order_by()
+        # Each pair is stored in both directions; one is enough.
+        opening = OpeningDebt.objects.order_by().filter(user__lt=F('counterparty'))
+        if user_ids is not None:
+            expenses = expenses.filter(created_by__in=user_ids)
+            payments = payments.filter(payer__in=user_ids, payee__in=user_ids)
+            opening = opening.filter(user__in=user_ids, counterparty__in=user_ids)
+        opening = list(opening.values_list('user_id', 'counterparty_id', 'currency', 'as_of', 'amount'))
+        days = {row[3] for row in opening}
+        for queryset in (expenses, payments):
+            days.update(
+                queryset.filter(~Q(currency=currency))
+                .annotate(day=TruncDate('created_at'))
+                .values_list('day', flat=True).distinct()
+            )
+        converter = fx.Converter(currency, days)
+
+        # (lower id, higher id) -> what the lower id owes the higher one
+        net = defaultdict(Decimal)
+        rows = expenses.values_list('created_by_id', 'currency', 'created_at', 'split_details')
+        for creditor, expense_currency, created_at, split_details in rows.iterator(chunk_size=2000):
+            factor = converter.factor(expense_currency, created_at)
+            for debtor, amount in split_details.items():
+                debtor = int(debtor)
+                if debtor == creditor or (user_ids is not None and debtor not in user_ids):
+                    continue
+                amount = Decimal(amount) * factor
+                if debtor < creditor:
+                    net[debtor, creditor] += amount
+                else:
+                    net[creditor, debtor] -= amount
+        for lower, higher, opening_currency, as_of, amount in opening:
+            # amount is what the higher id owes the lower one
+            net[lower, higher] -= amount * converter.factor(opening_currency, as_of)
+        rows = payments.values_list('payer_id', 'payee_id', 'amount', 'currency', 'created_at')
+        for payer, payee, amount, payment_currency, created_at in rows.iterator(chunk_size=2000):
+            amount = amount * converter.factor(payment_currency, created_at)
+            if payer < payee:
+                net[payer, payee] -= amount
+            else:
+                net[payee, payer] += amount
+
+        self.debts = {}
+        for (lower, higher), amount in net.items():
+            amount = amount.quantize(CENT)
+            if amount > 0:
+                self.debts[lower, higher] = amount
+            elif amount < 0:
+                self.debts[higher, lower] = -amount
+        self.users = sorted({user_id for pair in self.debts for user_id in pair})
+
+    def edges(self):
+        """
+        :return: List of [debtor, creditor, amount string] sorted by debtor and creditor
+        """
+        return [[debtor, creditor, str(amount)] for (debtor, creditor), amount in sorted(self.debts.items())]
+
+    def csr(self):
+        """
+        The matrix with a row per debtor and a column per creditor, both
+        numbered by position in ``users``.
+
+        :return: dict with ``indptr``, ``indices`` and ``data`` (amount strings)
+        """
+        index = {user_id: position for position, user_id in enumerate(self.users)}
+        indptr = [0] * (len(self.users) + 1)
+        indices, data = [], []
+        for (debtor, creditor), amount in sorted(self.debts.items()):
+            indptr[index[debtor] + 1] += 1
+            indices.append(index[creditor])
+            data.append(str(amount))
+        for row in range(len(self.users)):
+            indptr[row + 1] += indptr[row]
+        return {'indptr': indptr, 'indices': indices, 'data': data}
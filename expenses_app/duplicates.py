@@ -0,0 +1,184 @@
+"""
+Detection of duplicate expenses.
+
+Clients that retry or re-import sometimes submit the same expense twice.
+Instead of comparing a new expense with the history, each expense stores
+a fingerprint: a hash of its creator, amount, currency, participants,
+normalized category and creation time rounded down to a bucket of
+``DUPLICATE_WINDOW_SECONDS``. Duplicates share a fingerprint, so finding
+one is a single probe of the indexed ``fingerprint`` column.
+
+Two submissions either side of a bucket boundary get different
+fingerprints, so new expenses are also checked against the previous
+bucket; a duplicate is therefore always found within one window and never
+beyond two.
+
+There is no unique constraint (flagged duplicates are stored), so the
+probe and the insert must not interleave with another request of the same
+creator: ``lock_creator`` makes concurrent retries wait for each other,
+and the later one then finds the earlier one's expense.
+
+Expenses created before fingerprints existed, or materialized from
+recurring templates, have none until ``backfill`` computes it;
+``clusters`` then groups the whole table by fingerprint in the database.
+"""
+import collections
+import hashlib
+import itertools
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Count, F
+
+from .models import Expense, User
+
+
+CENT = Decimal('0.01')
+DEFAULT_CHUNK_SIZE = 2000
+
+
+def normalize_category(category):
+    """
+    Category as compared for duplicates: case-folded, with runs of spaces
+    collapsed.
+    """
+    return ' '.join((category or '').split()).casefold()
+
+
+def _bucket(created_at):
+    return int(created_at.timestamp()) // settings.DUPLICATE_WINDOW_SECONDS
+
+
+def _hash(created_by, total_amount, currency, participants, category, bucket):
+    key = '|'.join([
+        str(created_by),
+        str(Decimal(total_amount).quantize(CENT)),
+        currency.upper(),
+        ','.join(str(user_id) for user_id in sorted({int(user_id) for user_id in participants} | {int(created_by)})),
+        normalize_category(category),
+        str(bucket),
+    ])
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def fingerprint(created_by, total_amount, currency, participants, category, created_at):
+    """
+    Fingerprint of an expense.
+
+    :param created_by: Id of the creator, who always counts as a participant
+    :param total_amount: Total amount
+    :param currency: ISO 4217 code
+    :param participants: Ids of the participants
+    :param category: Category
+    :param created_at: Aware datetime of creation
+    :return: Hex digest
+    """
+    return _hash(created_by, total_amount, currency, participants, category, _bucket(created_at))
+
+
+def candidate_fingerprints(created_by, total_amount, currency, participants, category, created_at):
+    """
+    Fingerprints a duplicate of a new expense may have been stored with:
+    its own, then the one for the previous time bucket.
+
+    :return: List of two hex digests
+    """
+    bucket = _bucket(created_at)
+    return [_hash(created_by, total_amount, currency, participants, category, b) for b in (bucket, bucket - 1)]
+
+
+def lock_creator(created_by):
+    """
+    Hold the creator's row lock until the current transaction commits.
+
+    Call it before ``find_duplicate``. A no-op update takes the row lock
+    on backends with row locks; on SQLite, where the first write of a
+    transaction takes the database write lock, it makes the transaction
+    wait (up to the busy timeout) before probing rather than fail with
+    "database is locked" when it writes after another request's probe.
+
+    :param created_by: Id of the creator
+    """
+    User.objects.filter(pk=created_by).update(updated_at=F('updated_at'))
+
+
+def find_duplicate(fingerprints):
+    """
+    The oldest expense stored with one of the fingerprints.
+
+    :param fingerprints: Hex digests, e.g. from ``candidate_fingerprints``
+    :return: Expense id, or None
+    """
+    return Expense.objects.filter(fingerprint__in=fingerprints).order_by('id').values_list('id', flat=True).first()
+
+
+def refresh(expense):
+    """
+    Recompute the stored fingerprint of an edited expense.
+
+    The creation time, and so the bucket, never changes.
+
+    :param expense: Saved Expense instance
+    """
+    participants = expense.participants.values_list('id', flat=True)
+    expense.fingerprint = fingerprint(
+        expense.created_by_id, expense.total_amount, expense.currency, participants, expense.category, expense.created_at,
+    )
+    Expense.objects.filter(pk=expense.pk).update(fingerprint=expense.fingerprint)
+
+
+def backfill(chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Compute the fingerprints of expenses that have none, one id-ordered
+    chunk per query.
+
+    :param chunk_size: Expenses per chunk
+    :return: Number of expenses updated
+    """
+    Participant = Expense.participants.through
+    updated = 0
+    after = 0
+    while True:
+        expenses = list(
+            Expense.objects.filter(fingerprint__isnull=True, id__gt=after).order_by('id')
+            .only('id', 'created_by_id', 'total_amount', 'currency', 'category', 'created_at')[:chunk_size]
+        )
+        if not expenses:
+            return updated
+        participants = collections.defaultdict(list)
+        for expense_id, user_id in (
+            Participant.objects.filter(expense_id__gte=expenses[0].id, expense_id__lte=expenses[-1].id)
+            .values_list('expense_id', 'user_id')
+        ):
+            participants[expense_id].append(user_id)
+        for expense in expenses:
+            expense.fingerprint = fingerprint(
+                expense.created_by_id, expense.total_amount, expense.currency, participants[expense.id],
+                expense.category, expense.created_at,
+            )
+        Expense.objects.bulk_update(expenses, ['fingerprint'])
+        updated += len(expenses)
+        after = expenses[-1].id
+
+
+def clusters(since=None):
+    """
+    Groups of expenses sharing a fingerprint.
+
+    The database finds the repeated fingerprints from the index and rows
+    are streamed in fingerprint order, so memory holds one group at a time.
+    Duplicates created either side of a bucket boundary are not grouped.
+
+    :param since: Only consider expenses created at or after this aware datetime
+    :return: Iterator of (fingerprint, list of expense ids in id order)
+    """
+    expenses = Expense.objects.filter(fingerprint__isnull=False)
+    if since is not None:
+        expenses = expenses.filter(created_at__gte=since)
+    repeated = expenses.order_by().values('fingerprint').annotate(n=Count('id')).filter(n__gt=1).values('fingerprint')
+    rows = (
+        expenses.filter(fingerprint__in=repeated).order_by('fingerprint', 'id')
+        .values_list('fingerprint', 'id').iterator(chunk_size=DEFAULT_CHUNK_SIZE)
+    )
+    for key, group in itertools.groupby(rows, key=lambda row: row[0]):
+        yield key, [expense_id for _, expense_id in group]
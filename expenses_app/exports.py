@@ -0,0 +1,425 @@
+"""
+Streaming exports of the balance sheet.
+
+``BalanceSheet`` reads the expenses and then the payments once, in
+keyset-paginated chunks, and converts amounts into the reporting currency.
+The overall totals come from one grouped aggregate, so they are known
+before the first expense row is read; per-user totals are accumulated while
+the rows stream past, on top of the balances carried forward from archived
+expenses, and are available once they have all been yielded.
+
+Exporters turn a sheet into a stream of bytes and are registered by the
+``format`` clients select with ``?format=``:
+
+* ``csv``: the sectioned spreadsheet the API has always produced;
+* ``jsonl``: one JSON object per line, tagged with a ``type`` of
+  ``summary``, ``expense``, ``payment`` or ``balance``;
+* ``npz``: NumPy arrays (requires numpy) with the user x expense share
+  matrix in coordinate form, ready for ``scipy.sparse.coo_matrix``.
+
+``compress`` wraps any stream in on-the-fly gzip.
+"""
+import csv
+import io
+import json
+import zlib
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+from rest_framework import exceptions
+
+from . import fx
+from .models import Expense, OpeningBalance, Payment, User
+
+try:
+    import numpy
+except ImportError:  # pragma: no cover - optional dependency
+    numpy = None
+
+
+ZERO = Decimal('0')
+DEFAULT_CHUNK_SIZE = 2000
+# Bytes buffered before a chunk is yielded to the client.
+FLUSH_SIZE = 64 * 1024
+
+EXPORTERS = {}
+
+
+def register(cls):
+    """
+    Class decorator adding an exporter to the registry.
+    """
+    EXPORTERS[cls.format] = cls
+    return cls
+
+
+class BalanceSheet:
+    """
+    Balance sheet data in one reporting currency.
+
+    :param currency: Reporting currency
+    :param queryset: Expenses to include, defaults to all of them
+    :param chunk_size: Expenses or payments read per query
+    :param payments: Payments to include, defaults to all of them
+    """
+
+    def __init__(self, currency, queryset=None, chunk_size=DEFAULT_CHUNK_SIZE, payments=None):
+        self.currency = currency
+        self.queryset = queryset if queryset is not None else Expense.objects.all()
+        self.payment_queryset = payments if payments is not None else Payment.objects.all()
+        self.chunk_size = chunk_size
+        self.users = list(User.objects.order_by('id').values_list('id', 'name'))
+        self.names = dict(self.users)
+
+        groups = list(
+            self.queryset.order_by()
+            .annotate(day=TruncDate('created_at'))
+            .values('currency', 'day')
+            .annotate(total=Sum('total_amount'), count=Count('id'))
+        )
+        payment_days = self.payment_queryset.order_by().annotate(day=TruncDate('created_at')).values_list('day', flat=True).distinct()
+        opening = list(OpeningBalance.objects.values_list('user_id', 'currency', 'as_of', 'paid', 'owed'))
+        days = {group['day'] for group in groups} | set(payment_days) | {row[2] for row in opening}
+        self.converter = fx.Converter(currency, days)
+        self.total = sum((group['total'] * self.converter.factor(group['currency'], group['day']) for group in groups), ZERO)
+        self.count = sum(group['count'] for group in groups)
+        self.paid = defaultdict(Decimal)
+        self.owed = defaultdict(Decimal)
+        for user_id, opening_currency, as_of, paid, owed in opening:
+            factor = self.converter.factor(opening_currency, as_of)
+            self.paid[user_id] += paid * factor
+            self.owed[user_id] += owed * factor
+
+    def _chunks(self, queryset, columns):
+        """
+        Rows of a queryset in (created_at, id) order; ``columns`` must start
+        with ``id`` and ``created_at``.
+        """
+        queryset = queryset.order_by('created_at', 'id')
+        last = None
+        while True:
+            page = queryset
+            if last is not None:
+                page = page.filter(created_at__gte=last[0]).exclude(created_at=last[0], id__lte=last[1])
+            rows = list(page.values_list(*columns)[:self.chunk_size])
+            if not rows:
+                return
+            yield rows
+            last = (rows[-1][1], rows[-1][0])
+
+    def expenses(self):
+        """
+        Yield every expense in date order, accumulating per-user totals.
+
+        :return: Iterator of dicts with ``id``, ``created_at``, ``category``,
+                 ``total_amount``, ``currency``, ``created_by``,
+                 ``split_method``, ``participants`` (user ids), ``shares``
+                 (``{user id: Decimal}`` in the expense currency) and
+                 ``factor`` (into the reporting currency)
+        """
+        Participant = Expense.participants.through
+        columns = ('id', 'created_at', 'category', 'total_amount', 'currency', 'created_by_id', 'split_method', 'split_details')
+        for rows in self._chunks(self.queryset, columns):
+            participants = defaultdict(list)
+            for expense_id, user_id in (
+                Participant.objects.filter(expense_id__in=[row[0] for row in rows])
+                .order_by('expense_id', 'user_id')
+                .values_list('expense_id', 'user_id')
+            ):
+                participants[expense_id].append(user_id)
+            for expense_id, created_at, category, total_amount, currency, created_by, split_method, split_details in rows:
+                factor = self.converter.factor(currency, created_at)
+                shares = {int(user_id): Decimal(amount) for user_id, amount in split_details.items()}
+                self.paid[created_by] += total_amount * factor
+                for user_id, amount in shares.items():
+                    self.owed[user_id] += amount * factor
+                yield {
+                    'id': expense_id,
+                    'created_at': created_at,
+                    'category': category,
+                    'total_amount': total_amount,
+                    'currency': currency,
+                    'created_by': created_by,
+                    'split_method': split_method,
+                    'participants': participants[expense_id],
+                    'shares': shares,
+                    'factor': factor,
+                }
+
+    def payments(self):
+        """
+        Yield every payment in date order, adding it to the payer's paid and
+        the payee's owed totals.
+
+        :return: Iterator of dicts with ``id``, ``created_at``, ``payer``,
+                 ``payee``, ``amount``, ``currency`` and ``factor``
+        """
+        columns = ('id', 'created_at', 'payer_id', 'payee_id', 'amount', 'currency')
+        for rows in self._chunks(self.payment_queryset, columns):
+            for payment_id, created_at, payer, payee, amount, currency in rows:
+                factor = self.converter.factor(currency, created_at)
+                self.paid[payer] += amount * factor
+                self.owed[payee] += amount * factor
+                yield {
+                    'id': payment_id,
+                    'created_at': created_at,
+                    'payer': payer,
+                    'payee': payee,
+                    'amount': amount,
+                    'currency': currency,
+                    'factor': factor,
+                }
+
+    def balances(self):
+        """
+        Yield each user's totals in the reporting currency; only complete
+        once ``expenses`` and ``payments`` have been exhausted.
+
+        :return: Iterator of (user id, name, paid, owed)
+        """
+        for user_id, name in self.users:
+            yield user_id, name, self.paid[user_id], self.owed[user_id]
+
+
+class Exporter:
+    """
+    Base class for export formats.
+    """
+
+    format = None
+    media_type = None
+    extension = None
+
+    def check(self):
+        """
+        Fail before the response starts if the format cannot be produced.
+
+        :raises APIException: If a dependency of the format is missing
+        """
+
+    def stream(self, sheet):
+        """
+        :param sheet: BalanceSheet to export
+        :return: Iterator of bytes
+        """
+        raise NotImplementedError
+
+
+class _Buffer:
+    """
+    Text buffer that hands out its contents in chunks of ``FLUSH_SIZE``.
+    """
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+
+    def write(self, text):
+        self.buffer.write(text)
+
+    def take(self, force=False):
+        if not force and self.buffer.tell() < FLUSH_SIZE:
+            return None
+        data = self.buffer.getvalue().encode('utf-8')
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return data
+
+
+@register
+class CSVExporter(Exporter):
+    format = 'csv'
+    media_type = 'text/csv'
+    extension = 'csv'
+
+    def stream(self, sheet):
+        out = _Buffer()
+        writer = csv.writer(out)
+
+        # 1. Overall Expenses Summary
+        writer.writerows([
+            ['Overall Expenses Summary'],
+            ['Reporting Currency', sheet.currency],
+            ['Total Expenses', f'{sheet.total:.2f}'],
+            ['Number of Expenses', sheet.count],
+            []
+        ])
+
+        # 2. Individual Expense Details
+        writer.writerows([
+            ['Individual Expense Details'],
+            ['Date', 'Description', 'Total Amount', 'Currency', 'Paid By', 'Split Method', 'Participants'] + [f'{name} Share' for _, name in sheet.users]
+        ])
+        for expense in sheet.expenses():
+            shares = expense['shares']
+            writer.writerow([
+                expense['created_at'].strftime('%Y-%m-%d'),
+                expense['category'],
+                f"{expense['total_amount']:.2f}",
+                expense['currency'],
+                sheet.names.get(expense['created_by']),
+                expense['split_method'],
+                ';'.join(sheet.names.get(user_id) or '' for user_id in expense['participants']),
+            ] + [f'{shares.get(user_id, ZERO):.2f}' for user_id, _ in sheet.users])
+            chunk = out.take()
+            if chunk:
+                yield chunk
+        writer.writerow([])
+
+        # 3. Payments
+        writer.writerows([
+            ['Payments'],
+            ['Date', 'Paid By', 'Paid To', 'Amount', 'Currency']
+        ])
+        for payment in sheet.payments():
+            writer.writerow([
+                payment['created_at'].strftime('%Y-%m-%d'),
+                sheet.names.get(payment['payer']),
+                sheet.names.get(payment['payee']),
+                f"{payment['amount']:.2f}",
+                payment['currency'],
+            ])
+            chunk = out.take()
+            if chunk:
+                yield chunk
+        writer.writerow([])
+
+        # 4. User Balances
+        writer.writerows([
+            ['User Balances'],
+            ['User', f'Total Paid ({sheet.currency})', f'Total Owed ({sheet.currency})']
+        ])
+        for _, name, paid, owed in sheet.balances():
+            writer.writerow([name, f'{paid:.2f}', f'{owed:.2f}'])
+        yield out.take(force=True)
+
+
+@register
+class JSONLinesExporter(Exporter):
+    format = 'jsonl'
+    media_type = 'application/jsonl'
+    extension = 'jsonl'
+
+    def stream(self, sheet):
+        out = _Buffer()
+
+        def line(item):
+            out.write(json.dumps(item, separators=(',', ':')) + '\n')
+
+        line({'type': 'summary', 'currency': sheet.currency, 'total_expenses': f'{sheet.total:.2f}', 'expense_count': sheet.count})
+        for expense in sheet.expenses():
+            line({
+                'type': 'expense',
+                'id': expense['id'],
+                'created_at': expense['created_at'].isoformat(),
+                'category': expense['category'],
+                'total_amount': f"{expense['total_amount']:.2f}",
+                'currency': expense['currency'],
+                'created_by': expense['created_by'],
+                'split_method': expense['split_method'],
+                'participants': expense['participants'],
+                'shares': {str(user_id): str(amount) for user_id, amount in expense['shares'].items()},
+            })
+            chunk = out.take()
+            if chunk:
+                yield chunk
+        for payment in sheet.payments():
+            line({
+                'type': 'payment',
+                'id': payment['id'],
+                'created_at': payment['created_at'].isoformat(),
+                'payer': payment['payer'],
+                'payee': payment['payee'],
+                'amount': f"{payment['amount']:.2f}",
+                'currency': payment['currency'],
+            })
+            chunk = out.take()
+            if chunk:
+                yield chunk
+        for user_id, name, paid, owed in sheet.balances():
+            line({'type': 'balance', 'user': user_id, 'name': name, 'paid': f'{paid:.2f}', 'owed': f'{owed:.2f}'})
+        yield out.take(force=True)
+
+
+@register
+class NpzExporter(Exporter):
+    """
+    Arrays, with amounts converted into the reporting currency:
+
+    * ``user_ids``, ``user_paid``, ``user_owed``: one entry per user;
+    * ``expense_ids``, ``expense_dates`` (datetime64[s]), ``expense_totals``:
+      one entry per expense;
+    * ``share_user``, ``share_expense``, ``share_amount``: the non-zero
+      cells of the user x expense share matrix, as indices into the arrays
+      above, with ``shape`` its dimensions;
+    * ``payment_from``, ``payment_to``, ``payment_amount``: one entry per
+      payment, with payer and payee as indices into the user arrays.
+    """
+
+    format = 'npz'
+    media_type = 'application/x-npz'
+    extension = 'npz'
+
+    def check(self):
+        if numpy is None:
+            raise exceptions.NotAcceptable('The npz format requires numpy, which is not installed.')
+
+    def stream(self, sheet):
+        user_index = {user_id: index for index, (user_id, _) in enumerate(sheet.users)}
+        expense_ids, expense_dates, expense_totals = [], [], []
+        share_user, share_expense, share_amount = [], [], []
+        for column, expense in enumerate(sheet.expenses()):
+            factor = expense['factor']
+            expense_ids.append(expense['id'])
+            expense_dates.append(expense['created_at'].replace(tzinfo=None))
+            expense_totals.append(float(expense['total_amount'] * factor))
+            for user_id, amount in expense['shares'].items():
+                if user_id in user_index and amount:
+                    share_user.append(user_index[user_id])
+                    share_expense.append(column)
+                    share_amount.append(float(amount * factor))
+        payment_from, payment_to, payment_amount = [], [], []
+        for payment in sheet.payments():
+            if payment['payer'] in user_index and payment['payee'] in user_index:
+                payment_from.append(user_index[payment['payer']])
+                payment_to.append(user_index[payment['payee']])
+                payment_amount.append(float(payment['amount'] * payment['factor']))
+        balances = list(sheet.balances())
+        out = io.BytesIO()
+        numpy.savez_compressed(
+            out,
+            currency=numpy.array(sheet.currency),
+            shape=numpy.array([len(sheet.users), len(expense_ids)], dtype=numpy.int64),
+            user_ids=numpy.array([user_id for user_id, _, _, _ in balances], dtype=numpy.int64),
+            user_paid=numpy.array([float(paid) for _, _, paid, _ in balances], dtype=numpy.float64),
+            user_owed=numpy.array([float(owed) for _, _, _, owed in balances], dtype=numpy.float64),
+            expense_ids=numpy.array(expense_ids, dtype=numpy.int64),
+            expense_dates=numpy.array(expense_dates, dtype='datetime64[s]'),
+            expense_totals=numpy.array(expense_totals, dtype=numpy.float64),
+            share_user=numpy.array(share_user, dtype=numpy.int32),
+            share_expense=numpy.array(share_expense, dtype=numpy.int32),
+            share_amount=numpy.array(share_amount, dtype=numpy.float64),
+            payment_from=numpy.array(payment_from, dtype=numpy.int32),
+            payment_to=numpy.array(payment_to, dtype=numpy.int32),
+            payment_amount=numpy.array(payment_amount, dtype=numpy.float64),
+        )
+        view = out.getbuffer()
+        for start in range(0, len(view), FLUSH_SIZE):
+            yield bytes(view[start:start + FLUSH_SIZE])
+
+
+def compress(chunks, level=6):
+    """
+    Gzip a byte stream chunk by chunk.
+
+    :param chunks: Iterator of bytes
+    :param level: zlib compression level
+    :return: Iterator of gzip-compressed bytes
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
@@ -0,0 +1,137 @@
+import datetime
+
+from django.utils import timezone
+from rest_framework import serializers
+
+from .models import Expense
+from .search import search_expenses
+
+
+class ExpenseFilterSerializer(serializers.Serializer):
+    """
+    Serializer validating the query parameters accepted by expense lists.
+
+    All parameters are optional and combine with AND:
+    - ``date_from`` / ``date_to``: inclusive range of creation dates
+    - ``category``: exact category
+    - ``created_by``: id of the user who created the expense
+    - ``participant``: id of a user taking part in the expense
+    - ``min_amount`` / ``max_amount``: inclusive range of total amounts
+    - ``split_method``: one of the split methods
+    - ``q``: words to search for in category and description
+    """
+
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    category = serializers.CharField(required=False, max_length=100)
+    created_by = serializers.IntegerField(required=False)
+    participant = serializers.IntegerField(required=False)
+    min_amount = serializers.DecimalField(required=False, max_digits=12, decimal_places=2)
+    max_amount = serializers.DecimalField(required=False, max_digits=12, decimal_places=2)
+    split_method = serializers.ChoiceField(required=False, choices=Expense.SPLIT_CHOICES)
+    q = serializers.CharField(required=False, max_length=200)
+
+    def validate(self, data):
+        if 'date_from' in data and 'date_to' in data and data['date_from'] > data['date_to']:
+            raise serializers.ValidationError("date_from must not be after date_to")
+        if 'min_amount' in data and 'max_amount' in data and data['min_amount'] > data['max_amount']:
+            raise serializers.ValidationError("min_amount must not be greater than max_amount")
+        return data
+
+
+def _start_of_day(date):
+    return timezone.make_aware(datetime.datetime.combine(date, datetime.time.min))
+
+
+def include_archived(params):
+    """
+    Whether an expense list should also return archived expenses, as asked
+    with ``?include_archived=1``.
+
+    :param params: Query parameters, e.g. ``request.query_params``
+    :return: bool
+    :raises ValidationError: If the parameter is not a boolean
+    """
+    value = params.get('include_archived')
+    if value is None:
+        return False
+    try:
+        return serializers.BooleanField().to_internal_value(value)
+    except serializers.ValidationError as exc:
+        raise serializers.ValidationError({'include_archived': exc.detail})
+
+
+def _names(params, key):
+    value = params.get(key)
+    if value is None:
+        return None
+    return [name.strip() for name in value.split(',') if name.strip()]
+
+
+def sparse_fieldset(params, available, expandable=()):
+    """
+    The fields and expansions a list was asked for with ``?fields=a,b``
+    and ``?expand=participants``.
+
+    :param params: Query parameters, e.g. ``request.query_params``
+    :param available: Names of the fields of the list entries
+    :param expandable: Names of the fields that can be expanded
+    :return: (set of field names, or None for all; set of expanded field names)
+    :raises ValidationError: If a name is unknown or no field is left
+    """
+    fields = _names(params, 'fields')
+    if fields is not None:
+        unknown = sorted(set(fields) - set(available))
+        if unknown:
+            raise serializers.ValidationError({'fields': f"Unknown fields: {', '.join(unknown)}"})
+        if not fields:
+            raise serializers.ValidationError({'fields': 'At least one field is required.'})
+        fields = set(fields)
+    expand = set(_names(params, 'expand') or ())
+    unknown = sorted(expand - set(expandable))
+    if unknown:
+        raise serializers.ValidationError({'expand': f"Cannot expand: {', '.join(unknown)}"})
+    if fields is not None:
+        # Expanding a field asks for it
+        fields |= expand
+    return fields, expand
+
+
+def filter_expenses(queryset, params):
+    """
+    Apply the expense list query parameters to a queryset.
+
+    Each parameter maps onto a column covered by one of the Expense
+    indexes (or the participants (user, expense) index), so the database
+    can start from whichever filter is most selective.
+
+    :param queryset: Expense or ArchivedExpense queryset
+    :param params: Query parameters, e.g. ``request.query_params``
+    :return: Filtered queryset
+    :raises ValidationError: If a parameter is malformed
+    """
+    serializer = ExpenseFilterSerializer(data=params)
+    serializer.is_valid(raise_exception=True)
+    data = serializer.validated_data
+
+    if 'date_from' in data:
+        queryset = queryset.filter(created_at__gte=_start_of_day(data['date_from']))
+    if 'date_to' in data:
+        queryset = queryset.filter(created_at__lt=_start_of_day(data['date_to'] + datetime.timedelta(days=1)))
+    if 'category' in data:
+        queryset = queryset.filter(category=data['category'])
+    if 'created_by' in data:
+        queryset = queryset.filter(created_by_id=data['created_by'])
+    if 'participant' in data:
+        participants = queryset.model._meta.get_field('participants')
+        through = participants.remote_field.through.objects.filter(user_id=data['participant'])
+        queryset = queryset.filter(id__in=through.values(f'{participants.m2m_field_name()}_id'))
+    if 'min_amount' in data:
+        queryset = queryset.filter(total_amount__gte=data['min_amount'])
+    if 'max_amount' in data:
+        queryset = queryset.filter(total_amount__lte=data['max_amount'])
+    if 'split_method' in data:
+        queryset = queryset.filter(split_method=data['split_method'])
+    if data.get('q'):
+        queryset = search_expenses(queryset, data['q'])
+    return queryset
@@ -0,0 +1,217 @@
+"""
+Currency conversion backed by the FxRate table.
+
+Rates are cached in memory per day: the first conversion touching a set of
+days loads every rate needed for all of them in a single query, and later
+conversions for those days are dictionary lookups. Converting a whole
+report therefore costs at most one query however many rows and currencies
+it contains.
+"""
+import bisect
+import datetime
+import itertools
+import threading
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import exceptions, status
+
+from . import metrics
+from .models import FxRate
+
+
+ONE = Decimal('1')
+IMPORT_BATCH_SIZE = 1000
+
+
+class MissingRate(exceptions.APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = 'No exchange rate available.'
+    default_code = 'missing_fx_rate'
+
+    def __init__(self, currency, date):
+        super().__init__(f'No {currency} exchange rate on or before {date}.')
+        self.currency = currency
+        self.date = date
+
+
+class RateCache:
+    """
+    Per-process cache of effective rates, keyed by date.
+
+    Each cached day maps every known currency to the rate in effect that
+    day (the latest rate at most ``FX_RATE_MAX_AGE_DAYS`` earlier). The
+    cache is dropped after ``FX_RATE_CACHE_TTL`` seconds or by ``clear``.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._days = {}
+        self._loaded_at = time.monotonic()
+
+    def clear(self):
+        with self._lock:
+            self._days = {}
+            self._loaded_at = time.monotonic()
+
+    def rates_for(self, dates):
+        """
+        Return the effective rates for every given day.
+
+        :param dates: Iterable of datetime.date
+        :return: dict mapping each date to ``{currency: rate}``
+        """
+        dates = set(dates)
+        with self._lock:
+            if time.monotonic() - self._loaded_at > settings.FX_RATE_CACHE_TTL:
+                self._days = {}
+                self._loaded_at = time.monotonic()
+            days = self._days
+            missing = dates.difference(days)
+        metrics.CACHE_REQUESTS.inc('fx_rates', 'hit', amount=len(dates) - len(missing))
+        if missing:
+            metrics.CACHE_REQUESTS.inc('fx_rates', 'miss', amount=len(missing))
+            loaded = self._load(missing)
+            with self._lock:
+                self._days.update(loaded)
+            days = {**days, **loaded}
+        return {date: days[date] for date in dates}
+
+    @staticmethod
+    def _load(dates):
+        """
+        Load the effective rates for several days with one query.
+
+        :param dates: Set of datetime.date
+        :return: dict mapping each date to ``{currency: rate}``
+        """
+        max_age = datetime.timedelta(days=settings.FX_RATE_MAX_AGE_DAYS)
+        rows = FxRate.objects.filter(date__gte=min(dates) - max_age, date__lte=max(dates)).order_by('currency', 'date')
+        series = {}
+        for currency, date, rate in rows.values_list('currency', 'date', 'rate').iterator():
+            dates_list, rates = series.setdefault(currency, ([], []))
+            dates_list.append(date)
+            rates.append(rate)
+        effective = {}
+        for date in dates:
+            day = effective[date] = {}
+            for currency, (dates_list, rates) in series.items():
+                index = bisect.bisect_right(dates_list, date) - 1
+                if index >= 0 and date - dates_list[index] <= max_age:
+                    day[currency] = rates[index]
+        return effective
+
+
+rate_cache = RateCache()
+
+
+def _day(value):
+    if isinstance(value, datetime.datetime):
+        return timezone.localdate(value) if timezone.is_aware(value) else value.date()
+    return value
+
+
+class Converter:
+    """
+    Converts amounts dated on a known set of days into one currency.
+
+    :param target: Currency to convert into
+    :param dates: Every date (or datetime) that will be converted
+    """
+
+    def __init__(self, target, dates=()):
+        self.target = target
+        self.base = settings.FX_BASE_CURRENCY
+        self._rates = rate_cache.rates_for({_day(value) for value in dates})
+        self._factors = {}
+
+    def _rate(self, currency, date):
+        if currency == self.base:
+            return ONE
+        try:
+            return self._rates[date][currency]
+        except KeyError:
+            if date not in self._rates:
+                self._rates.update(rate_cache.rates_for([date]))
+                return self._rate(currency, date)
+            raise MissingRate(currency, date)
+
+    def factor(self, currency, when):
+        """
+        Multiplier converting ``currency`` into the target currency.
+
+        :param currency: Source currency
+        :param when: Date or datetime of the amount
+        :return: Decimal factor
+        """
+        if currency == self.target:
+            return ONE
+        date = _day(when)
+        key = (currency, date)
+        factor = self._factors.get(key)
+        if factor is None:
+            factor = self._factors[key] = self._rate(currency, date) / self._rate(self.target, date)
+        return factor
+
+    def convert(self, amount, currency, when):
+        return Decimal(amount) * self.factor(currency, when)
+
+
+def reporting_currency(request):
+    """
+    Currency requested with ``?currency=``, or the reporting default.
+
+    :param request: DRF request
+    :return: Upper-case currency code
+    :raises ValidationError: If the code is not three letters
+    """
+    currency = request.query_params.get('currency', settings.REPORTING_CURRENCY).upper()
+    if len(currency) != 3 or not currency.isalpha():
+        raise exceptions.ValidationError({'currency': 'Must be a three-letter ISO 4217 code.'})
+    return currency
+
+
+def parse_rate_row(row):
+    """
+    Parse one ``date,currency,rate`` CSV row.
+
+    :param row: dict from csv.DictReader
+    :return: Unsaved FxRate
+    :raises ValueError: If a field is missing or malformed
+    """
+    try:
+        date = datetime.date.fromisoformat(row['date'].strip())
+        currency = row['currency'].strip().upper()
+        rate = Decimal(row['rate'].strip())
+    except (KeyError, AttributeError, InvalidOperation) as exc:
+        raise ValueError(f'Invalid rate row {row!r}') from exc
+    if len(currency) != 3 or not currency.isalpha() or rate <= 0:
+        raise ValueError(f'Invalid rate row {row!r}')
+    return FxRate(date=date, currency=currency, rate=rate)
+
+
+def import_rates(rows, batch_size=IMPORT_BATCH_SIZE):
+    """
+    Insert or replace rates, one bulk upsert per batch.
+
+    :param rows: Iterable of dicts with ``date``, ``currency`` and ``rate``
+    :param batch_size: Rates written per statement
+    :return: Number of rates written
+    """
+    written = 0
+    rates = (parse_rate_row(row) for row in rows)
+    while True:
+        batch = list(itertools.islice(rates, batch_size))
+        if not batch:
+            break
+        FxRate.objects.bulk_create(
+            batch,
+            update_conflicts=True,
+            unique_fields=['currency', 'date'],
+            update_fields=['rate'],
+        )
+        written += len(batch)
+    rate_cache.clear()
+    return written
@@ -0,0 +1,225 @@
+"""
+Writing events to the append-only ledger.
+
+The ``record_*`` functions must be called inside the transaction that
+makes the change they describe, so an event exists exactly when the change
+was committed. The same transaction writes a UserChange row for every
+affected user, which ``/api/sync/`` reads. Once that transaction commits,
+every affected user connected to the live stream receives their balance
+delta.
+
+Readers of the ledger (projections, sync tokens, backups) remember the
+highest event id they have seen, which is only safe if events become
+visible in id order. Ids are handed out at insert time, so on PostgreSQL
+or MySQL a transaction could commit a lower id after a reader has moved
+past it. Every append therefore first locks one row and holds the lock
+until commit, so each writer waits for the previous one to commit before
+it takes an id. SQLite allows a single writer anyway and has no row locks.
+
+Projections are not caught up here: requests would pay for however many
+events are pending. ``replay_projections --follow`` (or a cron run of
+``replay_projections``) applies new events outside the request cycle.
+"""
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .models import LedgerEvent, ProjectionCheckpoint, UserChange
+from .pubsub import hub
+
+
+# ProjectionCheckpoint row every ledger writer locks until it commits
+APPEND_LOCK = 'ledger-append'
+
+
+def expense_state(expense):
+    """
+    Capture the parts of an expense that projections need.
+
+    :param expense: Expense instance
+    :return: JSON-serializable dict
+    """
+    return {
+        'created_by': expense.created_by_id,
+        'total_amount': str(expense.total_amount),
+        'currency': expense.currency,
+        'category': expense.category,
+        'shares': {str(user_id): str(amount) for user_id, amount in expense.split_details.items()},
+    }
+
+
+def payment_state(payment):
+    """
+    Capture a payment for its ledger event.
+
+    :param payment: Payment instance
+    :return: JSON-serializable dict
+    """
+    return {
+        'id': payment.id,
+        'payer': payment.payer_id,
+        'payee': payment.payee_id,
+        'amount': str(payment.amount),
+        'currency': payment.currency,
+    }
+
+
+def state_currency(state):
+    """
+    Currency of an expense state; events recorded before expenses had a
+    currency are in the default currency.
+
+    :param state: Expense state from an event payload
+    :return: ISO 4217 currency code
+    """
+    return state.get('currency') or settings.DEFAULT_CURRENCY
+
+
+def balance_deltas(payload):
+    """
+    Compute how an event changes each user's net balance.
+
+    A user's net balance is what they paid minus their shares, so an
+    expense adds its total to the creator and subtracts each share from
+    its participant; ``before`` states count negatively. A payment adds
+    its amount to the payer and subtracts it from the payee.
+
+    :param payload: Event payload
+    :return: dict mapping (user id, currency) to non-zero Decimal deltas
+    """
+    deltas = {}
+    for key, sign in (('before', -1), ('after', 1)):
+        state = payload.get(key)
+        if state is None:
+            continue
+        currency = state_currency(state)
+        creator = (int(state['created_by']), currency)
+        deltas[creator] = deltas.get(creator, Decimal('0')) + sign * Decimal(state['total_amount'])
+        for user_id, amount in state['shares'].items():
+            participant = (int(user_id), currency)
+            deltas[participant] = deltas.get(participant, Decimal('0')) - sign * Decimal(amount)
+    payment = payload.get('payment')
+    if payment is not None:
+        amount = Decimal(payment['amount'])
+        for user_id, delta in ((payment['payer'], amount), (payment['payee'], -amount)):
+            key = (int(user_id), payment['currency'])
+            deltas[key] = deltas.get(key, Decimal('0')) + delta
+    return {key: delta for key, delta in deltas.items() if delta}
+
+
+def affected_users(payload):
+    """
+    Users whose expenses or balances an event changes.
+
+    :param payload: Event payload
+    :return: set of user ids
+    """
+    users = set()
+    for key in ('before', 'after'):
+        state = payload.get(key)
+        if state is not None:
+            users.add(int(state['created_by']))
+            users.update(int(user_id) for user_id in state['shares'])
+    payment = payload.get('payment')
+    if payment is not None:
+        users.update((int(payment['payer']), int(payment['payee'])))
+    return users
+
+
+def _record_changes(events):
+    """
+    Write the UserChange rows of newly created events.
+
+    :param events: Saved LedgerEvent instances
+    """
+    changes = []
+    for event in events:
+        deltas = balance_deltas(event.payload)
+        for user_id in sorted(affected_users(event.payload)):
+            balance = {
+                currency: str(delta.quantize(Decimal('0.000001')))
+                for (delta_user, currency), delta in deltas.items() if delta_user == user_id
+            }
+            changes.append(UserChange(user_id=user_id, seq=event.id, expense_id=event.expense_id, balance=balance))
+    UserChange.objects.bulk_create(changes)
+
+
+def _lock_appends():
+    """
+    Wait for earlier ledger writers to commit, and make later ones wait
+    for this transaction.
+    """
+    if connection.features.has_select_for_update:
+        ProjectionCheckpoint.objects.select_for_update().get_or_create(name=APPEND_LOCK)
+
+
+def _publish(*events):
+    """
+    Send each affected user the balance deltas of committed events.
+
+    :param events: Committed LedgerEvent instances
+    """
+    for event in events:
+        for (user_id, currency), delta in balance_deltas(event.payload).items():
+            hub.publish(user_id, {
+                'event': 'balance',
+                'seq': event.id,
+                'kind': event.kind,
+                'expense_id': event.expense_id,
+                'currency': currency,
+                'delta': str(delta.quantize(Decimal('0.000001'))),
+            })
+
+
+def record(kind, payload, expense_id=None):
+    """
+    Append one event to the ledger.
+
+    :param kind: One of the LedgerEvent kinds
+    :param payload: JSON-serializable event payload
+    :param expense_id: Id of the expense the event is about, if any
+    :return: The created LedgerEvent
+    """
+    _lock_appends()
+    event = LedgerEvent.objects.create(kind=kind, payload=payload, expense_id=expense_id)
+    _record_changes([event])
+    transaction.on_commit(lambda: _publish(event))
+    return event
+
+
+def record_many(events):
+    """
+    Append several events at once.
+
+    :param events: Unsaved LedgerEvent instances
+    :return: The created LedgerEvent instances
+    """
+    _lock_appends()
+    events = LedgerEvent.objects.bulk_create(events)
+    _record_changes(events)
+    transaction.on_commit(lambda: _publish(*events))
+    return events
+
+
+def record_expense_created(expense):
+    return record(LedgerEvent.EXPENSE_CREATED, {'after': expense_state(expense)}, expense.id)
+
+
+def record_expense_edited(before, expense):
+    """
+    Record an edit given the state captured before it.
+
+    :param before: ``expense_state`` of the expense before the edit
+    :param expense: The edited Expense instance
+    :return: The created LedgerEvent
+    """
+    return record(LedgerEvent.EXPENSE_EDITED, {'before': before, 'after': expense_state(expense)}, expense.id)
+
+
+def record_expense_deleted(before, expense_id):
+    return record(LedgerEvent.EXPENSE_DELETED, {'before': before}, expense_id)
+
+
+def record_payment_recorded(payment):
+    return record(LedgerEvent.PAYMENT_RECORDED, {'payment': payment_state(payment)})
@@ -0,0 +1,35 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from expenses_app import archive
+from expenses_app.filters import _start_of_day
+
+
+class Command(BaseCommand):
+    """
+    Move expenses created before a date into the archive tables.
+
+    Their balances are carried forward as opening balances, so every
+    balance stays the same; the archived expenses remain listed with
+    ``?include_archived=1``. Safe to interrupt and re-run.
+    """
+
+    help = 'Archive expenses created before a date, carrying their balances forward'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--before', required=True, help='Archive expenses created before this day (YYYY-MM-DD)')
+        parser.add_argument('--batch-size', type=int, default=archive.DEFAULT_BATCH_SIZE, help='Expenses moved per transaction')
+
+    def handle(self, *args, **options):
+        try:
+            before = datetime.date.fromisoformat(options['before'])
+        except ValueError:
+            raise CommandError(f"Invalid date: {options['before']}")
+        if before > timezone.localdate():
+            raise CommandError('The cutoff must not be in the future')
+        start = time.monotonic()
+        archived = archive.archive(_start_of_day(before), options['batch_size'])
+        self.stdout.write(f'Archived {archived} expenses in {time.monotonic() - start:.1f}s')
@@ -0,0 +1,58 @@
+import json
+import os
+import time
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app import audit
+
+
+class Command(BaseCommand):
+    """
+    Check every expense for split and balance inconsistencies.
+
+    Only reads, in short id-ordered queries, so it can run against the live
+    database. Issues are written to the report as JSON Lines; an interrupted
+    run continues from its checkpoint with ``--resume``.
+    """
+
+    help = 'Audit expenses for split and balance inconsistencies'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--report', default='audit-report.jsonl', help='Report file (JSON Lines)')
+        parser.add_argument('--checkpoint', help='Checkpoint file, defaults to the report path with .checkpoint appended')
+        parser.add_argument('--resume', action='store_true', help='Continue from the checkpoint')
+        parser.add_argument('--chunk-size', type=int, default=audit.DEFAULT_CHUNK_SIZE, help='Expenses per chunk')
+        parser.add_argument('--workers', type=int, help='Worker processes, defaults to the number of CPUs')
+        parser.add_argument('--tolerance', default=str(audit.DEFAULT_TOLERANCE), help='Largest difference treated as rounding')
+        parser.add_argument('--skip-balances', action='store_true', help='Do not compare the totals with the balance projection')
+
+    def handle(self, *args, **options):
+        checkpoint = options['checkpoint'] or f"{options['report']}.checkpoint"
+        if options['resume'] and not os.path.exists(checkpoint):
+            raise CommandError(f'No checkpoint at {checkpoint}')
+        try:
+            tolerance = Decimal(options['tolerance'])
+        except InvalidOperation:
+            raise CommandError(f"Invalid tolerance: {options['tolerance']}")
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        start = time.monotonic()
+
+        def progress(state):
+            self.stderr.write(f'Checked {state.checked} expenses up to id {state.last_id}')
+
+        summary = audit.audit(
+            options['report'],
+            checkpoint,
+            resume=options['resume'],
+            chunk_size=options['chunk_size'],
+            workers=options['workers'],
+            tolerance=tolerance,
+            balances=not options['skip_balances'],
+            progress=progress if options['verbosity'] > 1 else None,
+        )
+        self.stdout.write(json.dumps(summary))
+        self.stderr.write(f"Audited {summary['checked']} expenses in {time.monotonic() - start:.1f}s")
@@ -0,0 +1,86 @@
+import json
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from expenses_app.models import Expense, User
+from expenses_app.readers import ValuesReader
+from expenses_app.renderers import FastJSONRenderer
+from expenses_app.serializers import ExpenseSerializer
+
+
+class _Rollback(Exception):
+    pass
+
+
+class Command(BaseCommand):
+    """
+    Compare list serialization through ExpenseSerializer and JSONRenderer
+    with the ValuesReader and FastJSONRenderer read path.
+
+    Sample expenses are created inside a transaction that is rolled back,
+    so the database is left unchanged.
+    """
+
+    help = 'Benchmark the expense list read path against ExpenseSerializer'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=10000, help='Expenses in the response')
+        parser.add_argument('--participants', type=int, default=4, help='Participants per expense')
+        parser.add_argument('--repeat', type=int, default=3, help='Runs per path; the best is reported')
+
+    def handle(self, *args, **options):
+        if options['rows'] < 1 or options['participants'] < 1:
+            raise CommandError('--rows and --participants must be positive')
+        try:
+            with transaction.atomic():
+                self._run(options)
+                raise _Rollback
+        except _Rollback:
+            pass
+
+    def _populate(self, rows, participants):
+        users = User.objects.bulk_create(
+            User(email=f'benchmark-{index}@example.com', name=f'Benchmark {index}')
+            for index in range(participants)
+        )
+        share = str(Decimal('100.00') / participants)
+        split_details = {str(user.id): share for user in users}
+        expenses = Expense.objects.bulk_create(
+            Expense(total_amount=Decimal('100.00'), split_method='equal', created_by=users[0],
+                    split_details=split_details, category='Benchmark')
+            for _ in range(rows)
+        )
+        Participant = Expense.participants.through
+        Participant.objects.bulk_create(
+            Participant(expense_id=expense.id, user_id=user.id) for expense in expenses for user in users
+        )
+        return Expense.objects.filter(category='Benchmark', created_by=users[0])
+
+    def _time(self, repeat, render):
+        best, body = None, None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            body = render()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, body
+
+    def _run(self, options):
+        queryset = self._populate(options['rows'], options['participants'])
+        reader = ValuesReader(ExpenseSerializer)
+
+        slow, slow_body = self._time(options['repeat'], lambda: JSONRenderer().render(
+            ExpenseSerializer(queryset.prefetch_related('participants'), many=True).data
+        ))
+        fast, fast_body = self._time(options['repeat'], lambda: FastJSONRenderer().render(reader.read(queryset)))
+        if json.loads(slow_body) != json.loads(fast_body):
+            raise CommandError('The fast read path produced a different response')
+
+        rows = options['rows']
+        self.stdout.write(f'ExpenseSerializer + JSONRenderer: {slow:.3f}s ({rows / slow:,.0f} rows/s)')
+        self.stdout.write(f'ValuesReader + FastJSONRenderer:  {fast:.3f}s ({rows / fast:,.0f} rows/s)')
+        self.stdout.write(f'Speedup: {slow / fast:.1f}x')
@@ -0,0 +1,44 @@
+import datetime
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app import duplicates
+from expenses_app.filters import _start_of_day
+
+
+class Command(BaseCommand):
+    """
+    List groups of expenses that look like double submissions.
+
+    Expenses without a fingerprint (created before fingerprints existed, or
+    materialized from recurring templates) get one first, then expenses are
+    grouped by fingerprint in the database. Each group is written as one
+    JSON object per line; nothing is deleted.
+    """
+
+    help = 'Find clusters of duplicate expenses by fingerprint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--since', help='Only consider expenses created on or after this day (YYYY-MM-DD)')
+        parser.add_argument('--skip-backfill', action='store_true', help='Do not compute missing fingerprints first')
+        parser.add_argument('--chunk-size', type=int, default=duplicates.DEFAULT_CHUNK_SIZE, help='Expenses fingerprinted per query')
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = _start_of_day(datetime.date.fromisoformat(options['since']))
+            except ValueError:
+                raise CommandError(f"Invalid date: {options['since']}")
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive')
+
+        if not options['skip_backfill']:
+            filled = duplicates.backfill(options['chunk_size'])
+            self.stderr.write(f'Fingerprinted {filled} expenses')
+        found = 0
+        for fingerprint, ids in duplicates.clusters(since):
+            self.stdout.write(json.dumps({'fingerprint': fingerprint, 'expenses': ids}))
+            found += 1
+        self.stderr.write(f'Found {found} clusters of duplicates')
@@ -0,0 +1,38 @@
+import csv
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from expenses_app import fx
+
+
+class Command(BaseCommand):
+    """
+    Load exchange rates from a CSV file with ``date,currency,rate`` columns.
+
+    Rates are the value of one unit of the currency in ``FX_BASE_CURRENCY``.
+    Existing rates for the same currency and day are replaced.
+    """
+
+    help = 'Import exchange rates from a date,currency,rate CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file to read, or '-' for stdin")
+        parser.add_argument('--batch-size', type=int, default=fx.IMPORT_BATCH_SIZE, help='Rates written per statement')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='')
+        except OSError as exc:
+            raise CommandError(str(exc))
+        try:
+            with transaction.atomic():
+                written = fx.import_rates(csv.DictReader(stream), options['batch_size'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+        self.stdout.write(f'Imported {written} rates')
@@ -0,0 +1,32 @@
+import datetime
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app import recurring
+
+
+class Command(BaseCommand):
+    """
+    Create the expenses of every recurring template that is due.
+
+    Meant to run from cron (e.g. daily). Re-running is harmless, and a run
+    after a long pause catches up every missed occurrence.
+    """
+
+    help = 'Materialize due occurrences of recurring expense templates'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date', help='Materialize occurrences due on or before this day (YYYY-MM-DD), defaults to today')
+        parser.add_argument('--batch-size', type=int, default=recurring.DEFAULT_BATCH_SIZE, help='Templates per transaction')
+
+    def handle(self, *args, **options):
+        today = None
+        if options['date']:
+            try:
+                today = datetime.date.fromisoformat(options['date'])
+            except ValueError:
+                raise CommandError(f"Invalid date: {options['date']}")
+        start = time.monotonic()
+        created = recurring.materialize(today, options['batch_size'])
+        self.stdout.write(f'Created {created} expenses in {time.monotonic() - start:.1f}s')
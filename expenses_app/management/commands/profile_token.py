@@ -0,0 +1,19 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from expenses_app.profiling import make_profile_token
+
+
+class Command(BaseCommand):
+    """
+    Print a signed value for the ``X-Profile-Token`` request header.
+
+    Sending the header with any request makes ProfilerMiddleware profile it.
+    The value expires after ``PROFILER_TOKEN_MAX_AGE`` seconds.
+    """
+
+    help = 'Print a signed X-Profile-Token header value for on-demand request profiling'
+
+    def handle(self, *args, **options):
+        self.stdout.write(make_profile_token())
+        self.stderr.write(f'Valid for {settings.PROFILER_TOKEN_MAX_AGE} seconds; dumps are written to {settings.PROFILER_DIR}')
@@ -0,0 +1,52 @@
+import csv
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app import provisioning
+from expenses_app.serializers import BulkUserSerializer
+
+
+class Command(BaseCommand):
+    """
+    Register users from a CSV file with ``email,name,mobile,password`` columns.
+
+    Entries are validated like the bulk registration endpoint and created
+    all at once; the ``email,token`` of each new user is written to stdout.
+    """
+
+    help = 'Create users and auth tokens in bulk from an email,name,mobile,password CSV file'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV file to read, or '-' for stdin")
+        parser.add_argument('--batch-size', type=int, default=provisioning.DEFAULT_BATCH_SIZE, help='Users written per statement')
+        parser.add_argument('--workers', type=int, help='Hashing processes, defaults to the number of CPUs')
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            stream = sys.stdin if path == '-' else open(path, newline='')
+        except OSError as exc:
+            raise CommandError(str(exc))
+        try:
+            rows = list(csv.DictReader(stream))
+        finally:
+            if stream is not sys.stdin:
+                stream.close()
+
+        serializer = BulkUserSerializer(data=rows, many=True)
+        if not serializer.is_valid():
+            raise CommandError(serializer.errors)
+
+        start = time.monotonic()
+        pool = provisioning.create_pool(options['workers'])
+        try:
+            created = provisioning.provision_users(serializer.validated_data, options['batch_size'], pool)
+        finally:
+            pool.shutdown()
+        writer = csv.writer(self.stdout, lineterminator='\n')
+        writer.writerow(['email', 'token'])
+        for user, key in created:
+            writer.writerow([user.email, key])
+        self.stderr.write(f'Created {len(created)} users in {time.monotonic() - start:.1f}s')
@@ -0,0 +1,66 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app import projections
+
+
+class Command(BaseCommand):
+    """
+    Bring ledger projections up to date, rebuild them, snapshot them or
+    compact the ledger.
+
+    Without options every projection catches up from its stored offset.
+    Writes do not catch projections up themselves, so run this from cron
+    or keep it running with ``--follow SECONDS``, which catches up again
+    every that many seconds until interrupted.
+    """
+
+    help = 'Catch up, rebuild, snapshot or compact the ledger projections'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--projection', action='append', choices=sorted(projections.PROJECTIONS), help='Limit to this projection (repeatable)')
+        parser.add_argument('--rebuild', action='store_true', help='Rebuild from the latest snapshot (or from scratch) before catching up')
+        parser.add_argument('--snapshot', action='store_true', help='Store a snapshot after catching up')
+        parser.add_argument('--compact', action='store_true', help='Delete events covered by every projection snapshot and the latest backup')
+        parser.add_argument('--chunk-size', type=int, default=projections.DEFAULT_CHUNK_SIZE, help='Events applied per transaction')
+        parser.add_argument('--follow', type=float, metavar='SECONDS', help='Keep catching up, pausing this long between runs')
+
+    def handle(self, *args, **options):
+        names = options['projection'] or list(projections.PROJECTIONS)
+        chunk_size = options['chunk_size']
+        if options['follow'] is not None:
+            if options['follow'] <= 0:
+                raise CommandError('--follow must be positive')
+            if options['rebuild'] or options['snapshot'] or options['compact']:
+                raise CommandError('--follow only catches up')
+            self.follow(names, chunk_size, options['follow'])
+            return
+        for name in names:
+            start = time.monotonic()
+            if options['rebuild']:
+                applied = projections.rebuild(name, chunk_size)
+            else:
+                applied = projections.catch_up(name, chunk_size)
+            elapsed = time.monotonic() - start
+            self.stdout.write(f'{name}: applied {applied} events in {elapsed:.1f}s')
+            if options['snapshot']:
+                offset = projections.take_snapshot(name, chunk_size)
+                self.stdout.write(f'{name}: snapshot at event {offset}')
+        if options['compact']:
+            try:
+                deleted = projections.compact(chunk_size)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+            self.stdout.write(f'Compacted {deleted} events')
+
+    def follow(self, names, chunk_size, interval):
+        try:
+            while True:
+                for name in names:
+                    applied = projections.catch_up(name, chunk_size)
+                    if applied:
+                        self.stdout.write(f'{name}: applied {applied} events')
+                time.sleep(interval)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from expenses_app import backup
+
+
+class Command(BaseCommand):
+    """
+    Restore a backup written by the ``backup`` command.
+
+    Rows are bulk inserted in chunked transactions. Rows whose primary key
+    already exists are skipped (expenses are updated), and deletes recorded
+    in incremental backups are applied, so incremental backups are
+    restored by running this once per file, oldest first.
+    """
+
+    help = 'Restore a streaming backup written by the backup command'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Backup files, full backup first, then incrementals in order')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows inserted per transaction')
+
+    def handle(self, *args, **options):
+        for path in options['paths']:
+            start = time.monotonic()
+            try:
+                counts = backup.load(path, chunk_size=options['chunk_size'])
+            except (OSError, ValueError) as exc:
+                raise CommandError(str(exc))
+            for table, count in counts.items():
+                self.stdout.write(f'{table}: {count} rows')
+            self.stdout.write(self.style.SUCCESS(f'Restored {path} in {time.monotonic() - start:.1f}s'))
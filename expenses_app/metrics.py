@@ -0,0 +1,292 @@
+"""
+In-process metrics registry exported in the Prometheus text format.
+
+Every metric keeps one shard per thread. A thread only ever writes to its
+own shard, so recording a value never takes a lock; the registry lock is
+held only the first time a thread touches a metric (to register its shard)
+and while a scrape copies the shards. Values are per process, so a
+multi-process deployment is scraped once per worker.
+"""
+import bisect
+import threading
+
+
+DEFAULT_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    """
+    Escape a label value for the exposition format.
+
+    :param value: Label value
+    :return: Escaped string
+    """
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    """
+    Render a ``{name="value",...}`` label block.
+
+    :param names: Label names
+    :param values: Label values, in the same order as ``names``
+    :param extra: Additional (name, value) pairs appended at the end
+    :return: Label block, or an empty string when there are no labels
+    """
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    """
+    Render a sample value, dropping the fraction for whole numbers.
+
+    :param value: int or float
+    :return: String representation
+    """
+    if isinstance(value, float) and not value.is_integer():
+        return repr(value)
+    return str(int(value))
+
+
+class _Metric:
+    """
+    Base class holding the per-thread shards of a metric.
+    """
+
+    type_name = None
+
+    def __init__(self, registry, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._registry = registry
+        self._local = threading.local()
+        self._shards = []
+
+    def _shard(self):
+        """
+        Return the calling thread's shard, registering it on first use.
+
+        :return: dict mapping label tuples to sample state
+        """
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            shard = {}
+            with self._registry.lock:
+                self._shards.append(shard)
+            self._local.shard = shard
+        return shard
+
+    def _check_labels(self, values):
+        if len(values) != len(self.labelnames):
+            raise ValueError(f'{self.name} expects labels {self.labelnames}, got {values}')
+
+    def _snapshot(self):
+        """
+        Copy every shard; must be called with the registry lock held.
+
+        :return: List of shard copies
+        """
+        return [shard.copy() for shard in self._shards]
+
+    def collect(self, shards):
+        """
+        Render the metric as exposition-format lines.
+
+        :param shards: Shard copies taken by ``_snapshot``
+        :return: List of strings
+        """
+        raise NotImplementedError
+
+    def header(self):
+        return [
+            f'# HELP {self.name} {self.documentation}',
+            f'# TYPE {self.name} {self.type_name}',
+        ]
+
+
+class Counter(_Metric):
+    """
+    Monotonically increasing counter.
+    """
+
+    type_name = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        """
+        Increment the counter for the given label values.
+
+        :param labelvalues: One value per label name
+        :param amount: Amount to add (must not be negative)
+        """
+        self._check_labels(labelvalues)
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues):
+        """
+        Return the current total for the given label values.
+
+        :param labelvalues: One value per label name
+        :return: Summed value across all threads
+        """
+        with self._registry.lock:
+            shards = self._snapshot()
+        return sum(shard.get(labelvalues, 0) for shard in shards)
+
+    def collect(self, shards):
+        totals = {}
+        for shard in shards:
+            for labels, value in shard.items():
+                totals[labels] = totals.get(labels, 0) + value
+        lines = self.header()
+        for labels in sorted(totals):
+            lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {_format_value(totals[labels])}')
+        return lines
+
+
+class Histogram(_Metric):
+    """
+    Histogram with fixed upper bounds.
+
+    Each label set stores ``[bucket counts..., +Inf count, sum]`` where
+    bucket counts are non-cumulative; they are accumulated on scrape.
+    """
+
+    type_name = 'histogram'
+
+    def __init__(self, registry, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        super().__init__(registry, name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        """
+        Record one observation.
+
+        :param value: Observed value
+        :param labelvalues: One value per label name
+        """
+        self._check_labels(labelvalues)
+        shard = self._shard()
+        state = shard.get(labelvalues)
+        if state is None:
+            state = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[labelvalues] = state
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    def count(self, *labelvalues):
+        """
+        Return the number of observations for the given label values.
+
+        :param labelvalues: One value per label name
+        :return: Observation count across all threads
+        """
+        with self._registry.lock:
+            shards = self._snapshot()
+        return sum(sum(shard[labelvalues][:-1]) for shard in shards if labelvalues in shard)
+
+    def collect(self, shards):
+        totals = {}
+        width = len(self.buckets) + 2
+        for shard in shards:
+            for labels, state in shard.items():
+                merged = totals.setdefault(labels, [0] * width)
+                for i, value in enumerate(list(state)):
+                    merged[i] += value
+        lines = self.header()
+        for labels in sorted(totals):
+            state = totals[labels]
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), state[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else _format_value(float(bound))
+                label_block = _format_labels(self.labelnames, labels, extra=[('le', le)])
+                lines.append(f'{self.name}_bucket{label_block} {cumulative}')
+            label_block = _format_labels(self.labelnames, labels)
+            lines.append(f'{self.name}_sum{label_block} {_format_value(state[-1])}')
+            lines.append(f'{self.name}_count{label_block} {cumulative}')
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Collection of metrics rendered together on scrape.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+
+    def _register(self, metric):
+        with self.lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'Metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(self, name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_LATENCY_BUCKETS):
+        return self._register(Histogram(self, name, documentation, labelnames, buckets))
+
+    def render(self):
+        """
+        Render every registered metric in the Prometheus text format.
+
+        :return: Exposition text ending with a newline
+        """
+        with self.lock:
+            snapshots = [(metric, metric._snapshot()) for metric in self._metrics.values()]
+        lines = []
+        for metric, shards in snapshots:
+            lines.extend(metric.collect(shards))
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+REQUESTS = registry.counter(
+    'http_requests_total',
+    'HTTP requests handled, by URL name, method and status code.',
+    ('view', 'method', 'status'),
+)
+REQUEST_LATENCY = registry.histogram(
+    'http_request_duration_seconds',
+    'Time spent producing the response, by URL name.',
+    ('view',),
+)
+DB_QUERIES = registry.counter(
+    'db_queries_total',
+    'Database queries executed while handling requests, by URL name.',
+    ('view',),
+)
+DB_QUERIES_PER_REQUEST = registry.histogram(
+    'db_queries_per_request',
+    'Database queries executed per request, by URL name.',
+    ('view',),
+    buckets=(1, 2, 5, 10, 20, 50, 100, 250, 1000),
+)
+EXPENSE_SPLIT_SIZE = registry.histogram(
+    'expense_split_participants',
+    'Number of participants in each created expense.',
+    buckets=(1, 2, 3, 4, 5, 8, 12, 20, 50, 100),
+)
+CACHE_REQUESTS = registry.counter(
+    'cache_requests_total',
+    'Lookups against in-process caches, by cache name and result (hit/miss).',
+    ('cache', 'result'),
+)
+
+
+def record_cache_lookup(cache, hit):
+    """
+    Count one lookup against a named cache.
+
+    :param cache: Cache name used as the ``cache`` label
+    :param hit: True for a hit, False for a miss
+    """
+    CACHE_REQUESTS.inc(cache, 'hit' if hit else 'miss')
@@ -0,0 +1,146 @@
+import cProfile
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from rest_framework import exceptions
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import metrics, profiling
+
+
+logger = logging.getLogger(__name__)
+
+
+class _QueryCounter:
+    """
+    Database execute wrapper that counts the queries it sees.
+    """
+
+    def __init__(self):
+        self.count = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+class MetricsMiddleware:
+    """
+    Middleware recording request counts, latency and query counts.
+
+    Requests are labelled with the URL name of the matched route
+    (``expense-create``, ``balance-sheet``, ...) so the label set stays
+    bounded no matter which ids appear in the path. Requests that do not
+    resolve to a route are labelled ``unmatched``.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        queries = _QueryCounter()
+        start = time.perf_counter()
+        with connection.execute_wrapper(queries):
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - start
+
+        match = getattr(request, 'resolver_match', None)
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        metrics.REQUESTS.inc(view, request.method, str(response.status_code))
+        metrics.REQUEST_LATENCY.observe(elapsed, view)
+        metrics.DB_QUERIES.inc(view, amount=queries.count)
+        metrics.DB_QUERIES_PER_REQUEST.observe(queries.count, view)
+        return response
+
+
+class ProfilerMiddleware:
+    """
+    Middleware profiling individual requests on demand.
+
+    A request is profiled when it carries a valid ``X-Profile-Token``
+    header (see ``manage.py profile_token``) or a ``?profile=1`` query
+    parameter from a staff user. The view runs under ``cProfile`` and,
+    when ``PROFILER_SAMPLE_INTERVAL`` is set, a wall-clock sampler; the
+    dumps go to ``PROFILER_DIR`` and only the newest
+    ``PROFILER_MAX_DUMPS`` are kept. Only one request per process is
+    profiled at a time; others are served normally.
+
+    This middleware must come after AuthenticationMiddleware.
+    """
+
+    HEADER = 'HTTP_X_PROFILE_TOKEN'
+    QUERY_PARAM = 'profile'
+
+    _busy = threading.Lock()
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def _requested(self, request):
+        """
+        Decide whether the request asked for, and may have, a profile.
+
+        :param request: The HTTP request object
+        :return: True if the request should be profiled
+        """
+        token = request.META.get(self.HEADER)
+        if token:
+            return profiling.check_profile_token(token, settings.PROFILER_TOKEN_MAX_AGE)
+        if request.GET.get(self.QUERY_PARAM) != '1':
+            return False
+        user = getattr(request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return user.is_staff
+        # API clients authenticate inside the view, so run the same
+        # authenticators here to find out who is asking.
+        drf_request = Request(request, authenticators=[auth() for auth in api_settings.DEFAULT_AUTHENTICATION_CLASSES])
+        try:
+            return bool(drf_request.user and drf_request.user.is_staff)
+        except exceptions.APIException:
+            return False
+
+    def __call__(self, request):
+        if not self._requested(request):
+            return self.get_response(request)
+        if not self._busy.acquire(blocking=False):
+            response = self.get_response(request)
+            response['X-Profile'] = 'busy'
+            return response
+        try:
+            return self._profile(request)
+        finally:
+            self._busy.release()
+
+    def _profile(self, request):
+        """
+        Run the rest of the chain under the profilers and write the dumps.
+
+        :param request: The HTTP request object
+        :return: The view's response, tagged with the dump name
+        """
+        sampler = None
+        if settings.PROFILER_SAMPLE_INTERVAL:
+            sampler = profiling.StackSampler(threading.get_ident(), settings.PROFILER_SAMPLE_INTERVAL)
+            sampler.start()
+        profiler = cProfile.Profile()
+        try:
+            response = profiler.runcall(self.get_response, request)
+        finally:
+            if sampler is not None:
+                sampler.stop()
+
+        match = getattr(request, 'resolver_match', None)
+        name = (match.url_name if match else None) or 'unmatched'
+        try:
+            stem = profiling.dump_profile(settings.PROFILER_DIR, name, profiler, sampler)
+            profiling.rotate_dumps(settings.PROFILER_DIR, settings.PROFILER_MAX_DUMPS)
+        except OSError:
+            logger.exception('Could not write profile for %s', request.path)
+            return response
+        response['X-Profile'] = os.path.basename(stem)
+        return response
@@ -0,0 +1,45 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0007_tokenversion'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='description',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['created_at', 'id'], name='expense_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['created_by', 'created_at'], name='expense_creator_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['category', 'created_at'], name='expense_category_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['split_method', 'created_at'], name='expense_method_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='expense',
+            index=models.Index(fields=['total_amount'], name='expense_amount_idx'),
+        ),
+        # The participants table is auto-created, so its (user, expense)
+        # index for "expenses of user X" lookups is created directly.
+        migrations.RunSQL(
+            'CREATE INDEX expense_participants_user_expense_idx '
+            'ON expenses_app_expense_participants (user_id, expense_id)',
+            'DROP INDEX expense_participants_user_expense_idx',
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-19 13:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0009_ledger_projections'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='version',
+            field=models.PositiveIntegerField(default=1),
+        ),
+    ]
@@ -0,0 +1,72 @@
+import django.db.models.deletion
+import expenses_app.models
+from django.conf import settings
+from django.db import migrations, models
+
+
+def reset_projection_checkpoints(apps, schema_editor):
+    # The projection tables are recreated with a currency key, so the
+    # projections must replay the ledger from the start.
+    ProjectionCheckpoint = apps.get_model('expenses_app', 'ProjectionCheckpoint')
+    ProjectionCheckpoint.objects.filter(name__in=['balances', 'category_rollups']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0010_expense_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='expense',
+            name='currency',
+            field=models.CharField(default=expenses_app.models.default_currency, max_length=3),
+        ),
+        migrations.CreateModel(
+            name='FxRate',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('currency', models.CharField(max_length=3)),
+                ('rate', models.DecimalField(decimal_places=10, max_digits=20)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('currency', 'date'), name='unique_fx_rate_currency_date')],
+                'indexes': [models.Index(fields=['date', 'currency'], name='fx_rate_date_idx')],
+            },
+        ),
+        migrations.DeleteModel(
+            name='UserBalance',
+        ),
+        migrations.DeleteModel(
+            name='CategoryRollup',
+        ),
+        migrations.CreateModel(
+            name='UserBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('paid', models.DecimalField(decimal_places=6, default=0, max_digits=20)),
+                ('owed', models.DecimalField(decimal_places=6, default=0, max_digits=20)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='balances', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'currency'), name='unique_user_balance_currency')],
+            },
+        ),
+        migrations.CreateModel(
+            name='CategoryRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('category', models.CharField(max_length=100)),
+                ('currency', models.CharField(max_length=3)),
+                ('total_amount', models.DecimalField(decimal_places=2, default=0, max_digits=20)),
+                ('expense_count', models.BigIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('category', 'currency'), name='unique_category_rollup_currency')],
+            },
+        ),
+        migrations.RunPython(reset_projection_checkpoints, migrations.RunPython.noop),
+    ]
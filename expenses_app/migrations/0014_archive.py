@@ -0,0 +1,66 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:00
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0013_payments'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedExpense',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('total_amount', models.DecimalField(decimal_places=2, max_digits=10)),
+                ('currency', models.CharField(max_length=3)),
+                ('split_method', models.CharField(choices=[('equal', 'Equal'), ('exact', 'Exact'), ('percentage', 'Percentage')], max_length=10)),
+                ('split_details', models.JSONField(default=dict)),
+                ('category', models.CharField(blank=True, max_length=100)),
+                ('description', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField()),
+                ('version', models.PositiveIntegerField(default=1)),
+                ('recurring_id', models.BigIntegerField(blank=True, null=True)),
+                ('occurrence', models.DateField(blank=True, null=True)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('created_by', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='archived_created_expenses', to=settings.AUTH_USER_MODEL)),
+                ('participants', models.ManyToManyField(related_name='archived_expenses', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['created_at', 'id'], name='archived_created_idx'), models.Index(fields=['created_by', 'created_at'], name='archived_creator_created_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='OpeningBalance',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('as_of', models.DateField()),
+                ('paid', models.DecimalField(decimal_places=6, default=0, max_digits=20)),
+                ('owed', models.DecimalField(decimal_places=6, default=0, max_digits=20)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='opening_balances', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'currency', 'as_of'), name='unique_opening_balance')],
+            },
+        ),
+        migrations.CreateModel(
+            name='OpeningDebt',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('currency', models.CharField(max_length=3)),
+                ('as_of', models.DateField()),
+                ('amount', models.DecimalField(decimal_places=6, default=0, max_digits=20)),
+                ('counterparty', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='opening_debts', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('user', 'counterparty', 'currency', 'as_of'), name='unique_opening_debt')],
+            },
+        ),
+    ]
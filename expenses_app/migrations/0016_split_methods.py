@@ -0,0 +1,28 @@
+# Generated by Django 5.2.18 on 2026-10-19 14:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0015_fingerprints'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='archivedexpense',
+            name='split_method',
+            field=models.CharField(choices=[('equal', 'Equal'), ('exact', 'Exact'), ('percentage', 'Percentage'), ('shares', 'Shares'), ('adjusted', 'Equal with adjustments')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='expense',
+            name='split_method',
+            field=models.CharField(choices=[('equal', 'Equal'), ('exact', 'Exact'), ('percentage', 'Percentage'), ('shares', 'Shares'), ('adjusted', 'Equal with adjustments')], max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='recurringexpense',
+            name='split_method',
+            field=models.CharField(choices=[('equal', 'Equal'), ('exact', 'Exact'), ('percentage', 'Percentage'), ('shares', 'Shares'), ('adjusted', 'Equal with adjustments')], max_length=10),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-19 15:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('expenses_app', '0018_user_updated_at_tombstone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='openingbalance',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+        migrations.AddField(
+            model_name='openingdebt',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True, db_index=True),
+        ),
+    ]
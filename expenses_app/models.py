@@ -1,8 +1,11 @@
 from django.db import models
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.utils import timezone
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 
+from . import splits
+
 
 # Create your models here.
 
@@ -32,6 +35,8 @@ class User(AbstractUser):
     email = models.EmailField(unique=True)
     name = models.CharField(max_length=255)
     mobile = models.CharField(max_length=15)
+    # Change cursor of incremental backups; ``QuerySet.update()`` leaves it alone
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
 
     USERNAME_FIELD = 'email'  # Use email as the unique identifier
     REQUIRED_FIELDS = ['name']  # Additional required fields for createsuperuser
@@ -44,34 +49,64 @@ class User(AbstractUser):
 # Get the custom User model
 User = get_user_model()
 
+
+def default_currency():
+    return settings.DEFAULT_CURRENCY
+
+
 class Expense(models.Model):
     """
     Model to represent an expense in the system.
     
     This model stores information about individual expenses, including:
-    - The total amount of the expense
+    - The total amount of the expense and its ISO 4217 currency code
     - The method used to split the expense
     - Who created the expense
     - The participants involved in the expense
     - Details of how the expense is split
     - The category of the expense
+    - A free-text description
     - When the expense was created
+    - A version number for optimistic concurrency control
     """
     
-    SPLIT_CHOICES = [
-        ('equal', 'Equal'),
-        ('exact', 'Exact'),
-        ('percentage', 'Percentage'),
-    ]
+    # One per registered split method (see expenses_app.splits)
+    SPLIT_CHOICES = splits.choices()
 
     total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, default=default_currency)
     split_method = models.CharField(max_length=10, choices=SPLIT_CHOICES)
     created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='created_expenses')
     participants = models.ManyToManyField(User, related_name='expenses')
     split_details = models.JSONField()
     category = models.CharField(max_length=100, blank=True)
+    description = models.TextField(blank=True, default='')
     created_at = models.DateTimeField(default=timezone.now)
     split_details = models.JSONField(default=dict)
+    # Incremented on every edit; clients send the version they edited so
+    # concurrent edits are detected instead of silently overwritten.
+    version = models.PositiveIntegerField(default=1)
+    # Set on expenses materialized from a recurring template.
+    recurring = models.ForeignKey('RecurringExpense', on_delete=models.SET_NULL, null=True, blank=True, related_name='occurrences')
+    occurrence = models.DateField(null=True, blank=True)
+    # Hash used to detect double submissions (see expenses_app.duplicates).
+    fingerprint = models.CharField(max_length=64, null=True, blank=True, editable=False)
+
+    class Meta:
+        # One index per filterable column, each suffixed with created_at so
+        # date-range filters and date ordering are served by the same index.
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='expense_created_idx'),
+            models.Index(fields=['created_by', 'created_at'], name='expense_creator_created_idx'),
+            models.Index(fields=['category', 'created_at'], name='expense_category_created_idx'),
+            models.Index(fields=['split_method', 'created_at'], name='expense_method_created_idx'),
+            models.Index(fields=['total_amount'], name='expense_amount_idx'),
+            models.Index(fields=['fingerprint'], name='expense_fingerprint_idx'),
+        ]
+        constraints = [
+            # A template's occurrence is materialized at most once.
+            models.UniqueConstraint(fields=['recurring', 'occurrence'], name='unique_recurring_occurrence'),
+        ]
 
     def __str__(self):
         """
@@ -81,3 +116,379 @@ class Expense(models.Model):
         """
         
         return f"Expense of {self.total_amount} created by {self.created_by}"
+
+
+class RecurringExpense(models.Model):
+    """
+    Model to represent a template for an expense that repeats.
+
+    The template holds everything needed to create each occurrence: the
+    amount, split method, shares as entered (``split_details``, in the same
+    form ExpenseSerializer accepts) and participants. Occurrence ``n`` falls
+    ``n * interval`` cadence units after ``start_date``; monthly and yearly
+    occurrences on days a month lacks fall on its last day.
+
+    ``next_due`` and ``occurrence_count`` describe the first occurrence not
+    yet materialized; the materialize_recurring command advances them in
+    the same transaction as the expenses it creates.
+    """
+
+    DAILY = 'daily'
+    WEEKLY = 'weekly'
+    MONTHLY = 'monthly'
+    YEARLY = 'yearly'
+
+    CADENCE_CHOICES = [
+        (DAILY, 'Daily'),
+        (WEEKLY, 'Weekly'),
+        (MONTHLY, 'Monthly'),
+        (YEARLY, 'Yearly'),
+    ]
+
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recurring_expenses')
+    participants = models.ManyToManyField(User, related_name='recurring_participations')
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, default=default_currency)
+    split_method = models.CharField(max_length=10, choices=Expense.SPLIT_CHOICES)
+    split_details = models.JSONField(default=dict, blank=True)
+    category = models.CharField(max_length=100, blank=True)
+    description = models.TextField(blank=True, default='')
+    cadence = models.CharField(max_length=10, choices=CADENCE_CHOICES)
+    interval = models.PositiveSmallIntegerField(default=1)
+    start_date = models.DateField()
+    end_date = models.DateField(null=True, blank=True)
+    next_due = models.DateField()
+    occurrence_count = models.PositiveIntegerField(default=0)
+    active = models.BooleanField(default=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['active', 'next_due'], name='recurring_due_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.cadence} expense of {self.total_amount} {self.currency} created by {self.created_by}"
+
+
+class Payment(models.Model):
+    """
+    Model to represent a settlement: money one user paid another outside of
+    any expense ("A paid B 50").
+
+    A payment counts as paid by the payer and owed by the payee, so it
+    raises the payer's net balance and lowers the payee's by its amount.
+    Payments are recorded once and never edited; a mistake is corrected by
+    a payment in the other direction.
+    """
+
+    payer = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments_made')
+    payee = models.ForeignKey(User, on_delete=models.CASCADE, related_name='payments_received')
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3, default=default_currency)
+    note = models.CharField(max_length=255, blank=True, default='')
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='recorded_payments')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['payer', 'created_at'], name='payment_payer_idx'),
+            models.Index(fields=['payee', 'created_at'], name='payment_payee_idx'),
+        ]
+
+    def __str__(self):
+        return f"Payment of {self.amount} {self.currency} from {self.payer} to {self.payee}"
+
+
+class ArchivedExpense(models.Model):
+    """
+    Model to hold an expense moved out of the live table by the
+    archive_expenses command.
+
+    Rows keep the id, fields and participants the expense had, so archived
+    expenses render exactly like live ones. They are read-only; their
+    effect on balances is carried by OpeningBalance and OpeningDebt, so
+    balance queries never read this table.
+    """
+
+    id = models.BigIntegerField(primary_key=True)
+    total_amount = models.DecimalField(max_digits=10, decimal_places=2)
+    currency = models.CharField(max_length=3)
+    split_method = models.CharField(max_length=10, choices=Expense.SPLIT_CHOICES)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='archived_created_expenses')
+    participants = models.ManyToManyField(User, related_name='archived_expenses')
+    split_details = models.JSONField(default=dict)
+    category = models.CharField(max_length=100, blank=True)
+    description = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField()
+    version = models.PositiveIntegerField(default=1)
+    recurring_id = models.BigIntegerField(null=True, blank=True)
+    occurrence = models.DateField(null=True, blank=True)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='archived_created_idx'),
+            models.Index(fields=['created_by', 'created_at'], name='archived_creator_created_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived expense of {self.total_amount} created by {self.created_by}"
+
+
+class OpeningBalance(models.Model):
+    """
+    Model to hold a user's totals over archived expenses.
+
+    The archive_expenses command adds each archived expense here as the
+    balance projection would (paid by the creator, owed by each
+    participant), in the expense currency and dated ``as_of``, the day the
+    expense was created; amounts are converted at that date when reported,
+    as the live expense was.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='opening_balances')
+    currency = models.CharField(max_length=3)
+    as_of = models.DateField()
+    paid = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    owed = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    # Last archive run that changed the row, the incremental backup cursor
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'currency', 'as_of'], name='unique_opening_balance'),
+        ]
+
+    @property
+    def net(self):
+        return self.paid - self.owed
+
+
+class OpeningDebt(models.Model):
+    """
+    Model to hold what one user owes another over archived expenses.
+
+    ``amount`` is what ``counterparty`` owes ``user`` (negative when
+    ``user`` owes); every pair is stored in both directions so a user's
+    rows are one index range. Rows are keyed like OpeningBalance.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='opening_debts')
+    counterparty = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    currency = models.CharField(max_length=3)
+    as_of = models.DateField()
+    amount = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    # Last archive run that changed the row, the incremental backup cursor
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'counterparty', 'currency', 'as_of'], name='unique_opening_debt'),
+        ]
+
+
+class TokenVersion(models.Model):
+    """
+    Model to hold the current signed-token version of a user.
+
+    Signed auth tokens embed the version they were issued with; bumping
+    the version revokes every token issued before. Users without a row
+    are on version 0. Lookups go through a short-lived cache, so this
+    table is read at most once per user per cache TTL.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='token_version')
+    version = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f"Token version {self.version} for {self.user_id}"
+
+
+class Tombstone(models.Model):
+    """
+    Model to record the deletion of a user or authtoken key.
+
+    Incremental backups copy these tables by change time and so cannot see
+    deleted rows; they write the tombstones recorded since the previous
+    backup as deletes instead. ``model`` is the deleted row's model label.
+    """
+
+    model = models.CharField(max_length=100)
+    key = models.CharField(max_length=255)
+    deleted_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"{self.model} {self.key} deleted at {self.deleted_at}"
+
+
+class LedgerEvent(models.Model):
+    """
+    Model to represent one entry of the append-only ledger.
+
+    Every change to expenses (and, later, payments) appends an event in
+    the same transaction as the change itself. The id is the event's
+    position in the stream; projections record the last id they applied.
+    ``expense_id`` is a plain column rather than a foreign key so events
+    outlive the expenses they describe.
+
+    Payloads hold the state needed to apply the event without reading
+    other tables, with amounts as decimal strings:
+    - expense_created: ``{"after": state}``
+    - expense_edited: ``{"before": state, "after": state}``
+    - expense_deleted: ``{"before": state}``
+    - payment_recorded: ``{"payment": {"id", "payer", "payee", "amount", "currency"}}``
+    where state is ``{"created_by", "total_amount", "category", "shares"}``.
+    """
+
+    EXPENSE_CREATED = 'expense_created'
+    EXPENSE_EDITED = 'expense_edited'
+    EXPENSE_DELETED = 'expense_deleted'
+    PAYMENT_RECORDED = 'payment_recorded'
+
+    KIND_CHOICES = [
+        (EXPENSE_CREATED, 'Expense created'),
+        (EXPENSE_EDITED, 'Expense edited'),
+        (EXPENSE_DELETED, 'Expense deleted'),
+        (PAYMENT_RECORDED, 'Payment recorded'),
+    ]
+
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    expense_id = models.BigIntegerField(null=True, blank=True, db_index=True)
+    payload = models.JSONField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['id']
+
+    def __str__(self):
+        return f"Event {self.id}: {self.kind}"
+
+
+class ProjectionCheckpoint(models.Model):
+    """
+    Model to store how far a projection has consumed the ledger.
+
+    ``offset`` is the id of the last event applied to the projection's
+    tables. ``snapshot`` optionally holds the projection's full state as
+    of ``snapshot_offset``; rebuilds start from it instead of from the
+    first event, and events up to it may be compacted away.
+
+    Ledger writers lock the ``ledger.APPEND_LOCK`` row, which belongs to no
+    projection, to commit events in id order.
+    """
+
+    name = models.CharField(max_length=50, unique=True)
+    offset = models.BigIntegerField(default=0)
+    snapshot = models.JSONField(null=True, blank=True)
+    snapshot_offset = models.BigIntegerField(null=True, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} at event {self.offset}"
+
+
+class UserBalance(models.Model):
+    """
+    Model to hold per-user totals maintained by the balance projection.
+
+    - paid: total amount of the expenses the user created and the payments
+      they made
+    - owed: sum of the user's shares across all expenses and of the
+      payments they received
+
+    Totals are kept per currency, in the currency of the expenses; they
+    are converted only when reported. The user reference has no database
+    constraint because events are replayed even for users deleted since.
+    """
+
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='balances')
+    currency = models.CharField(max_length=3)
+    paid = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+    owed = models.DecimalField(max_digits=20, decimal_places=6, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'currency'], name='unique_user_balance_currency'),
+        ]
+
+    @property
+    def net(self):
+        return self.paid - self.owed
+
+    def __str__(self):
+        return f"Balance of {self.user_id}: {self.net} {self.currency}"
+
+
+class UserChange(models.Model):
+    """
+    Model to record that a ledger event changed a user's data, for sync.
+
+    One row is written per affected user (the expense's creator and every
+    participant before and after the change, or both sides of a payment)
+    in the transaction that appends the event. ``seq`` is the event id, so
+    each user's rows form an increasing sequence and a client that has
+    seen everything up to ``seq`` reads only the rows after it.
+
+    - expense_id: the expense changed, if any
+    - balance: the change to the user's net balance, per currency, as
+      decimal strings
+    """
+
+    user = models.ForeignKey(User, on_delete=models.DO_NOTHING, db_constraint=False, related_name='changes')
+    seq = models.BigIntegerField()
+    expense_id = models.BigIntegerField(null=True, blank=True)
+    balance = models.JSONField(default=dict)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'seq'], name='unique_user_change_seq'),
+        ]
+
+    def __str__(self):
+        return f"Change {self.seq} for {self.user_id}"
+
+
+class CategoryRollup(models.Model):
+    """
+    Model to hold per-category totals, per currency, maintained by the
+    rollup projection.
+    """
+
+    category = models.CharField(max_length=100)
+    currency = models.CharField(max_length=3)
+    total_amount = models.DecimalField(max_digits=20, decimal_places=2, default=0)
+    expense_count = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['category', 'currency'], name='unique_category_rollup_currency'),
+        ]
+
+    def __str__(self):
+        return f"{self.category or '(none)'}: {self.total_amount} {self.currency} over {self.expense_count} expenses"
+
+
+class FxRate(models.Model):
+    """
+    Model to store one exchange rate per currency and day.
+
+    ``rate`` is the value of one unit of ``currency`` in the base currency
+    (``FX_BASE_CURRENCY``). Rates are loaded with the import_fx_rates
+    command; a day without a rate uses the latest earlier one.
+    """
+
+    date = models.DateField()
+    currency = models.CharField(max_length=3)
+    rate = models.DecimalField(max_digits=20, decimal_places=10)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['currency', 'date'], name='unique_fx_rate_currency_date'),
+        ]
+        indexes = [
+            models.Index(fields=['date', 'currency'], name='fx_rate_date_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.currency} on {self.date}: {self.rate}"
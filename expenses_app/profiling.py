@@ -0,0 +1,194 @@
+"""
+Helpers for the on-demand request profiler.
+
+A profiled request produces a ``.prof`` file readable by ``pstats`` or
+snakeviz and a ``.collapsed`` file in the folded-stack format consumed by
+flamegraph.pl and speedscope. When a sample interval is configured, a
+``.sampled.collapsed`` file from a wall-clock sampling profiler is written
+as well.
+"""
+import os
+import pstats
+import sys
+import threading
+import time
+
+from django.core import signing
+
+
+PROFILE_SIGNING_SALT = 'expenses_app.profiler'
+PROFILE_SIGNED_VALUE = 'profile'
+
+# Folding a cProfile graph visits every caller path; these bounds keep deep
+# or highly connected graphs from exploding.
+MAX_STACK_DEPTH = 64
+MIN_NODE_SECONDS = 1e-6
+
+
+def make_profile_token():
+    """
+    Create a signed value for the profiling request header.
+
+    :return: Timestamped signature accepted by ``check_profile_token``
+    """
+    return signing.TimestampSigner(salt=PROFILE_SIGNING_SALT).sign(PROFILE_SIGNED_VALUE)
+
+
+def check_profile_token(token, max_age):
+    """
+    Check a profiling header value.
+
+    :param token: Header value sent by the client
+    :param max_age: Maximum token age in seconds
+    :return: True if the signature is valid and not expired
+    """
+    try:
+        value = signing.TimestampSigner(salt=PROFILE_SIGNING_SALT).unsign(token, max_age=max_age)
+    except signing.BadSignature:
+        return False
+    return value == PROFILE_SIGNED_VALUE
+
+
+def _frame_label(func):
+    """
+    Build a folded-stack frame label from a pstats function key.
+
+    :param func: (filename, lineno, funcname) tuple
+    :return: Label without the frame separator used by the format
+    """
+    filename, lineno, funcname = func
+    if filename == '~':
+        label = funcname
+    else:
+        label = f'{funcname} ({os.path.basename(filename)}:{lineno})'
+    return label.replace(';', ',')
+
+
+def collapse_stats(stats):
+    """
+    Fold cProfile results into collapsed stacks.
+
+    cProfile only records caller/callee edges, not full stacks, so every
+    path from a root is walked and time is split along each edge in
+    proportion to its share of the callee's cumulative time.
+
+    :param stats: pstats.Stats instance
+    :return: dict mapping ``frame;frame;...`` to microseconds
+    """
+    raw = stats.stats
+    callees = {}
+    for func, (_, _, _, _, callers) in raw.items():
+        for caller, edge in callers.items():
+            callees.setdefault(caller, []).append((func, edge[3]))
+
+    folded = {}
+
+    def walk(func, budget, path, labels):
+        _, _, self_time, cumulative, _ = raw[func]
+        if cumulative <= 0 or budget < MIN_NODE_SECONDS:
+            return
+        scale = budget / cumulative
+        labels.append(_frame_label(func))
+        key = ';'.join(labels)
+        folded[key] = folded.get(key, 0.0) + self_time * scale
+        if len(labels) < MAX_STACK_DEPTH:
+            path.add(func)
+            for callee, edge_time in callees.get(func, ()):
+                if callee not in path:
+                    walk(callee, edge_time * scale, path, labels)
+            path.discard(func)
+        labels.pop()
+
+    for func, (_, _, _, cumulative, callers) in raw.items():
+        if not callers:
+            walk(func, cumulative, set(), [])
+
+    return {stack: int(seconds * 1e6) for stack, seconds in folded.items() if seconds * 1e6 >= 1}
+
+
+class StackSampler:
+    """
+    Wall-clock sampling profiler for a single thread.
+
+    A daemon thread reads the target thread's current frame every
+    ``interval`` seconds and counts each distinct stack, so time spent
+    blocked in I/O shows up alongside CPU time.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.samples = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-sampler', daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            labels = []
+            while frame is not None:
+                code = frame.f_code
+                labels.append(_frame_label((code.co_filename, code.co_firstlineno, code.co_name)))
+                frame = frame.f_back
+            if labels:
+                key = ';'.join(reversed(labels))
+                self.samples[key] = self.samples.get(key, 0) + 1
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+
+def write_collapsed(path, folded):
+    """
+    Write folded stacks, one ``stack count`` line each.
+
+    :param path: Destination file path
+    :param folded: dict mapping stacks to counts
+    """
+    with open(path, 'w', encoding='utf-8') as handle:
+        for stack, count in sorted(folded.items()):
+            handle.write(f'{stack} {count}\n')
+
+
+def dump_profile(directory, name, profiler, sampler=None):
+    """
+    Write the dump files for one profiled request.
+
+    :param directory: Output directory, created if missing
+    :param name: Short label for the request, used in file names
+    :param profiler: Disabled cProfile.Profile instance
+    :param sampler: Optional stopped StackSampler
+    :return: Path stem shared by the written files
+    """
+    os.makedirs(directory, exist_ok=True)
+    stem = os.path.join(directory, f'{time.strftime("%Y%m%dT%H%M%S")}-{time.time_ns() % 10**9:09d}-{name}')
+    profiler.dump_stats(stem + '.prof')
+    write_collapsed(stem + '.collapsed', collapse_stats(pstats.Stats(profiler)))
+    if sampler is not None:
+        write_collapsed(stem + '.sampled.collapsed', sampler.samples)
+    return stem
+
+
+def rotate_dumps(directory, keep):
+    """
+    Delete all but the newest ``keep`` dumps and their companion files.
+
+    :param directory: Directory holding the dumps
+    :param keep: Number of dumps to keep
+    """
+    try:
+        entries = [entry for entry in os.scandir(directory) if entry.name.endswith('.prof')]
+    except FileNotFoundError:
+        return
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    for entry in entries[keep:]:
+        stem = entry.path[:-len('.prof')]
+        for suffix in ('.prof', '.collapsed', '.sampled.collapsed'):
+            try:
+                os.remove(stem + suffix)
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,361 @@
+"""
+Projections maintained from the ledger event stream.
+
+A projection folds events into its own tables. Each one has a
+ProjectionCheckpoint row recording the last event it applied; catching up
+reads the events after that offset in id order, one chunk per transaction,
+and moves the offset in the same transaction as the table writes, so an
+interrupted catch-up resumes where it stopped. The offset only moves if it
+still holds the value the chunk was read after (compare-and-swap), so when
+two catch-ups race, on backends where ``select_for_update`` does not lock
+(SQLite), the second rolls its chunk back instead of applying it again. An offset never skips an event that commits later,
+because ``ledger`` makes events visible in id order.
+
+Within a chunk, events only update in-memory deltas; the tables are
+written once per chunk with one bulk upsert per projection, which is what
+keeps full replays of millions of events fast.
+
+A snapshot stores a projection's whole state at an offset. Rebuilding
+restores the latest snapshot and replays only later events, and
+compaction deletes the events that every projection has snapshotted and
+the latest backup has read past (incremental backups find edited and
+deleted expenses in the events since the previous backup).
+"""
+from decimal import Decimal
+
+from django.db import transaction
+from django.utils import timezone
+
+from .ledger import state_currency
+from .models import CategoryRollup, LedgerEvent, ProjectionCheckpoint, UserBalance
+
+
+ZERO = Decimal('0')
+DEFAULT_CHUNK_SIZE = 5000
+# Keeps ``IN`` lists under SQLite's bound-parameter limit.
+LOOKUP_BATCH = 900
+
+PROJECTIONS = {}
+# Checkpoint holding the last event id of the latest backup
+BACKUP_CHECKPOINT = 'backup'
+
+
+def register(cls):
+    """
+    Class decorator adding a projection to the registry.
+    """
+    PROJECTIONS[cls.name] = cls
+    return cls
+
+
+def _batches(items, size=LOOKUP_BATCH):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+class Projection:
+    """
+    Base class for projections.
+
+    Subclasses accumulate changes in ``apply`` and write them in ``flush``;
+    ``clear``, ``dump_state`` and ``load_state`` support rebuilds and
+    snapshots.
+    """
+
+    name = None
+
+    def apply(self, kind, payload):
+        """
+        Fold one event into the pending changes.
+
+        :param kind: Event kind
+        :param payload: Event payload
+        """
+        raise NotImplementedError
+
+    def flush(self):
+        """
+        Write the pending changes to the projection's tables.
+        """
+        raise NotImplementedError
+
+    def clear(self):
+        """
+        Delete everything from the projection's tables.
+        """
+        raise NotImplementedError
+
+    def dump_state(self):
+        """
+        :return: JSON-serializable copy of the projection's tables
+        """
+        raise NotImplementedError
+
+    def load_state(self, state):
+        """
+        Replace the projection's tables with a dumped state.
+
+        :param state: Value returned by ``dump_state``
+        """
+        raise NotImplementedError
+
+
+class _TotalsProjection(Projection):
+    """
+    Projection keeping additive totals per key in one table.
+
+    Keys are tuples of the ``key_fields`` values; ``pending`` maps each
+    key to a list of deltas, one per value field. ``touched_fields`` are
+    other columns rewritten on every flush, such as ``auto_now``
+    timestamps.
+    """
+
+    model = None
+    key_fields = ()
+    value_fields = ()
+    touched_fields = ()
+
+    def __init__(self):
+        self.pending = {}
+
+    def _add(self, key, *deltas):
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = [ZERO] * len(self.value_fields)
+        for index, delta in enumerate(deltas):
+            entry[index] += delta
+
+    def apply(self, kind, payload):
+        if 'payment' in payload:
+            self.apply_payment(payload['payment'])
+        if 'before' in payload:
+            self.apply_state(payload['before'], -1)
+        if 'after' in payload:
+            self.apply_state(payload['after'], 1)
+
+    def apply_state(self, state, sign):
+        """
+        Add (sign 1) or remove (sign -1) one expense state.
+
+        :param state: Expense state from an event payload
+        :param sign: 1 or -1
+        """
+        raise NotImplementedError
+
+    def apply_payment(self, payment):
+        """
+        Add a recorded payment; projections unaffected by payments ignore it.
+
+        :param payment: Payment state from an event payload
+        """
+
+    def _key(self, row):
+        return tuple(getattr(row, field) for field in self.key_fields)
+
+    def flush(self):
+        if not self.pending:
+            return
+        lead = self.key_fields[0]
+        rows = []
+        for keys in _batches(self.pending):
+            existing = {
+                self._key(row): row
+                for row in self.model.objects.filter(**{f'{lead}__in': {key[0] for key in keys}})
+            }
+            for key in keys:
+                row = existing.get(key) or self.model(**dict(zip(self.key_fields, key)))
+                for field, delta in zip(self.value_fields, self.pending[key]):
+                    setattr(row, field, (getattr(row, field) or ZERO) + delta)
+                rows.append(row)
+        self.model.objects.bulk_create(
+            rows,
+            update_conflicts=True,
+            unique_fields=[self.model._meta.get_field(field).name for field in self.key_fields],
+            update_fields=list(self.value_fields) + list(self.touched_fields),
+        )
+        self.pending = {}
+
+    def clear(self):
+        self.model.objects.all().delete()
+        self.pending = {}
+
+    def dump_state(self):
+        width = len(self.key_fields)
+        return [
+            list(row[:width]) + [str(value) for value in row[width:]]
+            for row in self.model.objects.order_by(*self.key_fields).values_list(*self.key_fields, *self.value_fields).iterator()
+        ]
+
+    def load_state(self, state):
+        self.clear()
+        width = len(self.key_fields)
+        rows = (
+            self.model(
+                **dict(zip(self.key_fields, row[:width])),
+                **{field: Decimal(value) for field, value in zip(self.value_fields, row[width:])},
+            )
+            for row in state
+        )
+        self.model.objects.bulk_create(rows, batch_size=LOOKUP_BATCH)
+
+
+@register
+class BalanceProjection(_TotalsProjection):
+    """
+    Per-user, per-currency paid and owed totals in UserBalance.
+    """
+
+    name = 'balances'
+    model = UserBalance
+    key_fields = ('user_id', 'currency')
+    value_fields = ('paid', 'owed')
+
+    def apply_state(self, state, sign):
+        currency = state_currency(state)
+        self._add((int(state['created_by']), currency), sign * Decimal(state['total_amount']), ZERO)
+        for user_id, amount in state['shares'].items():
+            self._add((int(user_id), currency), ZERO, sign * Decimal(amount))
+
+    def apply_payment(self, payment):
+        amount = Decimal(payment['amount'])
+        self._add((int(payment['payer']), payment['currency']), amount, ZERO)
+        self._add((int(payment['payee']), payment['currency']), ZERO, amount)
+
+
+@register
+class CategoryRollupProjection(_TotalsProjection):
+    """
+    Per-category, per-currency expense totals and counts in CategoryRollup.
+    """
+
+    name = 'category_rollups'
+    model = CategoryRollup
+    key_fields = ('category', 'currency')
+    value_fields = ('total_amount', 'expense_count')
+
+    def apply_state(self, state, sign):
+        self._add((state['category'], state_currency(state)), sign * Decimal(state['total_amount']), Decimal(sign))
+
+
+def _locked_checkpoint(name):
+    ProjectionCheckpoint.objects.get_or_create(name=name)
+    return ProjectionCheckpoint.objects.select_for_update().get(name=name)
+
+
+class _CheckpointMoved(Exception):
+    """
+    Another catch-up moved the offset while a chunk was being applied.
+    """
+
+
+def catch_up(name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Apply every event after the projection's stored offset.
+
+    If another catch-up of the same projection moves the offset first,
+    this one rolls back its current chunk and stops; the other applies the
+    remaining events.
+
+    :param name: Registered projection name
+    :param chunk_size: Events applied per transaction
+    :return: Number of events applied
+    """
+    projection = PROJECTIONS[name]()
+    applied = 0
+    while True:
+        try:
+            with transaction.atomic():
+                offset = _locked_checkpoint(name).offset
+                events = list(
+                    LedgerEvent.objects.filter(id__gt=offset)
+                    .order_by('id')
+                    .values_list('id', 'kind', 'payload')[:chunk_size]
+                )
+                if not events:
+                    return applied
+                for _, kind, payload in events:
+                    projection.apply(kind, payload)
+                projection.flush()
+                moved = ProjectionCheckpoint.objects.filter(name=name, offset=offset).update(
+                    offset=events[-1][0], updated_at=timezone.now(),
+                )
+                if not moved:
+                    raise _CheckpointMoved
+        except _CheckpointMoved:
+            return applied
+        applied += len(events)
+
+
+def catch_up_all(chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Catch up every registered projection.
+
+    :return: dict mapping projection names to the number of events applied
+    """
+    return {name: catch_up(name, chunk_size) for name in PROJECTIONS}
+
+
+def rebuild(name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Recreate a projection from its latest snapshot (or from the first
+    event) and replay the events after it.
+
+    :param name: Registered projection name
+    :param chunk_size: Events applied per transaction
+    :return: Number of events applied
+    """
+    projection = PROJECTIONS[name]()
+    with transaction.atomic():
+        checkpoint = _locked_checkpoint(name)
+        if checkpoint.snapshot is not None:
+            projection.load_state(checkpoint.snapshot)
+            checkpoint.offset = checkpoint.snapshot_offset
+        else:
+            projection.clear()
+            checkpoint.offset = 0
+        checkpoint.save(update_fields=['offset', 'updated_at'])
+    return catch_up(name, chunk_size)
+
+
+def take_snapshot(name, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Catch a projection up and store its state as a snapshot.
+
+    :param name: Registered projection name
+    :param chunk_size: Events applied per transaction while catching up
+    :return: Offset of the snapshot
+    """
+    catch_up(name, chunk_size)
+    projection = PROJECTIONS[name]()
+    with transaction.atomic():
+        checkpoint = _locked_checkpoint(name)
+        checkpoint.snapshot = projection.dump_state()
+        checkpoint.snapshot_offset = checkpoint.offset
+        checkpoint.save(update_fields=['snapshot', 'snapshot_offset', 'updated_at'])
+    return checkpoint.snapshot_offset
+
+
+def compact(chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Delete events already covered by the snapshot of every projection and
+    by the latest backup, if any.
+
+    :param chunk_size: Events deleted per statement
+    :return: Number of events deleted
+    :raises ValueError: If a projection has no snapshot yet
+    """
+    offsets = dict(ProjectionCheckpoint.objects.filter(name__in=PROJECTIONS).values_list('name', 'snapshot_offset'))
+    missing = [name for name in PROJECTIONS if offsets.get(name) is None]
+    if missing:
+        raise ValueError(f"No snapshot for: {', '.join(missing)}")
+    bound = min(offsets.values())
+    backup = ProjectionCheckpoint.objects.filter(name=BACKUP_CHECKPOINT).values_list('offset', flat=True).first()
+    if backup is not None:
+        bound = min(bound, backup)
+    deleted = 0
+    while True:
+        ids = list(LedgerEvent.objects.filter(id__lte=bound).order_by('id').values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return deleted
+        deleted += LedgerEvent.objects.filter(id__gte=ids[0], id__lte=ids[-1]).delete()[0]
@@ -0,0 +1,102 @@
+"""
+Bulk user provisioning.
+
+Hashing a password is deliberately slow (PBKDF2 with hundreds of thousands
+of iterations), so registering thousands of users one request at a time is
+bound by a single core. ``provision_users`` hashes every password on a
+process pool, then writes the users and their auth tokens with one
+``bulk_create`` per chunk.
+
+The pool uses the ``spawn`` start method, which is safe from threaded web
+servers; each worker runs ``django.setup()`` so that ``make_password``
+sees the configured hashers. Web processes keep one pool for their
+lifetime, sized by ``PASSWORD_HASH_WORKERS``.
+"""
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import django
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from .models import User
+
+
+DEFAULT_BATCH_SIZE = 500
+# Below this many passwords, sending them to the pool costs more than it saves.
+PARALLEL_MIN_PASSWORDS = 4
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def create_pool(workers=None):
+    """
+    :param workers: Worker processes, defaults to the number of CPUs
+    :return: ProcessPoolExecutor able to run ``make_password``
+    """
+    return ProcessPoolExecutor(max_workers=workers or os.cpu_count() or 1, mp_context=get_context('spawn'), initializer=django.setup)
+
+
+def shared_pool():
+    """
+    :return: The process-wide hashing pool, created on first use
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = create_pool(settings.PASSWORD_HASH_WORKERS)
+        return _pool
+
+
+def hash_passwords(passwords, pool=None):
+    """
+    Hash passwords in parallel, keeping their order.
+
+    :param passwords: List of raw passwords
+    :param pool: Executor to use, defaults to the shared pool
+    :return: List of encoded password hashes
+    """
+    if len(passwords) < PARALLEL_MIN_PASSWORDS:
+        return [make_password(password) for password in passwords]
+    return list((pool or shared_pool()).map(make_password, passwords))
+
+
+def provision_users(entries, batch_size=DEFAULT_BATCH_SIZE, pool=None):
+    """
+    Create users with auth tokens.
+
+    Uniqueness of the emails must have been checked by the caller; the
+    whole call is atomic, so a conflict inserted meanwhile creates nobody.
+
+    :param entries: List of dicts with ``email``, ``name``, ``mobile`` and ``password``
+    :param batch_size: Users written per statement
+    :param pool: Executor for hashing, defaults to the shared pool
+    :return: List of (User, token key), in the order of the entries
+    """
+    hashes = hash_passwords([entry['password'] for entry in entries], pool)
+    users = [
+        User(
+            email=User.objects.normalize_email(entry['email']),
+            name=entry['name'],
+            mobile=entry.get('mobile', ''),
+            password=password,
+        )
+        for entry, password in zip(entries, hashes)
+    ]
+    with transaction.atomic():
+        created = []
+        for start in range(0, len(users), batch_size):
+            chunk = User.objects.bulk_create(users[start:start + batch_size])
+            if chunk and chunk[0].pk is None:
+                # Backends that can't return ids from bulk inserts.
+                ids = dict(User.objects.filter(email__in=[user.email for user in chunk]).values_list('email', 'id'))
+                for user in chunk:
+                    user.pk = ids[user.email]
+            created.extend(chunk)
+        tokens = Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in created], batch_size=batch_size)
+    return [(user, token.key) for user, token in zip(created, tokens)]
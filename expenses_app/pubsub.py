@@ -0,0 +1,118 @@
+"""
+In-process publish/subscribe hub for live balance updates.
+
+Subscribers are SSE connections running on the ASGI event loop; each gets
+a bounded asyncio queue. Publishers may be on any thread (request threads
+committing expenses), so messages are handed to the subscriber's loop with
+``call_soon_threadsafe`` and never block the publisher.
+
+When a subscriber's queue is full the client is too slow to keep up: its
+pending messages are dropped and replaced by a single ``resync`` message
+telling it to refetch its balances. Memory per client therefore stays
+bounded no matter how far behind it falls.
+
+The hub only reaches clients connected to the same process as the writer.
+"""
+import asyncio
+import threading
+
+from django.conf import settings
+
+from . import metrics
+
+
+SSE_MESSAGES = metrics.registry.counter(
+    'sse_messages_total',
+    'Messages offered to SSE clients, by outcome (queued/dropped).',
+    ('outcome',),
+)
+
+
+class Subscription:
+    """
+    One connected client's queue.
+    """
+
+    def __init__(self, user_id, loop, maxsize):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=maxsize)
+
+    def offer(self, message):
+        """
+        Queue a message, collapsing the backlog into a resync when full.
+
+        Runs on the subscriber's event loop.
+
+        :param message: dict to send to the client
+        """
+        try:
+            self.queue.put_nowait(message)
+            SSE_MESSAGES.inc('queued')
+            return
+        except asyncio.QueueFull:
+            pass
+        dropped = 0
+        while not self.queue.empty():
+            self.queue.get_nowait()
+            dropped += 1
+        SSE_MESSAGES.inc('dropped', amount=dropped + 1)
+        self.queue.put_nowait({'event': 'resync'})
+
+
+class BalanceHub:
+    """
+    Registry of subscriptions keyed by user id.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}
+
+    def subscribe(self, user_id, maxsize=None):
+        """
+        Register a subscription on the running event loop.
+
+        :param user_id: User whose updates to receive
+        :param maxsize: Queue bound, defaults to ``SSE_QUEUE_SIZE``
+        :return: Subscription
+        """
+        subscription = Subscription(user_id, asyncio.get_running_loop(), maxsize or settings.SSE_QUEUE_SIZE)
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def subscriber_count(self, user_id=None):
+        with self._lock:
+            if user_id is not None:
+                return len(self._subscriptions.get(user_id, ()))
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+    def publish(self, user_id, message):
+        """
+        Send a message to every subscription of a user.
+
+        Safe to call from any thread; returns immediately.
+
+        :param user_id: Recipient user id
+        :param message: dict to send
+        """
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(user_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.offer, message)
+            except RuntimeError:
+                # The subscriber's loop has closed; its connection is gone.
+                self.unsubscribe(subscription)
+
+
+hub = BalanceHub()
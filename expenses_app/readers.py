@@ -0,0 +1,183 @@
+"""
+Read-only fast path for list endpoints.
+
+``ValuesReader`` produces dicts that render to the same JSON as a
+ModelSerializer's ``data`` without instantiating models or running DRF fields per row. It inspects the
+serializer once to build one accessor per field, then reads the rows with
+``values()`` and every many-to-many field with a single query on its
+through table, so a list costs two queries and one dict per row however
+many rows and participants there are.
+
+Only plain model fields, primary-key related fields and many-to-many
+primary-key fields are supported, which covers the serializers used for
+lists here.
+
+``read`` can be limited to some of the fields (``?fields=``): only their
+columns are selected, and a many-to-many field's query only runs when the
+field is asked for.
+"""
+from django.utils import timezone
+from rest_framework import serializers
+from rest_framework.settings import api_settings
+
+
+def _identity(value):
+    return value
+
+
+def _decimal_accessor(field):
+    coerce_to_string = getattr(field, 'coerce_to_string', api_settings.COERCE_DECIMAL_TO_STRING)
+    if not coerce_to_string or field.localize or field.normalize_output:
+        return field.to_representation
+    places = field.decimal_places
+    if places is None:
+        return field.to_representation
+
+    def accessor(value):
+        if value is None:
+            return ''
+        return f'{value:.{places}f}'
+    return accessor
+
+
+def _datetime_accessor(field):
+    output_format = getattr(field, 'format', api_settings.DATETIME_FORMAT)
+    if output_format is None or output_format.lower() != 'iso-8601' or hasattr(field, 'timezone'):
+        return field.to_representation
+
+    def accessor(value):
+        # Left as a datetime for the renderer, which formats it like
+        # DateTimeField does; only the time zone is applied here.
+        if not value:
+            return None
+        if timezone.is_aware(value):
+            return value.astimezone(timezone.get_current_timezone())
+        return value
+    return accessor
+
+
+class ValuesReader:
+    """
+    Builds a serializer's representation from ``values()`` rows.
+
+    :param serializer_class: ModelSerializer whose output to reproduce
+    """
+
+    def __init__(self, serializer_class):
+        self.serializer_class = serializer_class
+        self._plan = None
+
+    def _build_plan(self):
+        serializer = self.serializer_class()
+        model = serializer.Meta.model
+        columns, accessors = [], []
+        for name, field in serializer.fields.items():
+            if field.write_only:
+                continue
+            if isinstance(field, serializers.ManyRelatedField):
+                if not isinstance(field.child_relation, serializers.PrimaryKeyRelatedField):
+                    raise TypeError(f'{name}: only primary key relations are supported')
+                accessors.append((name, None, model._meta.get_field(field.source)))
+                continue
+            model_field = model._meta.get_field(field.source)
+            if isinstance(field, serializers.PrimaryKeyRelatedField):
+                accessor = _identity
+            elif isinstance(field, serializers.DecimalField):
+                accessor = _decimal_accessor(field)
+            elif isinstance(field, serializers.DateTimeField):
+                accessor = _datetime_accessor(field)
+            elif isinstance(field, (serializers.IntegerField, serializers.CharField, serializers.JSONField,
+                                    serializers.BooleanField, serializers.ChoiceField)):
+                accessor = _identity
+            else:
+                accessor = field.to_representation
+            columns.append(model_field.attname)
+            accessors.append((name, len(columns) - 1, accessor))
+        if model._meta.pk.attname not in columns:
+            columns.append(model._meta.pk.attname)
+        return columns, accessors, columns.index(model._meta.pk.attname)
+
+    @property
+    def plan(self):
+        if self._plan is None:
+            self._plan = self._build_plan()
+        return self._plan
+
+    def related_ids(self, queryset, field):
+        """
+        Read one many-to-many field for every row of a queryset.
+
+        :param queryset: Queryset of the rows being read
+        :param field: ManyToManyField of the model
+        :return: dict mapping row primary keys to lists of related primary keys
+        """
+        through = field.remote_field.through
+        source = field.m2m_field_name()
+        target = field.m2m_reverse_field_name()
+        related = {}
+        rows = (
+            through.objects.filter(**{f'{source}__in': queryset.order_by().values('pk')})
+            .order_by(source, target)
+            .values_list(f'{source}_id', f'{target}_id')
+        )
+        for row_id, related_id in rows.iterator(chunk_size=10000):
+            ids = related.get(row_id)
+            if ids is None:
+                related[row_id] = [related_id]
+            else:
+                ids.append(related_id)
+        return related
+
+    def read(self, queryset, fields=None):
+        """
+        Serialize every row of a queryset.
+
+        :param queryset: Queryset of the serializer's model
+        :param fields: Names of the fields to include, defaults to all of them
+        :return: list of dicts rendering like ``serializer_class(queryset, many=True).data``
+        """
+        columns, accessors, pk_index = self.plan
+        if fields is not None:
+            accessors = [accessor for accessor in accessors if accessor[0] in fields]
+            needed = {index for _, index, _ in accessors if index is not None}
+            if any(index is None for _, index, _ in accessors):
+                needed.add(pk_index)
+            position = {index: new for new, index in enumerate(sorted(needed))}
+            columns = [columns[index] for index in sorted(needed)]
+            accessors = [
+                (name, position[index] if index is not None else None, accessor) for name, index, accessor in accessors
+            ]
+            pk_index = position.get(pk_index)
+        rows = list(queryset.values_list(*columns))
+        if not rows:
+            return []
+        bound = []
+        for name, index, accessor in accessors:
+            if index is None:
+                # Many-to-many field: look the row's ids up by primary key.
+                related = self.related_ids(queryset, accessor)
+                index, accessor = pk_index, (lambda pk, related=related: related.get(pk) or [])
+            bound.append((name, index, accessor))
+        return [{name: accessor(row[index]) for name, index, accessor in bound} for row in rows]
+
+
+def participant_details(queryset, exclude=None):
+    """
+    Read the participants of every expense of a queryset with their names
+    and emails, in one query on the through table.
+
+    :param queryset: Expense or ArchivedExpense queryset
+    :param exclude: Id of a user to leave out
+    :return: dict mapping expense ids to lists of (user id, name, email) in user id order
+    """
+    field = queryset.model._meta.get_field('participants')
+    source = field.m2m_field_name()
+    rows = field.remote_field.through.objects.filter(**{f'{source}__in': queryset.order_by().values('pk')})
+    if exclude is not None:
+        rows = rows.exclude(user_id=exclude)
+    participants = {}
+    for expense_id, user_id, name, email in (
+        rows.order_by(f'{source}_id', 'user_id').values_list(f'{source}_id', 'user_id', 'user__name', 'user__email')
+    ):
+        participants.setdefault(expense_id, []).append((user_id, name, email))
+    return participants
@@ -0,0 +1,161 @@
+"""
+Materialization of recurring expense templates.
+
+``materialize`` turns every due occurrence of every active template into
+an Expense. Templates are processed in batches; each batch is one
+transaction that creates all its expenses, participant rows and ledger
+events with one bulk insert each and advances the templates' ``next_due``
+cursors, so a run interrupted between batches resumes without creating
+duplicates. The split of a template is calculated once per run and reused
+for all of its occurrences, with one ``allocate_many`` call per split
+method in the batch.
+"""
+import calendar
+import datetime
+from collections import defaultdict
+
+from django.db import transaction
+from django.utils import timezone
+
+from . import ledger, splits
+from .models import Expense, LedgerEvent, RecurringExpense
+
+
+DEFAULT_BATCH_SIZE = 500
+
+
+def _add_months(date, months):
+    month_index = date.month - 1 + months
+    year, month = date.year + month_index // 12, month_index % 12 + 1
+    return date.replace(year=year, month=month, day=min(date.day, calendar.monthrange(year, month)[1]))
+
+
+def occurrence_date(template, index):
+    """
+    Date of a template's occurrence.
+
+    :param template: RecurringExpense
+    :param index: Zero-based occurrence number
+    :return: datetime.date
+    """
+    steps = index * template.interval
+    if template.cadence == RecurringExpense.DAILY:
+        return template.start_date + datetime.timedelta(days=steps)
+    if template.cadence == RecurringExpense.WEEKLY:
+        return template.start_date + datetime.timedelta(weeks=steps)
+    if template.cadence == RecurringExpense.MONTHLY:
+        return _add_months(template.start_date, steps)
+    if template.cadence == RecurringExpense.YEARLY:
+        return _add_months(template.start_date, 12 * steps)
+    raise ValueError(f'Unknown cadence {template.cadence!r}')
+
+
+def due_occurrences(template, today):
+    """
+    Dates of the occurrences not yet materialized that are due by a day,
+    advancing the template's cursor past them (without saving it).
+
+    :param template: RecurringExpense
+    :param today: Last day to materialize
+    :return: list of datetime.date
+    """
+    dates = []
+    while template.active and template.next_due <= today:
+        if template.end_date is not None and template.next_due > template.end_date:
+            template.active = False
+            break
+        dates.append(template.next_due)
+        template.occurrence_count += 1
+        template.next_due = occurrence_date(template, template.occurrence_count)
+    return dates
+
+
+def materialize_batch(template_ids, today):
+    """
+    Materialize the due occurrences of some templates in one transaction.
+
+    :param template_ids: Ids of the templates to process
+    :param today: Last day to materialize
+    :return: Number of expenses created
+    """
+    with transaction.atomic():
+        templates = list(
+            RecurringExpense.objects.select_for_update()
+            .filter(id__in=template_ids, active=True, next_due__lte=today)
+            .prefetch_related('participants')
+        )
+        due = []
+        for template in templates:
+            dates = due_occurrences(template, today)
+            if dates:
+                due.append((template, list(template.participants.all()), dates))
+
+        # One allocation call per split method for the whole batch
+        by_method = defaultdict(list)
+        for item in due:
+            by_method[item[0].split_method].append(item)
+        split_details = {}
+        for method, items in by_method.items():
+            allocations = splits.get(method).allocate_many(
+                (template.total_amount, template.split_details, participants) for template, participants, _ in items
+            )
+            for (template, _, _), shares in zip(items, allocations):
+                split_details[template.id] = shares
+
+        expenses = []
+        participant_ids = []
+        for template, participants, dates in due:
+            members = {user.id for user in participants} | {template.created_by_id}
+            for date in dates:
+                expenses.append(Expense(
+                    recurring=template,
+                    occurrence=date,
+                    total_amount=template.total_amount,
+                    currency=template.currency,
+                    split_method=template.split_method,
+                    split_details=split_details[template.id],
+                    category=template.category,
+                    description=template.description,
+                    created_by_id=template.created_by_id,
+                    created_at=timezone.make_aware(datetime.datetime.combine(date, datetime.time())),
+                ))
+                participant_ids.append(members)
+
+        expenses = Expense.objects.bulk_create(expenses)
+        Participant = Expense.participants.through
+        Participant.objects.bulk_create(
+            Participant(expense_id=expense.id, user_id=user_id)
+            for expense, members in zip(expenses, participant_ids)
+            for user_id in members
+        )
+        if expenses:
+            ledger.record_many([
+                LedgerEvent(kind=LedgerEvent.EXPENSE_CREATED, payload={'after': ledger.expense_state(expense)}, expense_id=expense.id)
+                for expense in expenses
+            ])
+        RecurringExpense.objects.bulk_update(templates, ['next_due', 'occurrence_count', 'active'])
+    return len(expenses)
+
+
+def materialize(today=None, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Materialize every due occurrence of every active template.
+
+    Safe to re-run: occurrences already materialized are behind the
+    templates' cursors, and the (recurring, occurrence) unique constraint
+    rejects any duplicate a concurrent run might attempt.
+
+    :param today: Last day to materialize, defaults to the current date
+    :param batch_size: Templates per transaction
+    :return: Number of expenses created
+    """
+    today = today or timezone.localdate()
+    due = RecurringExpense.objects.filter(active=True, next_due__lte=today).order_by('id').values_list('id', flat=True)
+    created = 0
+    last_id = 0
+    while True:
+        ids = list(due.filter(id__gt=last_id)[:batch_size])
+        if not ids:
+            return created
+        created += materialize_batch(ids, today)
+        last_id = ids[-1]
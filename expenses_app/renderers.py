@@ -0,0 +1,66 @@
+"""
+JSON renderer for large responses.
+
+FastJSONRenderer produces the same output as DRF's JSONRenderer (compact,
+UTF-8, datetimes in ISO 8601 with ``Z`` for UTC, decimals as numbers) but
+encodes with orjson when it is installed. orjson serializes str, int,
+float, list, dict and datetime natively, so only Decimal and the rarer
+types DRF supports go through a Python fallback. Without orjson, or when
+the client asks for indented output, it falls back to JSONRenderer.
+"""
+from decimal import Decimal
+
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional dependency
+    orjson = None
+
+
+_encoder = JSONEncoder()
+
+
+def _default(obj):
+    if isinstance(obj, Decimal):
+        return float(obj)
+    return _encoder.default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    JSONRenderer using orjson when available.
+    """
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or self.ensure_ascii or not self.compact or self.get_indent(accepted_media_type, renderer_context or {}):
+            return super().render(data, accepted_media_type, renderer_context)
+        if data is None:
+            return b''
+        ret = orjson.dumps(data, default=_default, option=orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+        # Same escaping as JSONRenderer: these are valid JSON but not valid JavaScript.
+        return ret.replace('\u2028'.encode(), b'\\u2028').replace('\u2029'.encode(), b'\\u2029')
+
+
+class PassthroughRenderer(BaseRenderer):
+    """
+    Renderer for views that build their own (streaming) responses.
+
+    Listing one per export format lets DRF's content negotiation accept
+    ``?format=<name>`` for those views; it never renders the body itself.
+    """
+
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        return data
+
+    @classmethod
+    def for_format(cls, format, media_type):
+        """
+        :param format: Value of ``?format=`` to accept
+        :param media_type: Media type of the format
+        :return: PassthroughRenderer subclass
+        """
+        return type(f'{format.capitalize()}PassthroughRenderer', (cls,), {'format': format, 'media_type': media_type})
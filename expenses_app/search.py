@@ -0,0 +1,108 @@
+"""
+Full-text search over expense category and description.
+
+On SQLite an FTS5 table indexes ``Expense.category`` and
+``Expense.description``; triggers keep it in step with the expense table.
+The table and triggers are (re)created after every ``migrate`` because
+SQLite migrations that rebuild the expense table drop its triggers. Other
+databases fall back to a case-insensitive substring match.
+"""
+import re
+
+from django.db import connection
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+
+FTS_TABLE = 'expenses_app_expense_fts'
+EXPENSE_TABLE = 'expenses_app_expense'
+
+TRIGGERS = {
+    f'{FTS_TABLE}_ai': f"""
+        CREATE TRIGGER {FTS_TABLE}_ai AFTER INSERT ON {EXPENSE_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}(rowid, category, description)
+            VALUES (new.id, new.category, new.description);
+        END
+    """,
+    f'{FTS_TABLE}_ad': f"""
+        CREATE TRIGGER {FTS_TABLE}_ad AFTER DELETE ON {EXPENSE_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, category, description)
+            VALUES ('delete', old.id, old.category, old.description);
+        END
+    """,
+    f'{FTS_TABLE}_au': f"""
+        CREATE TRIGGER {FTS_TABLE}_au AFTER UPDATE OF category, description ON {EXPENSE_TABLE} BEGIN
+            INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, category, description)
+            VALUES ('delete', old.id, old.category, old.description);
+            INSERT INTO {FTS_TABLE}(rowid, category, description)
+            VALUES (new.id, new.category, new.description);
+        END
+    """,
+}
+
+_TERM = re.compile(r'\w+', re.UNICODE)
+
+
+def fts_enabled(using=connection):
+    return using.vendor == 'sqlite'
+
+
+def ensure_fts_index(using=connection):
+    """
+    Create the FTS table and triggers if missing, rebuilding the index
+    whenever a trigger had to be recreated.
+
+    :param using: Database connection
+    """
+    if not fts_enabled(using):
+        return
+    with using.cursor() as cursor:
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", [EXPENSE_TABLE])
+        if cursor.fetchone() is None:
+            return
+        cursor.execute(
+            f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+            f"category, description, content='{EXPENSE_TABLE}', content_rowid='id')"
+        )
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = %s", [EXPENSE_TABLE])
+        existing = {row[0] for row in cursor.fetchall()}
+        missing = [name for name in TRIGGERS if name not in existing]
+        for name in missing:
+            cursor.execute(TRIGGERS[name])
+        if missing:
+            cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+
+
+def fts_query(text):
+    """
+    Turn user input into an FTS5 query matching every word as a prefix.
+
+    :param text: Raw search text
+    :return: FTS5 MATCH expression, or None if the text has no words
+    """
+    terms = _TERM.findall(text)
+    if not terms:
+        return None
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_expenses(queryset, text):
+    """
+    Restrict an expense queryset to rows matching a free-text search.
+
+    Archived expenses are not in the FTS index and always use the
+    substring match.
+
+    :param queryset: Expense or ArchivedExpense queryset
+    :param text: Raw search text
+    :return: Filtered queryset
+    """
+    if fts_enabled(connection) and queryset.model._meta.db_table == EXPENSE_TABLE:
+        query = fts_query(text)
+        if query is None:
+            return queryset
+        return queryset.filter(id__in=RawSQL(f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s', [query]))
+    condition = Q()
+    for term in _TERM.findall(text):
+        condition &= Q(category__icontains=term) | Q(description__icontains=term)
+    return queryset.filter(condition)
@@ -1,7 +1,11 @@
+from django.core.exceptions import ValidationError as DjangoValidationError
 from rest_framework import serializers
-from .models import Expense, User
+from rest_framework.relations import MANY_RELATION_KWARGS
+from .models import ArchivedExpense, Expense, Payment, RecurringExpense, User
+from collections import Counter
 from decimal import Decimal
-from .utils import calculate_split, validate_split_details
+from .provisioning import provision_users
+from . import splits
 
 class UserSerializer(serializers.ModelSerializer):
     """
@@ -31,12 +35,99 @@ class UserSerializer(serializers.ModelSerializer):
         
         user = User.objects.create_user(
             email=validated_data['email'],
-            username=validated_data['email'],
             name=validated_data['name'],
             mobile=validated_data['mobile'],
             password=validated_data['password'] 
         )
         return user
+
+
+class BulkUserListSerializer(serializers.ListSerializer):
+    """
+    List serializer for bulk registration.
+
+    Email uniqueness is checked for the whole list with one query instead
+    of one per entry, and the users are created by ``provision_users``.
+    """
+
+    def validate(self, attrs):
+        emails = [User.objects.normalize_email(entry['email']) for entry in attrs]
+        repeated = sorted(email for email, count in Counter(emails).items() if count > 1)
+        if repeated:
+            raise serializers.ValidationError(f"Duplicate emails: {', '.join(repeated)}")
+        existing = sorted(User.objects.filter(email__in=emails).values_list('email', flat=True))
+        if existing:
+            raise serializers.ValidationError(f"Users already exist: {', '.join(existing)}")
+        return attrs
+
+    def create(self, validated_data):
+        created = provision_users(validated_data)
+        for user, key in created:
+            user.token = key
+        return [user for user, _ in created]
+
+
+class BulkUserSerializer(serializers.ModelSerializer):
+    """
+    Serializer for one entry of a bulk registration; responses include the
+    new user's auth token.
+    """
+
+    password = serializers.CharField(write_only=True, required=True, style={'input_type': 'password'})
+    token = serializers.CharField(read_only=True)
+
+    class Meta:
+        model = User
+        fields = ['id', 'email', 'name', 'mobile', 'password', 'token']
+        # Checked for the whole list by BulkUserListSerializer
+        extra_kwargs = {'email': {'validators': []}}
+        list_serializer_class = BulkUserListSerializer
+
+
+class BulkManyRelatedField(serializers.ManyRelatedField):
+    """
+    List of primary keys looked up with one query for the whole list
+    instead of one per key.
+    """
+
+    def to_internal_value(self, data):
+        if isinstance(data, str) or not hasattr(data, '__iter__'):
+            self.fail('not_a_list', input_type=type(data).__name__)
+        if not self.allow_empty and len(data) == 0:
+            self.fail('empty')
+        child = self.child_relation
+        queryset = child.get_queryset()
+        pks = []
+        for item in data:
+            try:
+                if isinstance(item, bool):
+                    raise TypeError
+                pks.append(queryset.model._meta.pk.to_python(item))
+            except (DjangoValidationError, TypeError):
+                child.fail('incorrect_type', data_type=type(item).__name__)
+        objects = queryset.in_bulk(set(pks))
+        for item, pk in zip(data, pks):
+            if pk not in objects:
+                child.fail('does_not_exist', pk_value=item)
+        return [objects[pk] for pk in pks]
+
+
+class BulkPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """
+    PrimaryKeyRelatedField whose ``many=True`` form is a BulkManyRelatedField.
+    """
+
+    @classmethod
+    def many_init(cls, *args, **kwargs):
+        list_kwargs = {'child_relation': cls(*args, **kwargs)}
+        list_kwargs.update((key, value) for key, value in kwargs.items() if key in MANY_RELATION_KWARGS)
+        return BulkManyRelatedField(**list_kwargs)
+
+
+# Fields the calculated split depends on
+SPLIT_FIELDS = {'split_method', 'total_amount', 'participants', 'split_details'}
+
+
 class ExpenseSerializer(serializers.ModelSerializer):
     """
     Serializer for the Expense model.
@@ -45,71 +136,56 @@ class ExpenseSerializer(serializers.ModelSerializer):
     including complex validation for different split methods.
     """
     
-    participants = serializers.PrimaryKeyRelatedField(many=True, queryset=User.objects.all())
+    participants = BulkPrimaryKeyRelatedField(many=True, queryset=User.objects.all())
     split_details = serializers.JSONField(required=False)
 
     class Meta:
         model = Expense
-        fields = ['id', 'total_amount', 'split_method', 'created_by', 'participants', 'split_details', 'category', 'created_at']
-        read_only_fields = ['created_by', 'created_at']
+        fields = ['id', 'total_amount', 'currency', 'split_method', 'created_by', 'participants', 'split_details', 'category', 'description', 'created_at', 'version']
+        read_only_fields = ['created_by', 'created_at', 'version']
+
+    def validate_currency(self, value):
+        """
+        Normalise the currency to an upper-case three-letter code.
+
+        :param value: Currency sent by the client
+        :return: Upper-case ISO 4217 code
+        """
+        if len(value) != 3 or not value.isalpha():
+            raise serializers.ValidationError("Must be a three-letter ISO 4217 code")
+        return value.upper()
 
     def validate(self, data):
         """
         Validate the expense data, particularly the split method and details.
         
-        This method performs complex validation based on the chosen split method:
+        The split method's strategy (see ``splits``) checks the details and
+        calculates the shares:
         - For 'equal' split, it calculates equal shares for all participants.
         - For 'exact' split, it ensures the sum of split amounts equals the total.
         - For 'percentage' split, it ensures percentages sum to 100 and calculates amounts.
+        - For 'shares' split, it divides the total in proportion to each user's shares.
+        - For 'adjusted' split, it adds each user's adjustment to an equal split of the rest.
         
-        It also uses external validation functions for additional checks.
+        For partial updates, fields that are not sent keep their current values;
+        the split is only recalculated when one of the fields it depends on is sent.
         
         :param data: Dictionary of input data
         :return: Validated and potentially modified data dictionary
         """
-        split_method = data['split_method']
-        total_amount = data['total_amount']
-        participants = data['participants']
-        split_details = data.get('split_details', {})
-        
-        # Validation logic for different split methods
-        if split_method == 'equal':
-            share = total_amount / len(participants)
-            split_details = {}
-            for user in participants:
-                split_details[str(user.id)] = str(share)
-            data['split_details'] = split_details
-        
-        elif split_method == 'exact':
-            if not split_details:
-                raise serializers.ValidationError("Split details are required for exact split")
-            total_split = Decimal('0')
-            for amount in split_details.values():
-                total_split += Decimal(amount)
-            if total_split != total_amount:
-                raise serializers.ValidationError("The sum of split amounts must equal the total amount")
-        
-        elif split_method == 'percentage':
-            if not split_details:
-                raise serializers.ValidationError("Split details are required for percentage split")
-            total_percentage = Decimal('0')
-            for percent in split_details.values():
-                total_percentage += Decimal(percent)
-            if total_percentage != 100:
-                raise serializers.ValidationError("The sum of percentages must equal 100")
-            split_details_updated = {}
-            for user_id, percent in split_details.items():
-                split_details_updated[user_id] = str(Decimal(percent) / 100 * total_amount)
-            data['split_details'] = split_details_updated
-        
-        # Additional validation using external functions
-        if not validate_split_details(total_amount, split_method, split_details, participants):
-            raise serializers.ValidationError("Invalid split details")
-        
-        # Calculate the final split details
-        split_details_final = calculate_split(total_amount, split_method, split_details, participants)
-        data['split_details'] = split_details_final
-        
+        if self.instance is not None and self.partial:
+            if not SPLIT_FIELDS.intersection(data):
+                return data
+            data.setdefault('split_method', self.instance.split_method)
+            data.setdefault('total_amount', self.instance.total_amount)
+            data.setdefault('participants', list(self.instance.participants.all()))
+
+        try:
+            data['split_details'] = splits.get(data['split_method']).split(
+                data['total_amount'], data.get('split_details', {}), data['participants'],
+            )
+        except splits.SplitError as exc:
+            raise serializers.ValidationError(str(exc))
         return data
 
 
@@ -127,3 +203,107 @@ class ExpenseSerializer(serializers.ModelSerializer):
         expense = Expense.objects.create(**validated_data)
         expense.participants.set(participants)
         return expense
+
+
+class ArchivedExpenseSerializer(ExpenseSerializer):
+    """
+    Read-only serializer rendering archived expenses like live ones.
+    """
+
+    class Meta(ExpenseSerializer.Meta):
+        model = ArchivedExpense
+        read_only_fields = ExpenseSerializer.Meta.fields
+
+
+class RecurringExpenseSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the RecurringExpense model.
+
+    Shares are stored as entered and validated the same way as for a single
+    expense; the split itself is calculated when occurrences are materialized.
+    """
+
+    participants = BulkPrimaryKeyRelatedField(many=True, queryset=User.objects.all())
+    split_details = serializers.JSONField(required=False)
+
+    class Meta:
+        model = RecurringExpense
+        fields = [
+            'id', 'total_amount', 'currency', 'split_method', 'created_by', 'participants', 'split_details',
+            'category', 'description', 'cadence', 'interval', 'start_date', 'end_date', 'next_due', 'active',
+        ]
+        read_only_fields = ['created_by', 'next_due']
+
+    validate_currency = ExpenseSerializer.validate_currency
+
+    def validate(self, data):
+        """
+        Validate the schedule and the shares of the template.
+
+        :param data: Dictionary of input data
+        :return: Validated data dictionary
+        """
+        if data.get('interval', 1) < 1:
+            raise serializers.ValidationError("Interval must be at least 1")
+        if data.get('end_date') and data['end_date'] < data['start_date']:
+            raise serializers.ValidationError("End date must not be before the start date")
+        if not data['participants']:
+            raise serializers.ValidationError("At least one participant is required")
+        try:
+            splits.get(data['split_method']).validate(data['total_amount'], data.get('split_details', {}), data['participants'])
+        except splits.SplitError as exc:
+            raise serializers.ValidationError(str(exc))
+        return data
+
+    def create(self, validated_data):
+        """
+        Create a template whose first occurrence is its start date.
+
+        :param validated_data: Dictionary of validated template data
+        :return: Newly created RecurringExpense instance
+        """
+        participants = validated_data.pop('participants')
+        template = RecurringExpense.objects.create(next_due=validated_data['start_date'], **validated_data)
+        template.participants.set(participants)
+        return template
+
+
+class PaymentSerializer(serializers.ModelSerializer):
+    """
+    Serializer for the Payment model.
+
+    The payer defaults to the requesting user, who must be the payer or the
+    payee of the payment they record.
+    """
+
+    payer = serializers.PrimaryKeyRelatedField(queryset=User.objects.all(), required=False)
+    payee = serializers.PrimaryKeyRelatedField(queryset=User.objects.all())
+
+    class Meta:
+        model = Payment
+        fields = ['id', 'payer', 'payee', 'amount', 'currency', 'note', 'created_by', 'created_at']
+        read_only_fields = ['created_by', 'created_at']
+
+    validate_currency = ExpenseSerializer.validate_currency
+
+    def validate_amount(self, value):
+        if value <= 0:
+            raise serializers.ValidationError("Amount must be positive")
+        return value
+
+    def validate(self, data):
+        """
+        Check that the payment is between two different users, one of them
+        the requesting user.
+
+        :param data: Dictionary of input data
+        :return: Validated data with the payer filled in
+        :raises serializers.ValidationError: If the payment is invalid
+        """
+        user = self.context['request'].user
+        data.setdefault('payer', user)
+        if data['payer'] == data['payee']:
+            raise serializers.ValidationError("The payer and the payee must be different users")
+        if user not in (data['payer'], data['payee']):
+            raise serializers.ValidationError("You can only record payments you made or received")
+        return data
@@ -0,0 +1,255 @@
+"""
+Split methods.
+
+Every way of dividing an expense between its participants is a ``Split``
+registered under the name stored in ``Expense.split_method``:
+
+* ``equal``: the total divided by the number of participants;
+* ``exact``: amounts given per user, which must add up to the total;
+* ``percentage``: percentages per user, which must add up to 100;
+* ``shares``: weights per user (e.g. 2 nights against 1), the total
+  divided in proportion and rounded to cents;
+* ``adjusted``: an equal split plus (or minus) an amount per user, e.g.
+  for someone who had an extra item.
+
+A split checks the details once in ``validate`` and computes the shares
+in ``allocate``; serializers, recurring templates and the legacy helpers
+in ``utils`` all go through ``get``, a dictionary lookup. ``allocate_many``
+splits a batch of expenses of one method in one call, so bulk writers
+pay the per-method overhead once.
+
+Participants may be given as users or ids. Shares are returned as a dict
+mapping user id strings to amount strings, as stored in
+``Expense.split_details``.
+"""
+import math
+from decimal import Decimal, InvalidOperation
+from fractions import Fraction
+
+
+CENT = Decimal('0.01')
+
+SPLITS = {}
+
+
+class SplitError(ValueError):
+    """
+    The details sent do not describe a valid split.
+    """
+
+
+def register(cls):
+    """
+    Class decorator adding a split method to the registry.
+    """
+    SPLITS[cls.name] = cls()
+    return cls
+
+
+def get(name):
+    """
+    :param name: Split method name
+    :return: The registered Split
+    :raises SplitError: If no split method has that name
+    """
+    try:
+        return SPLITS[name]
+    except KeyError:
+        raise SplitError("Invalid split method")
+
+
+def choices():
+    """
+    :return: (name, label) pairs for model and serializer choices
+    """
+    return [(name, split.label) for name, split in SPLITS.items()]
+
+
+def _user_id(participant):
+    return str(getattr(participant, 'id', participant))
+
+
+def _decimals(split_details):
+    try:
+        return {str(user_id): Decimal(value) for user_id, value in split_details.items()}
+    except (InvalidOperation, TypeError, ValueError):
+        raise SplitError("Invalid split details")
+
+
+def _apportion(total_amount, weights):
+    """
+    Divide an amount in proportion to weights, in whole cents that add up
+    to the amount. Leftover cents go to the largest remainders, ties to the
+    earliest key.
+
+    :param total_amount: Decimal with at most two decimal places
+    :param weights: dict mapping keys to non-negative weights, not all zero
+    :return: dict mapping the same keys to Decimal amounts
+    """
+    cents = int(Decimal(total_amount) / CENT)
+    total_weight = sum(Fraction(weight) for weight in weights.values())
+    exact = {key: cents * Fraction(weight) / total_weight for key, weight in weights.items()}
+    amounts = {key: math.floor(value) for key, value in exact.items()}
+    order = sorted(exact, key=lambda key: amounts[key] - exact[key])
+    for key in order[:cents - sum(amounts.values())]:
+        amounts[key] += 1
+    return {key: Decimal(amount) * CENT for key, amount in amounts.items()}
+
+
+class Split:
+    """
+    Base class for split methods.
+
+    :cvar name: Value stored in ``split_method``, at most 10 characters
+    :cvar label: Human-readable name
+    :cvar requires_details: Whether ``split_details`` must be sent
+    """
+
+    name = None
+    label = None
+    requires_details = True
+
+    def validate(self, total_amount, split_details, participants):
+        """
+        Check the details sent for an expense.
+
+        :param total_amount: Decimal total
+        :param split_details: dict sent by the client
+        :param participants: Users or ids sharing the expense
+        :raises SplitError: If the details are invalid
+        """
+        if self.requires_details and not split_details:
+            raise SplitError(f"Split details are required for {self.name} split")
+
+    def allocate(self, total_amount, split_details, participants):
+        """
+        Compute the shares of validated details.
+
+        :return: dict mapping user id strings to amount strings
+        """
+        raise NotImplementedError
+
+    def allocate_many(self, rows):
+        """
+        Compute the shares of many expenses of this method.
+
+        :param rows: Iterable of (total_amount, split_details, participants)
+        :return: list of share dicts, in the order of ``rows``
+        """
+        return [self.allocate(*row) for row in rows]
+
+    def split(self, total_amount, split_details, participants):
+        """
+        Validate the details and compute the shares.
+
+        :raises SplitError: If the details are invalid
+        """
+        self.validate(total_amount, split_details, participants)
+        return self.allocate(total_amount, split_details, participants)
+
+    def _check_members(self, split_details, participants):
+        members = {_user_id(participant) for participant in participants}
+        if not members:
+            raise SplitError("At least one participant is required")
+        if not set(map(str, split_details)) <= members:
+            raise SplitError(f"Split details of a {self.name} split must only name participants")
+
+
+@register
+class EqualSplit(Split):
+    name = 'equal'
+    label = 'Equal'
+    requires_details = False
+
+    def validate(self, total_amount, split_details, participants):
+        if not participants:
+            raise SplitError("At least one participant is required")
+
+    def allocate(self, total_amount, split_details, participants):
+        share = str(total_amount / len(participants))
+        return {_user_id(participant): share for participant in participants}
+
+    def allocate_many(self, rows):
+        # Batches tend to repeat amounts and group sizes; divide each once.
+        shares = {}
+        allocations = []
+        for total_amount, _, participants in rows:
+            key = (total_amount, len(participants))
+            if key not in shares:
+                shares[key] = str(total_amount / len(participants))
+            allocations.append({_user_id(participant): shares[key] for participant in participants})
+        return allocations
+
+
+@register
+class ExactSplit(Split):
+    name = 'exact'
+    label = 'Exact'
+
+    def validate(self, total_amount, split_details, participants):
+        super().validate(total_amount, split_details, participants)
+        if sum(_decimals(split_details).values(), Decimal('0')) != total_amount:
+            raise SplitError("The sum of split amounts must equal the total amount")
+
+    def allocate(self, total_amount, split_details, participants):
+        return split_details
+
+
+@register
+class PercentageSplit(Split):
+    name = 'percentage'
+    label = 'Percentage'
+
+    def validate(self, total_amount, split_details, participants):
+        super().validate(total_amount, split_details, participants)
+        if sum(_decimals(split_details).values(), Decimal('0')) != 100:
+            raise SplitError("The sum of percentages must equal 100")
+
+    def allocate(self, total_amount, split_details, participants):
+        return {
+            user_id: str(Decimal(percent) / 100 * total_amount)
+            for user_id, percent in split_details.items()
+        }
+
+
+@register
+class SharesSplit(Split):
+    name = 'shares'
+    label = 'Shares'
+
+    def validate(self, total_amount, split_details, participants):
+        super().validate(total_amount, split_details, participants)
+        self._check_members(split_details, participants)
+        weights = _decimals(split_details).values()
+        if any(weight < 0 for weight in weights):
+            raise SplitError("Shares must not be negative")
+        if not any(weights):
+            raise SplitError("At least one share must be positive")
+
+    def allocate(self, total_amount, split_details, participants):
+        weights = _decimals(split_details)
+        weights = {_user_id(participant): weights.get(_user_id(participant), 0) for participant in participants}
+        return {user_id: str(amount) for user_id, amount in _apportion(total_amount, weights).items()}
+
+
+@register
+class AdjustedSplit(Split):
+    name = 'adjusted'
+    label = 'Equal with adjustments'
+    requires_details = False
+
+    def validate(self, total_amount, split_details, participants):
+        self._check_members(split_details, participants)
+        adjustments = _decimals(split_details).values()
+        if any(adjustment != adjustment.quantize(CENT) for adjustment in adjustments):
+            raise SplitError("Adjustments must be whole cents")
+        if any(Decimal(amount) < 0 for amount in self.allocate(total_amount, split_details, participants).values()):
+            raise SplitError("Adjustments must not make a share negative")
+
+    def allocate(self, total_amount, split_details, participants):
+        adjustments = _decimals(split_details)
+        base = _apportion(
+            Decimal(total_amount) - sum(adjustments.values(), Decimal('0')),
+            {_user_id(participant): 1 for participant in participants},
+        )
+        return {user_id: str(amount + adjustments.get(user_id, 0)) for user_id, amount in base.items()}
@@ -0,0 +1,125 @@
+"""
+Server-Sent Events stream of balance deltas, served as a plain ASGI app.
+
+The stream bypasses Django's request handling: an idle connection is one
+coroutine waiting on its queue, with no thread or database connection
+held, so a single worker can keep thousands of clients connected.
+
+Clients authenticate with ``Authorization: Token <token>`` or, because
+browsers' EventSource cannot set headers, ``?token=<token>``. Each message
+is ``event: balance`` with a JSON body
+``{"seq", "kind", "expense_id", "currency", "delta"}`` where ``delta`` is
+the change of the user's net balance in that currency; ``event: resync`` means messages were dropped
+and the client should refetch its balances.
+"""
+import asyncio
+import json
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from rest_framework import exceptions
+
+from . import metrics
+from .authentication import user_id_for_token
+from .pubsub import hub
+
+
+SSE_PATH = '/api/stream/balances/'
+
+SSE_CONNECTIONS = metrics.registry.counter(
+    'sse_connections_total',
+    'SSE connections accepted or rejected, by result.',
+    ('result',),
+)
+
+
+def _token_from_scope(scope):
+    for name, value in scope.get('headers', []):
+        if name == b'authorization':
+            parts = value.decode('latin-1').split()
+            if len(parts) == 2 and parts[0].lower() == 'token':
+                return parts[1]
+    query = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+    return query.get('token', [None])[0]
+
+
+def _format(message):
+    """
+    Encode one SSE message.
+
+    :param message: dict with an ``event`` key and optional data
+    :return: bytes ready to send
+    """
+    data = {key: value for key, value in message.items() if key != 'event'}
+    return f"event: {message['event']}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode()
+
+
+async def _respond(send, status, body):
+    await send({'type': 'http.response.start', 'status': status, 'headers': [(b'content-type', b'application/json')]})
+    await send({'type': 'http.response.body', 'body': json.dumps(body).encode()})
+
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def balance_stream(scope, receive, send):
+    """
+    ASGI application streaming the authenticated user's balance deltas.
+
+    :param scope: ASGI connection scope
+    :param receive: ASGI receive callable
+    :param send: ASGI send callable
+    """
+    if scope['method'] != 'GET':
+        await _respond(send, 405, {'detail': 'Method not allowed.'})
+        return
+    token = _token_from_scope(scope)
+    if not token:
+        SSE_CONNECTIONS.inc('rejected')
+        await _respond(send, 401, {'detail': 'Authentication credentials were not provided.'})
+        return
+    try:
+        user_id = await sync_to_async(user_id_for_token)(token)
+    except exceptions.AuthenticationFailed as exc:
+        SSE_CONNECTIONS.inc('rejected')
+        await _respond(send, 401, {'detail': str(exc.detail)})
+        return
+
+    SSE_CONNECTIONS.inc('accepted')
+    subscription = hub.subscribe(user_id)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({
+            'type': 'http.response.start',
+            'status': 200,
+            'headers': [
+                (b'content-type', b'text/event-stream'),
+                (b'cache-control', b'no-cache'),
+                (b'x-accel-buffering', b'no'),
+            ],
+        })
+        await send({'type': 'http.response.body', 'body': b'retry: 5000\n\n' + _format({'event': 'ready'}), 'more_body': True})
+        while True:
+            message = asyncio.ensure_future(subscription.queue.get())
+            done, _ = await asyncio.wait(
+                {message, disconnected},
+                timeout=settings.SSE_HEARTBEAT_SECONDS,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+            if message in done:
+                body = _format(message.result())
+            else:
+                message.cancel()
+                if disconnected in done:
+                    break
+                body = b': keepalive\n\n'
+            await send({'type': 'http.response.body', 'body': body, 'more_body': True})
+    except OSError:
+        # The client went away mid-write.
+        pass
+    finally:
+        hub.unsubscribe(subscription)
+        disconnected.cancel()
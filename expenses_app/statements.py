@@ -0,0 +1,228 @@
+"""
+Per-user statements with running balances.
+
+A statement lists every expense a user created or takes part in, oldest
+first, with what the user paid, their share and the effect on their
+balance (paid minus share). The running balance is a SQL window sum over
+those effects, partitioned by currency.
+
+Pages are cut with a signed cursor holding the position of the last row
+and the balances after it. The next page's query starts after that
+position and adds the carried balances to its own window sums, so no page
+reads the rows before it. A ``date_from`` without a cursor is handled the
+same way, with the opening balances taken from one aggregate over the
+earlier rows. Balances carried forward from archived expenses open the
+statement.
+"""
+import datetime
+from decimal import Decimal
+
+from django.core import signing
+from django.db.models import Case, DecimalField, F, Func, Q, Sum, TextField, Value, When, Window
+from django.db.models.functions import Cast, Coalesce
+from django.utils.dateparse import parse_datetime
+from rest_framework import serializers
+
+from .filters import _start_of_day
+from .models import Expense, OpeningBalance
+
+
+CURSOR_SALT = 'expenses_app.statements.cursor'
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+AMOUNT = DecimalField(max_digits=20, decimal_places=6)
+ZERO = Decimal('0')
+
+
+class StatementParamsSerializer(serializers.Serializer):
+    """
+    Serializer validating the statement query parameters.
+
+    - ``date_from`` / ``date_to``: inclusive range of creation dates
+    - ``page_size``: rows per page
+    - ``cursor``: value of ``next`` from the previous page
+    """
+
+    date_from = serializers.DateField(required=False)
+    date_to = serializers.DateField(required=False)
+    page_size = serializers.IntegerField(required=False, min_value=1, max_value=MAX_PAGE_SIZE, default=DEFAULT_PAGE_SIZE)
+    cursor = serializers.CharField(required=False)
+
+    def validate(self, data):
+        if 'date_from' in data and 'date_to' in data and data['date_from'] > data['date_to']:
+            raise serializers.ValidationError("date_from must not be after date_to")
+        return data
+
+
+def encode_cursor(user_id, data, created_at, expense_id, balances):
+    """
+    Sign the position and balances after the last row of a page.
+
+    :param user_id: Owner of the statement
+    :param data: Validated query parameters of the page
+    :param created_at: Creation time of the last row
+    :param expense_id: Id of the last row
+    :param balances: dict mapping currencies to running balances
+    :return: Cursor string
+    """
+    return signing.dumps({
+        'user': user_id,
+        'from': data['date_from'].isoformat() if 'date_from' in data else None,
+        'to': data['date_to'].isoformat() if 'date_to' in data else None,
+        'at': created_at.isoformat(),
+        'id': expense_id,
+        'balances': {currency: str(balance) for currency, balance in balances.items()},
+    }, salt=CURSOR_SALT, compress=True)
+
+
+def decode_cursor(cursor, user_id, data):
+    """
+    Verify a cursor against the user and the date range of the request.
+
+    :return: (created_at, expense id, balances)
+    :raises ValidationError: If the cursor is forged or belongs to another query
+    """
+    try:
+        payload = signing.loads(cursor, salt=CURSOR_SALT)
+    except signing.BadSignature:
+        raise serializers.ValidationError({'cursor': 'Invalid cursor.'})
+    expected = (
+        user_id,
+        data['date_from'].isoformat() if 'date_from' in data else None,
+        data['date_to'].isoformat() if 'date_to' in data else None,
+    )
+    if (payload['user'], payload['from'], payload['to']) != expected:
+        raise serializers.ValidationError({'cursor': 'The cursor belongs to a different statement.'})
+    balances = {currency: Decimal(balance) for currency, balance in payload['balances'].items()}
+    return parse_datetime(payload['at']), payload['id'], balances
+
+
+class JSONMember(Func):
+    """
+    Text value of one member of a JSON object column.
+
+    KeyTextTransform compiles all-digit keys such as user ids into array
+    indexes, so the member path is built here with the key quoted.
+    """
+
+    output_field = TextField()
+
+    def __init__(self, expression, key):
+        super().__init__(expression, Value(f'$."{key}"'))
+        self.key = key
+
+    def as_sql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template='JSON_UNQUOTE(JSON_EXTRACT(%(expressions)s))', **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template='JSON_EXTRACT(%(expressions)s)', **extra_context)
+
+    def as_postgresql(self, compiler, connection, **extra_context):
+        clone = self.copy()
+        clone.set_source_expressions([self.get_source_expressions()[0], Value(str(self.key))])
+        return super(JSONMember, clone).as_sql(compiler, connection, template='(%(expressions)s)', arg_joiner=' ->> ', **extra_context)
+
+
+def statement_rows(user_id):
+    """
+    Expenses of a user annotated with the user's paid amount, share and
+    balance change.
+
+    :param user_id: Owner of the statement
+    :return: Expense queryset
+    """
+    participating = Expense.participants.through.objects.filter(user_id=user_id).values('expense_id')
+    share = Coalesce(Cast(JSONMember('split_details', user_id), AMOUNT), Value(ZERO), output_field=AMOUNT)
+    paid = Case(When(created_by_id=user_id, then=F('total_amount')), default=Value(ZERO), output_field=AMOUNT)
+    return (
+        Expense.objects.filter(Q(created_by_id=user_id) | Q(id__in=participating))
+        .annotate(paid=paid, share=share)
+        .annotate(change=F('paid') - F('share'))
+    )
+
+
+def archived_balances(user_id):
+    """
+    Balance per currency carried forward from archived expenses.
+
+    :param user_id: Owner of the statement
+    :return: dict mapping currencies to balances
+    """
+    totals = (
+        OpeningBalance.objects.filter(user_id=user_id).order_by()
+        .values('currency').annotate(total=Sum(F('paid') - F('owed')))
+    )
+    return {row['currency']: row['total'] for row in totals}
+
+
+def opening_balances(rows, before, user_id):
+    """
+    Balance per currency over every row created before a time, including
+    archived expenses.
+
+    :param rows: Queryset from ``statement_rows``
+    :param before: Aware datetime
+    :param user_id: Owner of the statement
+    :return: dict mapping currencies to balances
+    """
+    balances = archived_balances(user_id)
+    totals = rows.filter(created_at__lt=before).order_by().values('currency').annotate(total=Sum('change'))
+    for row in totals:
+        balances[row['currency']] = balances.get(row['currency'], ZERO) + row['total']
+    return balances
+
+
+def statement_page(user_id, data):
+    """
+    Build one page of a user's statement.
+
+    :param user_id: Owner of the statement
+    :param data: Validated StatementParamsSerializer data
+    :return: (list of row dicts, cursor for the next page or None)
+    """
+    rows = statement_rows(user_id)
+    if 'date_to' in data:
+        rows = rows.filter(created_at__lt=_start_of_day(data['date_to'] + datetime.timedelta(days=1)))
+
+    if data.get('cursor'):
+        created_at, expense_id, carried = decode_cursor(data['cursor'], user_id, data)
+        page = rows.filter(Q(created_at__gt=created_at) | Q(created_at=created_at, id__gt=expense_id))
+    elif 'date_from' in data:
+        start = _start_of_day(data['date_from'])
+        carried = opening_balances(rows, start, user_id)
+        page = rows.filter(created_at__gte=start)
+    else:
+        carried = archived_balances(user_id)
+        page = rows
+
+    order = [F('created_at').asc(), F('id').asc()]
+    page = page.annotate(
+        window_balance=Window(Sum('change'), partition_by=[F('currency')], order_by=order),
+    ).order_by(*order)
+    size = data['page_size']
+    fetched = list(page.values(
+        'id', 'created_at', 'category', 'description', 'currency', 'total_amount', 'paid', 'share', 'change', 'window_balance',
+    )[:size + 1])
+
+    results = []
+    balances = dict(carried)
+    for row in fetched[:size]:
+        balance = carried.get(row['currency'], ZERO) + row['window_balance']
+        balances[row['currency']] = balance
+        results.append({
+            'expense_id': row['id'],
+            'created_at': row['created_at'],
+            'category': row['category'],
+            'description': row['description'],
+            'currency': row['currency'],
+            'total_amount': f"{row['total_amount']:.2f}",
+            'paid': str(row['paid']),
+            'share': str(row['share']),
+            'change': str(row['change']),
+            'balance': str(balance),
+        })
+    cursor = None
+    if len(fetched) > size:
+        last = fetched[size - 1]
+        cursor = encode_cursor(user_id, data, last['created_at'], last['id'], balances)
+    return results, cursor
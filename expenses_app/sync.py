@@ -0,0 +1,127 @@
+"""
+Incremental sync for clients that keep a local copy of a user's data.
+
+Every ledger event writes a UserChange row per affected user (see
+``ledger``), numbered with the event id. A client stores the opaque token
+returned by each sync and sends it back with ``?since=``; the next sync
+reads that user's changes after it from the (user, seq) index, so it costs
+as much as the changes made since, not the user's history. A token can
+hold the highest seq seen because events, and their UserChange rows,
+become visible in id order (see ``ledger``).
+
+A sync returns:
+
+* ``expenses``: the current state of every changed expense the user still
+  takes part in, participants included;
+* ``removed``: ids of changed expenses that were deleted or no longer
+  include the user;
+* ``balances``: the change to the user's net balance (paid minus owed)
+  per currency, payments included;
+* ``token``: the token for the next sync, and ``more`` when only part of
+  the changes fit in this response.
+
+Without a token (or with ``reset`` in the response) the client replaces its
+copy: every expense of the user is returned and ``balances`` holds the
+full balances. These are read at the balance projection's checkpoint, and
+the token starts there, so changes after it are applied exactly once.
+"""
+from decimal import Decimal
+
+from django.core import signing
+from django.db import transaction
+from django.db.models import Q
+from rest_framework import serializers
+
+from .models import Expense, ProjectionCheckpoint, UserBalance, UserChange
+from .projections import BalanceProjection
+from .readers import ValuesReader
+from .serializers import ExpenseSerializer
+
+
+TOKEN_SALT = 'expenses_app.sync.token'
+MAX_CHANGES = 1000
+ZERO = Decimal('0')
+
+reader = ValuesReader(ExpenseSerializer)
+
+
+def encode_token(user_id, seq):
+    return signing.dumps({'user': user_id, 'seq': seq}, salt=TOKEN_SALT)
+
+
+def decode_token(token, user_id):
+    """
+    :return: Sequence number the token was issued at
+    :raises ValidationError: If the token is forged or belongs to another user
+    """
+    try:
+        payload = signing.loads(token, salt=TOKEN_SALT)
+    except signing.BadSignature:
+        raise serializers.ValidationError({'since': 'Invalid sync token.'})
+    if payload['user'] != user_id:
+        raise serializers.ValidationError({'since': 'The sync token belongs to another user.'})
+    return payload['seq']
+
+
+def _expenses(user_id):
+    Participant = Expense.participants.through
+    taking_part = Participant.objects.filter(user_id=user_id).values('expense_id')
+    return Expense.objects.filter(Q(created_by=user_id) | Q(id__in=taking_part)).order_by('id')
+
+
+def full_sync(user_id):
+    """
+    Everything a client needs to start over.
+
+    :param user_id: Syncing user
+    :return: Response dict
+    """
+    with transaction.atomic():
+        seq = (
+            ProjectionCheckpoint.objects.filter(name=BalanceProjection.name)
+            .values_list('offset', flat=True).first()
+        ) or 0
+        balances = {
+            row.currency: str(row.net)
+            for row in UserBalance.objects.filter(user_id=user_id).order_by('currency')
+        }
+    return {
+        'reset': True,
+        'expenses': reader.read(_expenses(user_id)),
+        'removed': [],
+        'balances': balances,
+        'token': encode_token(user_id, seq),
+        'more': False,
+    }
+
+
+def changes_since(user_id, seq, limit=MAX_CHANGES):
+    """
+    The user's changes after a sequence number.
+
+    :param user_id: Syncing user
+    :param seq: Last sequence number the client has seen
+    :param limit: Most changes read at once; the client syncs again while ``more``
+    :return: Response dict
+    """
+    changes = list(
+        UserChange.objects.filter(user_id=user_id, seq__gt=seq).order_by('seq')
+        .values_list('seq', 'expense_id', 'balance')[:limit + 1]
+    )
+    more = len(changes) > limit
+    changes = changes[:limit]
+
+    balances = {}
+    for _, _, balance in changes:
+        for currency, delta in balance.items():
+            balances[currency] = balances.get(currency, ZERO) + Decimal(delta)
+    changed = {expense_id for _, expense_id, _ in changes if expense_id is not None}
+    expenses = reader.read(_expenses(user_id).filter(id__in=changed)) if changed else []
+    return {
+        'reset': False,
+        'expenses': expenses,
+        'removed': sorted(changed - {expense['id'] for expense in expenses}),
+        'balances': {currency: str(delta) for currency, delta in sorted(balances.items()) if delta},
+        'token': encode_token(user_id, changes[-1][0] if changes else seq),
+        'more': more,
+    }
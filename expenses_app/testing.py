@@ -0,0 +1,129 @@
+"""
+Query budgets for tests.
+
+``query_budget`` wraps a block of test code, or a whole test method, and
+records every query it runs together with the stack that issued it. On
+exit the test fails if:
+
+* more queries ran than the budget allows. The budget is a number, or a
+  function of the data size the test passes as ``size``, e.g.
+  ``lambda n: 5 + n // 1000`` for a view reading in chunks of 1000;
+* one query shape ran more than ``max_repeats`` times. A shape is the SQL
+  with literals, parameters and ``IN`` lists reduced to placeholders, so a
+  query issued once per row (N+1) shows up as one shape repeated N times.
+
+Failures list the offending queries with the application frames of the
+stacks that issued them, so the loop is easy to find. Savepoint
+statements are transaction bookkeeping and are not counted.
+"""
+import os
+import re
+import traceback
+from collections import defaultdict
+from contextlib import ContextDecorator
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+DEFAULT_MAX_REPEATS = 3
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r'(?<![\w"])-?\d+(?:\.\d+)?\b')
+_PLACEHOLDERS = re.compile(r'\?(?:\s*,\s*\?)+')
+_SAVEPOINT = re.compile(r'^\s*(SAVEPOINT|RELEASE SAVEPOINT|ROLLBACK TO SAVEPOINT)\b', re.IGNORECASE)
+
+
+def query_shape(sql):
+    """
+    SQL with every literal and parameter replaced by ``?`` and lists of
+    them collapsed, so queries differing only in values compare equal.
+    """
+    sql = _STRING.sub('?', sql)
+    sql = _NUMBER.sub('?', sql.replace('%s', '?'))
+    return _PLACEHOLDERS.sub('?, ...', sql)
+
+
+def _app_stack():
+    """
+    The frames of the current stack that belong to the project, outermost
+    first, without Django, DRF or this module.
+    """
+    base = str(settings.BASE_DIR)
+    return [
+        frame for frame in traceback.extract_stack()
+        # Packages only: scripts such as manage.py sit directly in BASE_DIR
+        if frame.filename.startswith(base) and os.path.dirname(frame.filename) != base
+        and frame.filename != __file__ and 'site-packages' not in frame.filename
+    ]
+
+
+class _QueryRecorder:
+    """
+    Database execute wrapper keeping each query with the stack that issued it.
+    """
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        if not _SAVEPOINT.match(sql):
+            self.queries.append((sql, _app_stack()))
+        return execute(sql, params, many, context)
+
+
+class query_budget(ContextDecorator):
+    """
+    Fail the test if a block runs more queries than budgeted or repeats a
+    query shape.
+
+    :param limit: Maximum number of queries, or a function of ``size`` returning it
+    :param size: Size of the data the block works on, passed to ``limit``
+    :param max_repeats: Most times one query shape may run
+    :param using: Database alias to watch
+    """
+
+    def __init__(self, limit, size=None, max_repeats=DEFAULT_MAX_REPEATS, using=DEFAULT_DB_ALIAS):
+        self.limit = limit
+        self.size = size
+        self.max_repeats = max_repeats
+        self.using = using
+
+    @property
+    def budget(self):
+        return self.limit(self.size) if callable(self.limit) else self.limit
+
+    def __enter__(self):
+        self.recorder = _QueryRecorder()
+        self._wrapper = connections[self.using].execute_wrapper(self.recorder)
+        self._wrapper.__enter__()
+        return self
+
+    @property
+    def queries(self):
+        """
+        (sql, application stack) of every query run so far
+        """
+        return self.recorder.queries
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self._wrapper.__exit__(exc_type, exc_value, tb)
+        if exc_type is not None:
+            return False
+        problems = []
+        if len(self.queries) > self.budget:
+            problems.append(f'{len(self.queries)} queries ran, the budget is {self.budget}:')
+            problems.extend(f'  {index}. {sql}' for index, (sql, _) in enumerate(self.queries, 1))
+        shapes = defaultdict(list)
+        for sql, stack in self.queries:
+            shapes[query_shape(sql)].append(stack)
+        for shape, stacks in shapes.items():
+            if len(stacks) > self.max_repeats:
+                problems.append(f'Query repeated {len(stacks)} times (at most {self.max_repeats} allowed), likely N+1:')
+                problems.append(f'  {shape}')
+                for stack in stacks[:2]:
+                    problems.append('  issued from:')
+                    problems.extend('    ' + line for line in ''.join(traceback.format_list(stack)).splitlines())
+        if problems:
+            raise AssertionError('\n'.join(problems))
+        return False
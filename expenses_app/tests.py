@@ -6,6 +6,7 @@ from decimal import Decimal
 from .models import Expense
 from .serializers import ExpenseSerializer
 import json
+from io import StringIO
 
 User = get_user_model()
 
@@ -111,4 +112,1917 @@ class ViewTests(TestCase):
 
         res = self.client.get('/api/balance-sheet/')
         self.assertEqual(res.status_code, status.HTTP_200_OK)
-        self.assertEqual(res['Content-Type'], 'text/csv')
\ No newline at end of file
+        self.assertEqual(res['Content-Type'], 'text/csv')
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.client.force_authenticate(user=self.user)
+
+    def test_metrics_endpoint_reports_views(self):
+        """Test that requests are counted per URL name and exported"""
+        from .metrics import REQUESTS, EXPENSE_SPLIT_SIZE
+        before = REQUESTS.value('expense-create', 'POST', '201')
+        splits_before = EXPENSE_SPLIT_SIZE.count()
+        payload = {
+            'total_amount': '100.00',
+            'split_method': 'equal',
+            'category': 'Food',
+            'participants': [self.user.id],
+        }
+        self.client.post('/api/expenses/', payload, format='json')
+        self.assertEqual(REQUESTS.value('expense-create', 'POST', '201'), before + 1)
+        self.assertEqual(EXPENSE_SPLIT_SIZE.count(), splits_before + 1)
+
+        res = APIClient().get('/metrics')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        body = res.content.decode()
+        self.assertIn('http_requests_total{view="expense-create",method="POST",status="201"}', body)
+        self.assertIn('http_request_duration_seconds_bucket{view="expense-create",le="+Inf"}', body)
+        self.assertIn('# TYPE db_queries_total counter', body)
+
+    def test_registry_merges_thread_shards(self):
+        """Test that values recorded on different threads are summed on scrape"""
+        import threading
+        from .metrics import MetricsRegistry
+        registry = MetricsRegistry()
+        counter = registry.counter('jobs_total', 'Jobs.', ('kind',))
+        histogram = registry.histogram('job_seconds', 'Job time.', buckets=(1, 5))
+
+        def work():
+            for _ in range(100):
+                counter.inc('a')
+                histogram.observe(2)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(counter.value('a'), 400)
+        text = registry.render()
+        self.assertIn('jobs_total{kind="a"} 400', text)
+        self.assertIn('job_seconds_bucket{le="1"} 0', text)
+        self.assertIn('job_seconds_bucket{le="5"} 400', text)
+        self.assertIn('job_seconds_count 400', text)
+
+
+class ProfilerTests(TestCase):
+    def setUp(self):
+        import tempfile
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.client.force_authenticate(user=self.user)
+        self.dump_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dump_dir, ignore_errors=True)
+
+    def test_signed_header_writes_dumps(self):
+        """Test that a signed header profiles the request and writes both dump files"""
+        import os
+        from .profiling import make_profile_token
+        with self.settings(PROFILER_DIR=self.dump_dir, PROFILER_SAMPLE_INTERVAL=0.001):
+            res = self.client.get('/api/expenses/user/', HTTP_X_PROFILE_TOKEN=make_profile_token())
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        stem = os.path.join(self.dump_dir, res['X-Profile'])
+        self.assertTrue(os.path.exists(stem + '.prof'))
+        with open(stem + '.collapsed') as handle:
+            lines = handle.read().splitlines()
+        self.assertTrue(lines)
+        self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in lines))
+
+    def test_query_param_requires_staff(self):
+        """Test that ?profile=1 is ignored for non-staff users and invalid headers"""
+        import os
+        with self.settings(PROFILER_DIR=self.dump_dir):
+            res = self.client.get('/api/expenses/user/?profile=1', HTTP_X_PROFILE_TOKEN='forged')
+            self.assertNotIn('X-Profile', res)
+            res = self.client.get('/api/expenses/user/?profile=1')
+            self.assertNotIn('X-Profile', res)
+            self.user.is_staff = True
+            self.user.save()
+            self.client.force_login(self.user)
+            res = self.client.get('/api/expenses/user/?profile=1')
+            self.assertIn('X-Profile', res)
+        self.assertEqual(len([name for name in os.listdir(self.dump_dir) if name.endswith('.prof')]), 1)
+
+    def test_rotate_keeps_newest_dumps(self):
+        """Test that rotation removes the oldest dumps with their companion files"""
+        import os
+        from .profiling import rotate_dumps
+        for index in range(4):
+            for suffix in ('.prof', '.collapsed'):
+                path = os.path.join(self.dump_dir, f'dump{index}{suffix}')
+                open(path, 'w').close()
+                os.utime(path, (index, index))
+        rotate_dumps(self.dump_dir, keep=2)
+        self.assertEqual(sorted(os.listdir(self.dump_dir)), ['dump2.collapsed', 'dump2.prof', 'dump3.collapsed', 'dump3.prof'])
+
+
+class SignedTokenTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+
+    def login(self, **extra):
+        res = self.client.post('/api/login/', {'email': 'test@example.com', 'password': 'testpass123', **extra}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return res.data['token']
+
+    def test_signed_token_authenticates_without_queries(self):
+        """Test that a signed token is verified without touching the database once cached"""
+        token = self.login(token_type='signed')
+        self.assertTrue(token.startswith('s1.'))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        self.client.get('/api/expenses/user/')
+        with self.assertNumQueries(1):
+            res = self.client.get('/api/expenses/user/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_key_tokens_keep_working(self):
+        """Test that stored authtoken keys are still accepted"""
+        token = self.login()
+        self.assertFalse(token.startswith('s1.'))
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        res = self.client.get('/api/expenses/user/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_tampered_and_expired_tokens_are_rejected(self):
+        """Test that forged or expired signed tokens fail authentication"""
+        from .authentication import issue_signed_token
+        token = issue_signed_token(self.user)
+        prefix, user_id, version, expires, signature = token.split('.')
+        forged = '.'.join([prefix, str(int(user_id) + 1), version, expires, signature])
+        for bad in (forged, issue_signed_token(self.user, ttl=-1)):
+            self.client.credentials(HTTP_AUTHORIZATION=f'Token {bad}')
+            res = self.client.get('/api/expenses/user/')
+            self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    def test_revoke_invalidates_issued_tokens(self):
+        """Test that revoking bumps the version and rejects older tokens"""
+        token = self.login(token_type='signed')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        res = self.client.post('/api/tokens/revoke/')
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        res = self.client.get('/api/expenses/user/')
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        self.client.credentials()
+        token = self.login(token_type='signed')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        res = self.client.get('/api/expenses/user/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+
+    def test_deactivation_rejects_signed_tokens(self):
+        """Test that deactivating a user rejects their signed tokens, even on views not loading the user"""
+        from django.core.cache import cache
+        token = self.login(token_type='signed')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        self.assertEqual(self.client.get('/api/expenses/user/').status_code, status.HTTP_200_OK)
+
+        self.user.is_active = False
+        self.user.save()
+        res = self.client.get('/api/expenses/user/')
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # A bulk update skips the signals; the version lookup still sees it
+        self.user.is_active = True
+        self.user.save()
+        self.client.credentials()
+        token = self.login(token_type='signed')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {token}')
+        User.objects.filter(pk=self.user.pk).update(is_active=False)
+        cache.clear()
+        res = self.client.get('/api/expenses/user/')
+        self.assertEqual(res.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class BackupTests(TestCase):
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.expense = self.make_expense('100.00')
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_expense(self, amount):
+        expense = Expense.objects.create(
+            total_amount=Decimal(amount),
+            split_method='exact',
+            created_by=self.user,
+            category='Food',
+            split_details={str(self.user.id): amount, str(self.other.id): '0.00'}
+        )
+        expense.participants.add(self.user, self.other)
+        return expense
+
+    def test_full_backup_round_trip(self):
+        """Test that a restored backup reproduces users, expenses, participants and tokens"""
+        import os
+        from django.core.management import call_command
+        from rest_framework.authtoken.models import Token
+        token = Token.objects.create(user=self.user)
+        path = os.path.join(self.tmp, 'full.jsonl.gz')
+        call_command('backup', path, '--chunk-size', '1', stdout=StringIO())
+
+        Token.objects.all().delete()
+        Expense.objects.all().delete()
+        User.objects.all().delete()
+        call_command('restore', path, '--chunk-size', '1', stdout=StringIO())
+
+        restored = Expense.objects.get(id=self.expense.id)
+        self.assertEqual(restored.total_amount, Decimal('100.00'))
+        self.assertEqual(restored.split_details, self.expense.split_details)
+        self.assertEqual(restored.created_at, self.expense.created_at)
+        self.assertEqual(set(restored.participants.values_list('id', flat=True)), {self.user.id, self.other.id})
+        self.assertTrue(User.objects.get(id=self.user.id).check_password('testpass123'))
+        self.assertEqual(Token.objects.get(user=self.user).key, token.key)
+
+    def test_incremental_backup_contains_only_new_rows(self):
+        """Test that an incremental backup holds only rows added since the previous one"""
+        import os
+        from django.test import override_settings
+        from .backup import dump, load, read_header
+        full = os.path.join(self.tmp, 'full.jsonl.gz')
+        dump(full)
+        newer = self.make_expense('50.00')
+        incremental = os.path.join(self.tmp, 'inc.jsonl.gz')
+        with override_settings(BACKUP_CURSOR_OVERLAP=0):
+            counts = dump(incremental, since=read_header(full))
+        self.assertEqual(counts['user'], 0)
+        self.assertEqual(counts['expense'], 1)
+        self.assertEqual(counts['expense_participant'], 2)
+
+        Expense.objects.all().delete()
+        load(full)
+        load(incremental)
+        load(incremental)
+        self.assertEqual(set(Expense.objects.values_list('id', flat=True)), {self.expense.id, newer.id})
+
+    def test_incremental_backup_replays_edits_and_deletes(self):
+        """Test that edits, participant changes and deletes since the previous backup are restored"""
+        import os
+        from django.db import transaction
+        from . import ledger
+        from .backup import dump, load, read_header
+        gone = self.make_expense('30.00')
+        full = os.path.join(self.tmp, 'full.jsonl.gz')
+        dump(full)
+
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            before = ledger.expense_state(self.expense)
+            self.expense.total_amount = Decimal('80.00')
+            self.expense.split_details = {str(self.user.id): '80.00'}
+            self.expense.version += 1
+            self.expense.save()
+            self.expense.participants.set([self.user])
+            ledger.record_expense_edited(before, self.expense)
+            before = ledger.expense_state(gone)
+            gone_id = gone.id
+            gone.delete()
+            ledger.record_expense_deleted(before, gone_id)
+        incremental = os.path.join(self.tmp, 'inc.jsonl.gz')
+        counts = dump(incremental, since=read_header(full))
+        self.assertEqual((counts['expense'], counts['expense deletes']), (1, 1))
+
+        Expense.objects.all().delete()
+        load(full)
+        load(incremental)
+        restored = Expense.objects.get()
+        self.assertEqual((restored.id, restored.total_amount, restored.version), (self.expense.id, Decimal('80.00'), 2))
+        self.assertEqual(list(restored.participants.values_list('id', flat=True)), [self.user.id])
+
+    def test_incremental_backup_replays_user_changes_and_revoked_tokens(self):
+        """Test that deactivations, password changes and deleted tokens since a full backup are restored"""
+        import os
+        from rest_framework.authtoken.models import Token
+        from .backup import dump, load, read_header
+        from .models import Tombstone
+        revoked = Token.objects.create(user=self.user).key
+        full = os.path.join(self.tmp, 'full.jsonl.gz')
+        dump(full)
+        self.other.is_active = False
+        self.other.save()
+        self.user.set_password('newpass456')
+        self.user.save()
+        Token.objects.filter(key=revoked).delete()
+        incremental = os.path.join(self.tmp, 'inc.jsonl.gz')
+        counts = dump(incremental, since=read_header(full))
+        self.assertEqual((counts['user'], counts['token deletes']), (2, 1))
+
+        Token.objects.all().delete()
+        Expense.objects.all().delete()
+        User.objects.all().delete()
+        Tombstone.objects.all().delete()
+        load(full)
+        self.assertTrue(Token.objects.filter(key=revoked).exists())
+        load(incremental)
+        self.assertFalse(User.objects.get(id=self.other.id).is_active)
+        self.assertTrue(User.objects.get(id=self.user.id).check_password('newpass456'))
+        self.assertFalse(Token.objects.filter(key=revoked).exists())
+
+    def test_compaction_keeps_events_since_the_latest_backup(self):
+        """Test that compacting the ledger between two backups keeps the edits the incremental one needs"""
+        import os
+        from django.db import transaction
+        from . import ledger, projections
+        from .backup import dump, load, read_header
+        from .models import LedgerEvent
+        full = os.path.join(self.tmp, 'full.jsonl.gz')
+        dump(full)
+        with transaction.atomic():
+            before = ledger.expense_state(self.expense)
+            self.expense.total_amount = Decimal('80.00')
+            self.expense.split_details = {str(self.user.id): '40.00', str(self.other.id): '40.00'}
+            self.expense.save()
+            ledger.record_expense_edited(before, self.expense)
+        for name in projections.PROJECTIONS:
+            projections.take_snapshot(name)
+        projections.compact()
+        self.assertTrue(LedgerEvent.objects.filter(kind=LedgerEvent.EXPENSE_EDITED).exists())
+
+        incremental = os.path.join(self.tmp, 'inc.jsonl.gz')
+        self.assertEqual(dump(incremental, since=read_header(full))['expense'], 1)
+        Expense.objects.all().delete()
+        load(full)
+        load(incremental)
+        self.assertEqual(Expense.objects.get().total_amount, Decimal('80.00'))
+
+        # Once a backup has read the edit, compaction may drop it
+        dump(os.path.join(self.tmp, 'next.jsonl.gz'), since=read_header(incremental))
+        for name in projections.PROJECTIONS:
+            projections.take_snapshot(name)
+        projections.compact()
+        self.assertFalse(LedgerEvent.objects.filter(kind=LedgerEvent.EXPENSE_EDITED).exists())
+
+    def test_incremental_backup_records_archiving(self):
+        """Test that expenses archived after a full backup are not restored as live expenses too"""
+        import datetime
+        import os
+        from django.utils import timezone
+        from .archive import archive
+        from .backup import dump, load, read_header
+        from .models import ArchivedExpense, OpeningBalance
+        full = os.path.join(self.tmp, 'full.jsonl.gz')
+        dump(full)
+        Expense.objects.filter(id=self.expense.id).update(created_at=timezone.now() - datetime.timedelta(days=400))
+        self.assertEqual(archive(timezone.now() - datetime.timedelta(days=30)), 1)
+        incremental = os.path.join(self.tmp, 'inc.jsonl.gz')
+        self.assertEqual(dump(incremental, since=read_header(full))['expense deletes'], 1)
+
+        Expense.objects.all().delete()
+        ArchivedExpense.objects.all().delete()
+        OpeningBalance.objects.all().delete()
+        load(full)
+        load(incremental)
+        self.assertFalse(Expense.objects.exists())
+        self.assertEqual(list(ArchivedExpense.objects.values_list('id', flat=True)), [self.expense.id])
+        self.assertEqual(OpeningBalance.objects.get(user=self.user).paid, Decimal('100'))
+
+    def test_incremental_backup_copies_only_rows_of_new_archive_runs(self):
+        """Test that archived participants and opening rows are only copied when an archive run touched them"""
+        import datetime
+        import os
+        from django.test import override_settings
+        from django.utils import timezone
+        from .archive import archive
+        from .backup import dump, load, read_header
+        from .models import ArchivedExpense, OpeningBalance, OpeningDebt
+        old = timezone.now() - datetime.timedelta(days=400)
+        cutoff = timezone.now() - datetime.timedelta(days=30)
+        later = self.make_expense('50.00')
+        Expense.objects.filter(id=self.expense.id).update(created_at=old)
+        archive(cutoff)
+        full = os.path.join(self.tmp, 'full.jsonl.gz')
+        dump(full)
+        Expense.objects.filter(id=later.id).update(created_at=old)
+        archive(cutoff)
+        incremental = os.path.join(self.tmp, 'inc.jsonl.gz')
+        with override_settings(BACKUP_CURSOR_OVERLAP=0):
+            counts = dump(incremental, since=read_header(full))
+            self.assertEqual((counts['archived_expense'], counts['archived_expense_participant']), (1, 2))
+            self.assertEqual(counts['opening_balance'], OpeningBalance.objects.count())
+            idle = dump(os.path.join(self.tmp, 'idle.jsonl.gz'), since=read_header(incremental))
+        self.assertEqual(
+            [idle[name] for name in ('archived_expense', 'archived_expense_participant', 'opening_balance', 'opening_debt')],
+            [0, 0, 0, 0],
+        )
+
+        ArchivedExpense.objects.all().delete()
+        OpeningBalance.objects.all().delete()
+        OpeningDebt.objects.all().delete()
+        load(full)
+        load(incremental)
+        self.assertEqual(ArchivedExpense.objects.get(id=later.id).participants.count(), 2)
+        self.assertEqual(OpeningBalance.objects.get(user=self.user).paid, Decimal('150'))
+
+
+class ExpenseFilterTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        self.dinner = self.make_expense('90.00', 'Dinner', 'Pizza night downtown', '2024-10-01', self.user, [self.user, self.other])
+        self.taxi = self.make_expense('20.00', 'Transport', 'Taxi to the airport', '2024-10-05', self.other, [self.user, self.other])
+        self.rent = self.make_expense('900.00', 'Rent', 'October rent', '2024-10-10', self.user, [self.user])
+
+    def make_expense(self, amount, category, description, day, creator, participants):
+        import datetime
+        from django.utils import timezone
+        expense = Expense.objects.create(
+            total_amount=Decimal(amount),
+            split_method='equal',
+            created_by=creator,
+            category=category,
+            description=description,
+            created_at=timezone.make_aware(datetime.datetime.fromisoformat(day + 'T12:00:00')),
+            split_details={str(user.id): str(Decimal(amount) / len(participants)) for user in participants}
+        )
+        expense.participants.add(*participants)
+        return expense
+
+    def ids(self, url):
+        res = self.client.get(url)
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        return {item.get('id', item.get('expense_id')) for item in res.data}
+
+    def test_filters_combine(self):
+        """Test date, amount, creator, participant and category filters"""
+        self.assertEqual(self.ids('/api/expenses/overall/?date_from=2024-10-02&date_to=2024-10-10'), {self.taxi.id, self.rent.id})
+        self.assertEqual(self.ids('/api/expenses/overall/?min_amount=50&max_amount=100'), {self.dinner.id})
+        self.assertEqual(self.ids(f'/api/expenses/overall/?created_by={self.user.id}'), {self.dinner.id, self.rent.id})
+        self.assertEqual(self.ids(f'/api/expenses/overall/?participant={self.other.id}&category=Transport'), {self.taxi.id})
+        self.assertEqual(self.ids(f'/api/expenses/user/?created_by={self.other.id}'), {self.taxi.id})
+
+    def test_free_text_search(self):
+        """Test that words in the description and category are matched by prefix"""
+        self.assertEqual(self.ids('/api/expenses/overall/?q=airp'), {self.taxi.id})
+        self.assertEqual(self.ids('/api/expenses/overall/?q=rent'), {self.rent.id})
+        self.taxi.description = 'Shuttle'
+        self.taxi.save()
+        self.assertEqual(self.ids('/api/expenses/overall/?q=airport'), set())
+
+    def test_invalid_filters_are_rejected(self):
+        """Test that malformed parameters return 400"""
+        for query in ('date_from=yesterday', 'split_method=random', 'min_amount=10&max_amount=5'):
+            res = self.client.get(f'/api/expenses/overall/?{query}')
+            self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class LedgerProjectionTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+
+    def create_expense(self, amount, category='Food'):
+        payload = {
+            'total_amount': amount,
+            'split_method': 'equal',
+            'category': category,
+            'participants': [self.user.id, self.other.id],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post('/api/expenses/', payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return res.data['id']
+
+    def test_create_appends_event_and_updates_projections(self):
+        """Test that creating an expense records an event and the projections catch up outside the request"""
+        from .models import LedgerEvent, UserBalance, CategoryRollup, ProjectionCheckpoint
+        from .projections import catch_up_all
+        expense_id = self.create_expense('100.00')
+        self.create_expense('50.00', category='Taxi')
+        self.assertFalse(UserBalance.objects.exists())
+        self.assertEqual(catch_up_all(), {'balances': 2, 'category_rollups': 2})
+
+        event = LedgerEvent.objects.get(expense_id=expense_id)
+        self.assertEqual(event.kind, LedgerEvent.EXPENSE_CREATED)
+        self.assertEqual(event.payload['after']['created_by'], self.user.id)
+
+        mine = UserBalance.objects.get(user=self.user)
+        theirs = UserBalance.objects.get(user=self.other)
+        self.assertEqual(mine.paid, Decimal('150'))
+        self.assertEqual(mine.owed, Decimal('75'))
+        self.assertEqual(theirs.net, Decimal('-75'))
+        self.assertEqual(CategoryRollup.objects.get(category='Food').expense_count, 1)
+        self.assertEqual(ProjectionCheckpoint.objects.get(name='balances').offset, LedgerEvent.objects.last().id)
+
+    def test_rebuild_from_snapshot_and_compact(self):
+        """Test that a rebuild after compaction reproduces the same state"""
+        from . import projections
+        from .models import LedgerEvent, UserBalance
+        self.create_expense('100.00')
+        for name in projections.PROJECTIONS:
+            projections.take_snapshot(name)
+        self.create_expense('30.00')
+        projections.catch_up_all()
+        expected = dict(UserBalance.objects.values_list('user_id', 'owed'))
+
+        self.assertEqual(projections.compact(), 1)
+        self.assertEqual(LedgerEvent.objects.count(), 1)
+        UserBalance.objects.all().delete()
+        self.assertEqual(projections.rebuild('balances', chunk_size=1), 1)
+        self.assertEqual(dict(UserBalance.objects.values_list('user_id', 'owed')), expected)
+
+    def test_compact_requires_snapshots(self):
+        """Test that compaction refuses to run before every projection has a snapshot"""
+        from . import projections
+        self.create_expense('10.00')
+        with self.assertRaises(ValueError):
+            projections.compact()
+
+    def test_catch_up_rolls_back_when_the_checkpoint_moved(self):
+        """Test that a catch-up whose offset was moved by another does not apply its chunk"""
+        from unittest import mock
+        from . import projections
+        from .models import LedgerEvent, ProjectionCheckpoint, UserBalance
+        self.create_expense('10.00')
+        flush = projections.BalanceProjection.flush
+
+        def racing_flush(projection):
+            flush(projection)
+            # Another worker applied the same events meanwhile
+            ProjectionCheckpoint.objects.filter(name='balances').update(offset=LedgerEvent.objects.last().id)
+
+        with mock.patch.object(projections.BalanceProjection, 'flush', racing_flush):
+            self.assertEqual(projections.catch_up('balances'), 0)
+        self.assertFalse(UserBalance.objects.exists())
+        self.assertEqual(projections.catch_up('balances'), 1)
+        self.assertEqual(UserBalance.objects.get(user=self.other).owed, Decimal('5'))
+
+
+class BalanceStreamTests(TestCase):
+    def setUp(self):
+        from django.core.cache import cache
+        cache.clear()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+
+    def create_expense(self):
+        expense = Expense.objects.create(
+            total_amount=Decimal('90.00'),
+            split_method='equal',
+            created_by=self.other,
+            category='Food',
+            split_details={str(self.user.id): '30.00', str(self.other.id): '60.00'}
+        )
+        from . import ledger
+        with self.captureOnCommitCallbacks(execute=True):
+            ledger.record_expense_created(expense)
+        return expense
+
+    def test_stream_delivers_deltas_until_disconnect(self):
+        """Test that a connected client receives its balance delta for a committed expense"""
+        import asyncio
+        from asgiref.sync import async_to_sync, sync_to_async
+        from .authentication import issue_signed_token
+        from .pubsub import hub
+        from .sse import SSE_PATH, balance_stream
+        token = issue_signed_token(self.user)
+        sent = []
+
+        async def scenario():
+            disconnect = asyncio.Event()
+
+            async def receive():
+                await disconnect.wait()
+                return {'type': 'http.disconnect'}
+
+            async def send(message):
+                sent.append(message)
+                if b'event: balance' in message.get('body', b''):
+                    disconnect.set()
+
+            scope = {'type': 'http', 'method': 'GET', 'path': SSE_PATH, 'query_string': f'token={token}'.encode(), 'headers': []}
+            stream = asyncio.ensure_future(balance_stream(scope, receive, send))
+            while hub.subscriber_count(self.user.id) == 0:
+                await asyncio.sleep(0.01)
+            expense = await sync_to_async(self.create_expense)()
+            await asyncio.wait_for(stream, 5)
+            return expense
+
+        expense = async_to_sync(scenario)()
+        self.assertEqual(sent[0]['status'], 200)
+        body = b''.join(message.get('body', b'') for message in sent[1:]).decode()
+        self.assertIn('event: ready', body)
+        data = json.loads(body.split('event: balance\ndata: ')[1].split('\n')[0])
+        self.assertEqual(data['expense_id'], expense.id)
+        self.assertEqual(Decimal(data['delta']), Decimal('-30'))
+        self.assertEqual(hub.subscriber_count(self.user.id), 0)
+
+    def test_stream_rejects_invalid_token(self):
+        """Test that connections without a valid token get 401"""
+        from asgiref.sync import async_to_sync
+        from .sse import SSE_PATH, balance_stream
+        sent = []
+
+        async def send(message):
+            sent.append(message)
+
+        async def receive():
+            return {'type': 'http.disconnect'}
+
+        scope = {'type': 'http', 'method': 'GET', 'path': SSE_PATH, 'query_string': b'token=nope', 'headers': []}
+        async_to_sync(balance_stream)(scope, receive, send)
+        self.assertEqual(sent[0]['status'], 401)
+
+    def test_full_queue_collapses_into_resync(self):
+        """Test that a slow subscriber's backlog is replaced by a single resync message"""
+        import asyncio
+        from .pubsub import BalanceHub
+
+        async def scenario():
+            hub = BalanceHub()
+            subscription = hub.subscribe(self.user.id, maxsize=2)
+            for seq in range(5):
+                hub.publish(self.user.id, {'event': 'balance', 'seq': seq})
+            await asyncio.sleep(0)
+            return [subscription.queue.get_nowait() for _ in range(subscription.queue.qsize())]
+
+        messages = asyncio.run(scenario())
+        self.assertEqual(messages[0], {'event': 'resync'})
+        self.assertLessEqual(len(messages), 2)
+
+
+class ExpenseEditTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post('/api/expenses/', {
+                'total_amount': '100.00',
+                'split_method': 'equal',
+                'category': 'Food',
+                'participants': [self.user.id, self.other.id],
+            }, format='json')
+        self.expense_id = res.data['id']
+        self.url = f'/api/expenses/{self.expense_id}/'
+
+    def balances(self):
+        from .models import UserBalance
+        from .projections import catch_up_all
+        catch_up_all()
+        return {row.user_id: row.net for row in UserBalance.objects.all()}
+
+    def test_edit_applies_only_the_difference(self):
+        """Test that editing updates the split, bumps the version and shifts balances by the delta"""
+        from .models import LedgerEvent
+        self.assertEqual(self.balances(), {self.user.id: Decimal('50'), self.other.id: Decimal('-50')})
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.patch(self.url, {'total_amount': '60.00', 'version': 1}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['version'], 2)
+        self.assertEqual(Decimal(res.data['split_details'][str(self.other.id)]), Decimal('30'))
+        self.assertEqual(self.balances(), {self.user.id: Decimal('30'), self.other.id: Decimal('-30')})
+        event = LedgerEvent.objects.filter(expense_id=self.expense_id).last()
+        self.assertEqual(event.kind, LedgerEvent.EXPENSE_EDITED)
+        self.assertEqual(event.payload['before']['total_amount'], '100.00')
+
+    def test_stale_version_conflicts(self):
+        """Test that an edit based on an old version is rejected with 409"""
+        self.client.patch(self.url, {'category': 'Dinner', 'version': 1}, format='json')
+        res = self.client.patch(self.url, {'category': 'Lunch', 'version': 1}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        res = self.client.patch(self.url, {'category': 'Lunch'}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(Expense.objects.get(id=self.expense_id).category, 'Dinner')
+
+    def test_concurrent_edits_on_one_version_conflict(self):
+        """Test that of two changes sent with the same version while one is in flight, the other gets 409"""
+        from unittest import mock
+        from . import ledger
+        expense_state = ledger.expense_state
+        responses = []
+
+        def in_flight(expense):
+            # A second client sends its changes after the first passed the
+            # version check but before it wrote anything else
+            if not responses:
+                responses.append(None)
+                responses.append(self.client.patch(self.url, {'total_amount': '70.00', 'version': 1}, format='json'))
+                responses.append(self.client.delete(f'{self.url}?version=1'))
+            return expense_state(expense)
+
+        with mock.patch.object(ledger, 'expense_state', in_flight), self.captureOnCommitCallbacks(execute=True):
+            res = self.client.patch(self.url, {'total_amount': '60.00', 'version': 1}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([response.status_code for response in responses[1:]], [status.HTTP_409_CONFLICT] * 2)
+        expense = Expense.objects.get(id=self.expense_id)
+        self.assertEqual((expense.total_amount, expense.version), (Decimal('60.00'), 2))
+        self.assertEqual(self.balances(), {self.user.id: Decimal('30'), self.other.id: Decimal('-30')})
+
+    def test_delete_reverses_balances(self):
+        """Test that deleting removes the expense and its balance contribution"""
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.delete(f'{self.url}?version=1')
+        self.assertEqual(res.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertFalse(Expense.objects.filter(id=self.expense_id).exists())
+        self.assertEqual(self.balances(), {self.user.id: Decimal('0'), self.other.id: Decimal('0')})
+
+    def test_only_creator_can_change(self):
+        """Test that a participant can read but not edit or delete"""
+        self.client.force_authenticate(user=self.other)
+        self.assertEqual(self.client.get(self.url).status_code, status.HTTP_200_OK)
+        res = self.client.patch(self.url, {'category': 'Mine', 'version': 1}, format='json')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+        res = self.client.delete(f'{self.url}?version=1')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+
+class CurrencyTests(TestCase):
+    def setUp(self):
+        from .throttling import buckets
+        buckets.clear()
+        from django.core.management import call_command
+        from .fx import rate_cache
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        import os
+        import tempfile
+        rate_cache.clear()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rates.csv')
+            with open(path, 'w') as rates:
+                rates.write('date,currency,rate\n2024-01-01,EUR,1.10\n2024-01-01,GBP,1.25\n2024-01-03,EUR,1.20\n')
+            call_command('import_fx_rates', path, stdout=StringIO())
+
+    def create(self, amount, currency, day):
+        import datetime
+        from django.utils import timezone
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post('/api/expenses/', {
+                'total_amount': amount,
+                'currency': currency,
+                'split_method': 'equal',
+                'participants': [self.user.id, self.other.id],
+            }, format='json')
+        created_at = timezone.make_aware(datetime.datetime(2024, 1, day, 12))
+        Expense.objects.filter(id=res.data['id']).update(created_at=created_at)
+        return res
+
+    def test_converter_carries_rates_forward(self):
+        """Test that conversion uses the latest earlier rate and loads all days in one query"""
+        import datetime
+        from .fx import Converter, MissingRate
+        days = [datetime.date(2024, 1, day) for day in (1, 2, 3)]
+        with self.assertNumQueries(1):
+            converter = Converter('USD', days)
+        with self.assertNumQueries(0):
+            self.assertEqual(converter.convert('10', 'EUR', days[1]), Decimal('11.00'))
+            self.assertEqual(converter.convert('10', 'EUR', days[2]), Decimal('12.00'))
+            self.assertEqual(converter.factor('GBP', days[0]) / converter.factor('EUR', days[0]), Decimal('1.25') / Decimal('1.10'))
+        with self.assertRaises(MissingRate):
+            Converter('USD', [datetime.date(2024, 2, 1)]).factor('EUR', datetime.date(2024, 2, 1))
+
+    def test_currency_is_validated(self):
+        """Test that expenses keep their currency and reject malformed codes"""
+        self.assertEqual(self.create('100.00', 'eur', 1).data['currency'], 'EUR')
+        res = self.client.post('/api/expenses/', {
+            'total_amount': '10.00', 'currency': 'EURO', 'split_method': 'equal', 'participants': [self.user.id],
+        }, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_balances_are_kept_per_currency_and_converted(self):
+        """Test that projections keep currencies apart and reports convert them"""
+        from .models import UserBalance
+        from .projections import catch_up_all
+        self.create('100.00', 'EUR', 1)
+        self.create('50.00', 'USD', 3)
+        catch_up_all()
+        self.assertEqual(
+            dict(UserBalance.objects.filter(user=self.other).values_list('currency', 'owed')),
+            {'EUR': Decimal('50'), 'USD': Decimal('25')},
+        )
+        res = self.client.get('/api/balances/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(Decimal(res.data['other@example.com']), Decimal('80'))
+        res = self.client.get('/api/balances/?currency=EUR')
+        self.assertEqual(Decimal(res.data['other@example.com']).quantize(Decimal('0.01')), Decimal('70.83'))
+
+    def test_balance_sheet_converts_totals(self):
+        """Test that the balance sheet reports totals in the requested currency"""
+        import csv
+        self.create('100.00', 'EUR', 1)
+        self.create('50.00', 'USD', 3)
+        res = self.client.get('/api/balance-sheet/')
+        rows = list(csv.reader(StringIO(b''.join(res.streaming_content).decode())))
+        self.assertIn(['Total Expenses', '160.00'], rows)
+        self.assertIn(['Test User', '160.00', '80.00'], rows)
+        res = self.client.get('/api/balance-sheet/?currency=GBP')
+        self.assertIn(['Reporting Currency', 'GBP'], list(csv.reader(StringIO(b''.join(res.streaming_content).decode()))))
+        res = self.client.get('/api/balance-sheet/?currency=JPY')
+        self.assertEqual(res.status_code, status.HTTP_422_UNPROCESSABLE_ENTITY)
+
+
+class RecurringExpenseTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+
+    def create_template(self, **fields):
+        data = {
+            'total_amount': '900.00',
+            'split_method': 'equal',
+            'participants': [self.user.id, self.other.id],
+            'category': 'Rent',
+            'cadence': 'monthly',
+            'start_date': '2024-01-31',
+        }
+        data.update(fields)
+        return self.client.post('/api/expenses/recurring/', data, format='json')
+
+    def test_materialize_catches_up_once(self):
+        """Test that a backlog is materialized in one run and re-runs create nothing"""
+        import datetime
+        from .models import LedgerEvent, UserBalance
+        from .projections import catch_up_all
+        from .recurring import materialize
+        res = self.create_template()
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['next_due'], '2024-01-31')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(materialize(datetime.date(2024, 4, 30)), 4)
+        self.assertEqual(materialize(datetime.date(2024, 4, 30)), 0)
+        expenses = Expense.objects.filter(recurring=res.data['id']).order_by('occurrence')
+        self.assertEqual(
+            [expense.occurrence for expense in expenses],
+            [datetime.date(2024, 1, 31), datetime.date(2024, 2, 29), datetime.date(2024, 3, 31), datetime.date(2024, 4, 30)],
+        )
+        self.assertEqual(set(expenses[0].participants.values_list('id', flat=True)), {self.user.id, self.other.id})
+        self.assertEqual(Decimal(expenses[0].split_details[str(self.other.id)]), Decimal('450'))
+        self.assertEqual(LedgerEvent.objects.filter(kind=LedgerEvent.EXPENSE_CREATED).count(), 4)
+        catch_up_all()
+        self.assertEqual(UserBalance.objects.get(user=self.other).owed, Decimal('1800'))
+
+    def test_end_date_deactivates_template(self):
+        """Test that occurrences stop after the end date"""
+        import datetime
+        from django.core.management import call_command
+        from .models import RecurringExpense
+        res = self.create_template(cadence='weekly', start_date='2024-01-01', end_date='2024-01-20')
+        out = StringIO()
+        call_command('materialize_recurring', '--date', '2024-03-01', stdout=out)
+        self.assertIn('Created 3 expenses', out.getvalue())
+        self.assertFalse(RecurringExpense.objects.get(id=res.data['id']).active)
+
+    def test_invalid_split_is_rejected(self):
+        """Test that templates are validated like expenses"""
+        res = self.create_template(split_method='exact', split_details={str(self.user.id): '100.00'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class FastReadPathTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        for amount in ('100.00', '30.50'):
+            self.client.post('/api/expenses/', {
+                'total_amount': amount,
+                'split_method': 'equal',
+                'category': 'Food',
+                'participants': [self.user.id, self.other.id],
+            }, format='json')
+
+    def test_reader_matches_serializer(self):
+        """Test that the values() read path renders exactly like ExpenseSerializer"""
+        from rest_framework.renderers import JSONRenderer
+        from .readers import ValuesReader
+        from .renderers import FastJSONRenderer
+        queryset = Expense.objects.order_by('id')
+        expected = JSONRenderer().render(ExpenseSerializer(queryset, many=True).data)
+        with self.assertNumQueries(2):
+            data = ValuesReader(ExpenseSerializer).read(queryset)
+        self.assertEqual(FastJSONRenderer().render(data), expected)
+        self.assertEqual(ValuesReader(ExpenseSerializer).read(queryset.none()), [])
+
+    def test_list_endpoints_use_constant_queries(self):
+        """Test that list endpoints don't query per expense or participant"""
+        with self.assertNumQueries(2):
+            res = self.client.get('/api/expenses/overall/')
+        self.assertEqual(json.loads(res.content)[1]['total_amount'], '30.50')
+        with self.assertNumQueries(2):
+            res = self.client.get('/api/expenses/user/')
+        body = json.loads(res.content)
+        self.assertEqual(body[0]['participants'], [{'id': self.other.id, 'name': 'Other User', 'email': 'other@example.com', 'share': 50.0}])
+        self.assertEqual(body[1]['your_share'], 15.25)
+
+
+class BalanceSheetExportTests(TestCase):
+    def setUp(self):
+        from .throttling import buckets
+        buckets.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        for category in ('Food', 'Taxi', 'Hotel'):
+            self.client.post('/api/expenses/', {
+                'total_amount': '10.00',
+                'split_method': 'equal',
+                'category': category,
+                'participants': [self.user.id, self.other.id],
+            }, format='json')
+
+    def test_csv_streams_in_chunks(self):
+        """Test that the CSV export is streamed and reads expenses in chunks"""
+        import csv
+        from . import exports
+        sheet = exports.BalanceSheet('USD', chunk_size=2)
+        rows = list(csv.reader(StringIO(b''.join(exports.CSVExporter().stream(sheet)).decode())))
+        self.assertEqual([row[1] for row in rows[7:10]], ['Food', 'Taxi', 'Hotel'])
+        self.assertEqual(rows[7][-2:], ['5.00', '5.00'])
+        self.assertIn(['Other User', '0.00', '15.00'], rows)
+
+    def test_jsonl_with_gzip(self):
+        """Test that ?format=jsonl&compress=gzip returns gzipped JSON lines"""
+        import gzip
+        res = self.client.get('/api/balance-sheet/?format=jsonl&compress=gzip')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res['Content-Type'], 'application/gzip')
+        self.assertIn('detailed_balance_sheet.jsonl.gz', res['Content-Disposition'])
+        lines = [json.loads(line) for line in gzip.decompress(b''.join(res.streaming_content)).splitlines()]
+        self.assertEqual(lines[0], {'type': 'summary', 'currency': 'USD', 'total_expenses': '30.00', 'expense_count': 3})
+        self.assertEqual([line['type'] for line in lines], ['summary'] + ['expense'] * 3 + ['balance'] * 2)
+        self.assertEqual(lines[-1]['owed'], '15.00')
+
+    def test_errors_are_json(self):
+        """Test that bad parameters are reported as JSON, and unknown formats are 404"""
+        res = self.client.get('/api/balance-sheet/?format=csv&compress=zip')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('compress', res.json())
+        self.assertEqual(self.client.get('/api/balance-sheet/?format=xlsx').status_code, status.HTTP_404_NOT_FOUND)
+        for name in ('json', 'api'):
+            res = self.client.get(f'/api/balance-sheet/?format={name}')
+            self.assertEqual(res.status_code, status.HTTP_404_NOT_FOUND)
+            self.assertIn('csv', res.json()['detail'])
+
+    def test_npz_share_matrix(self):
+        """Test the npz export, or its 406 when numpy is not installed"""
+        from . import exports
+        res = self.client.get('/api/balance-sheet/?format=npz')
+        if exports.numpy is None:
+            self.assertEqual(res.status_code, status.HTTP_406_NOT_ACCEPTABLE)
+            return
+        from io import BytesIO
+        arrays = exports.numpy.load(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(list(arrays['shape']), [2, 3])
+        self.assertEqual(len(arrays['share_amount']), 6)
+        self.assertEqual(list(arrays['user_owed']), [15.0, 15.0])
+
+
+class StatementTests(TestCase):
+    def setUp(self):
+        from .throttling import buckets
+        buckets.clear()
+        import datetime
+        from django.utils import timezone
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        # Day n: the user pays 10n split equally, or owes half of the other's 10n
+        for day in range(1, 7):
+            payer = self.user if day % 2 else self.other
+            expense = Expense.objects.create(
+                total_amount=Decimal(10 * day),
+                split_method='equal',
+                created_by=payer,
+                category=f'Day {day}',
+                split_details={str(self.user.id): str(5 * day), str(self.other.id): str(5 * day)},
+                created_at=timezone.make_aware(datetime.datetime(2024, 1, day, 12)),
+            )
+            expense.participants.add(self.user, self.other)
+
+    def test_running_balance(self):
+        """Test that each row carries the running balance of the user's changes"""
+        res = self.client.get('/api/statement/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual([Decimal(row['change']) for row in res.data['results']], [5, -10, 15, -20, 25, -30])
+        self.assertEqual([Decimal(row['balance']) for row in res.data['results']], [5, -5, 10, -10, 15, -15])
+        self.assertIsNone(res.data['next'])
+
+    def test_pages_carry_balance_forward(self):
+        """Test that later pages and date ranges start from the carried balance"""
+        res = self.client.get('/api/statement/?page_size=4')
+        self.assertEqual(len(res.data['results']), 4)
+        with self.assertNumQueries(1):
+            page = self.client.get(res.data['next'])
+        self.assertEqual([Decimal(row['balance']) for row in page.data['results']], [15, -15])
+        res = self.client.get('/api/statement/?date_from=2024-01-03&date_to=2024-01-04')
+        self.assertEqual([Decimal(row['balance']) for row in res.data['results']], [10, -10])
+
+    def test_cursor_is_bound_to_the_query(self):
+        """Test that a cursor can't be tampered with or reused for another range"""
+        res = self.client.get('/api/statement/?page_size=2')
+        cursor = res.data['next'].split('cursor=')[1]
+        self.assertEqual(self.client.get(f'/api/statement/?page_size=2&cursor={cursor}x').status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.get(f'/api/statement/?page_size=2&date_to=2024-01-05&cursor={cursor}')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class CoalescingTests(TestCase):
+    def setUp(self):
+        from .throttling import buckets
+        buckets.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.client.force_authenticate(user=self.user)
+
+    def test_concurrent_readers_share_one_computation(self):
+        """Test that readers joining a flight replay its output and the source runs once"""
+        import threading
+        from .coalescing import SingleFlight
+        flights = SingleFlight('test', max_in_flight=1)
+        release = threading.Event()
+        runs = []
+
+        def source():
+            runs.append(1)
+            yield b'a'
+            release.wait(5)
+            yield b'b'
+
+        leader = flights.start('key', source())
+        follower = flights.join('key')
+        self.assertEqual(next(leader), b'a')
+        results = {}
+        thread = threading.Thread(target=lambda: results.setdefault('follower', b''.join(follower)))
+        thread.start()
+        release.set()
+        self.assertEqual(b'a' + b''.join(leader), b'ab')
+        thread.join(5)
+        self.assertEqual(results['follower'], b'ab')
+        self.assertEqual(len(runs), 1)
+        self.assertEqual(flights.in_flight(), 0)
+        self.assertIsNone(flights.join('key'))
+
+    def test_flights_drop_consumed_chunks(self):
+        """Test that chunks every reader has read are dropped and late requests start a new flight"""
+        from .coalescing import SingleFlight
+        flights = SingleFlight('test', max_in_flight=1)
+        leader = flights.start('key', iter([b'a', b'b', b'c']))
+        follower = flights.join('key')
+        flight = follower.flight
+        self.assertEqual([next(leader), next(leader)], [b'a', b'b'])
+        self.assertEqual(flight.chunks, [b'a', b'b'])
+        self.assertEqual(next(follower), b'a')
+        self.assertEqual(flight.chunks, [b'b'])
+
+        # The output can no longer be replayed from the start
+        self.assertIsNone(flights.join('key'))
+        self.assertEqual(flights.in_flight(), 1)
+        follower.close()
+        self.assertEqual(next(leader), b'c')
+        self.assertEqual(flight.chunks, [])
+        self.assertEqual(list(leader), [])
+        self.assertEqual(flights.in_flight(), 0)
+
+    def test_in_flight_cap_and_abandoned_flights(self):
+        """Test that the cap rejects new keys and abandoned flights free their slot"""
+        from .coalescing import Overloaded, SingleFlight
+        flights = SingleFlight('test', max_in_flight=1)
+        reader = flights.start('one', iter([b'x']))
+        with self.assertRaises(Overloaded):
+            flights.start('two', iter([b'y']))
+        reader.close()
+        self.assertEqual(flights.in_flight(), 0)
+        self.assertEqual(b''.join(flights.start('two', iter([b'y']))), b'y')
+
+    def test_balance_sheet_sheds_load(self):
+        """Test that the balance sheet answers 503 with Retry-After when the cap is reached"""
+        from django.test import override_settings
+        from .views import BalanceSheetView
+        with override_settings(COALESCE_MAX_IN_FLIGHT=1):
+            busy = BalanceSheetView.flights.start(('other',), iter([b'']))
+            try:
+                res = self.client.get('/api/balance-sheet/')
+            finally:
+                busy.close()
+        self.assertEqual(res.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(res['Retry-After'], '5')
+
+    def test_token_bucket_throttles_per_user(self):
+        """Test that bursts beyond the bucket get 429 and the bucket refills"""
+        from django.test import override_settings
+        from .throttling import buckets
+        self.assertEqual(buckets.take('k', 2, 1.0, now=0), 0)
+        self.assertEqual(buckets.take('k', 2, 1.0, now=0), 0)
+        self.assertEqual(buckets.take('k', 2, 1.0, now=0.5), 0.5)
+        self.assertEqual(buckets.take('k', 2, 1.0, now=1.0), 0)
+        with override_settings(TOKEN_BUCKET_RATES={'reports': {'capacity': 2, 'refill_rate': 0.01}}):
+            self.assertEqual(self.client.get('/api/statement/').status_code, status.HTTP_200_OK)
+            self.assertEqual(self.client.get('/api/balances/').status_code, status.HTTP_200_OK)
+            res = self.client.get('/api/statement/')
+        self.assertEqual(res.status_code, status.HTTP_429_TOO_MANY_REQUESTS)
+        self.assertIn('Retry-After', res)
+
+
+class AuditTests(TestCase):
+    def setUp(self):
+        import tempfile
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.report = f'{self.directory.name}/report.jsonl'
+
+    def create_expense(self, amount):
+        payload = {
+            'total_amount': amount,
+            'split_method': 'equal',
+            'category': 'Food',
+            'participants': [self.user.id, self.other.id],
+        }
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post('/api/expenses/', payload, format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        return res.data['id']
+
+    def read_report(self):
+        with open(self.report) as handle:
+            return [json.loads(line) for line in handle]
+
+    def test_audit_reports_inconsistencies(self):
+        """Test that broken splits and the balances they skew are reported"""
+        from django.core.management import call_command
+        self.create_expense('100.00')
+        broken = self.create_expense('60.00')
+        Expense.objects.filter(id=broken).update(split_details={str(self.user.id): '30.00', '999': '20.00'})
+        out = StringIO()
+        call_command('audit_expenses', '--report', self.report, '--chunk-size', '1', '--workers', '2', stdout=out, stderr=StringIO())
+        summary = json.loads(out.getvalue())
+        self.assertEqual(summary['checked'], 2)
+        self.assertEqual(summary['issues'], {'split_sum': 1, 'share_without_participant': 1, 'participant_without_share': 1, 'balance': 2})
+
+        lines = self.read_report()
+        self.assertEqual(lines[-1], summary)
+        issues = [line for line in lines if line['type'] == 'issue' and line['expense_id'] == broken]
+        self.assertEqual({issue['check'] for issue in issues}, {'split_sum', 'share_without_participant', 'participant_without_share'})
+        balance = [line for line in lines if line.get('check') == 'balance' and line['detail']['user'] == self.other.id][0]
+        self.assertEqual(Decimal(balance['detail']['projected']['owed']) - Decimal(balance['detail']['expected']['owed']), Decimal('30'))
+
+    def test_audit_tolerates_division_drift(self):
+        """Test that rounding left by equal splits is reported as drift only"""
+        from .audit import audit
+        expense_id = self.create_expense('100.00')
+        half = str(Decimal('100') / 2 - Decimal(1) / 3)
+        Expense.objects.filter(id=expense_id).update(split_details={str(self.user.id): half, str(self.other.id): '50.33'})
+        summary = audit(self.report, f'{self.report}.checkpoint', workers=1, balances=False)
+        self.assertEqual(summary['issues'], {'split_drift': 1})
+
+    def test_audit_resumes_from_checkpoint(self):
+        """Test that a resumed audit only reads expenses after the checkpoint and keeps the totals"""
+        from django.core.management import call_command
+        self.create_expense('100.00')
+        call_command('audit_expenses', '--report', self.report, '--workers', '1', stdout=StringIO(), stderr=StringIO())
+        self.create_expense('40.00')
+        out = StringIO()
+        call_command('audit_expenses', '--report', self.report, '--workers', '1', '--resume', stdout=out, stderr=StringIO())
+        summary = json.loads(out.getvalue())
+        self.assertEqual(summary['checked'], 2)
+        self.assertEqual(summary['issues'], {})
+        self.assertEqual([line['type'] for line in self.read_report()], ['summary', 'summary'])
+
+
+class BulkUserProvisioningTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.admin = User.objects.create_user(email='admin@example.com', password='testpass123', name='Admin', is_staff=True)
+        self.client.force_authenticate(user=self.admin)
+
+    def entries(self, count):
+        return [
+            {'email': f'user{i}@Example.com', 'name': f'User {i}', 'mobile': '555', 'password': f'secret-{i}'}
+            for i in range(count)
+        ]
+
+    def test_bulk_create_hashes_passwords_and_issues_tokens(self):
+        """Test that bulk registration creates working users and tokens"""
+        from rest_framework.authtoken.models import Token
+        res = self.client.post('/api/users/bulk/', self.entries(6), format='json')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual([row['email'] for row in res.data], [f'user{i}@example.com' for i in range(6)])
+        self.assertNotIn('password', res.data[0])
+        user = User.objects.get(email='user5@example.com')
+        self.assertTrue(user.check_password('secret-5'))
+        self.assertEqual(Token.objects.get(user=user).key, res.data[5]['token'])
+
+    def test_bulk_create_is_all_or_nothing(self):
+        """Test that duplicates within the list or with existing users reject the whole list"""
+        entries = self.entries(2) + [{'email': 'admin@example.com', 'name': 'Again', 'mobile': '1', 'password': 'x'}]
+        res = self.client.post('/api/users/bulk/', entries, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.post('/api/users/bulk/', self.entries(1) * 2, format='json')
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(User.objects.count(), 1)
+
+    def test_bulk_create_requires_staff(self):
+        """Test that only staff users can register users in bulk"""
+        self.client.force_authenticate(user=User.objects.create_user(email='test@example.com', password='testpass123', name='Test User'))
+        res = self.client.post('/api/users/bulk/', self.entries(1), format='json')
+        self.assertEqual(res.status_code, status.HTTP_403_FORBIDDEN)
+
+    def test_provision_users_command(self):
+        """Test that the command creates users from a CSV file and prints their tokens"""
+        import csv
+        import os
+        import tempfile
+        from django.core.management import call_command
+        with tempfile.NamedTemporaryFile('w', suffix='.csv', newline='', delete=False) as handle:
+            writer = csv.DictWriter(handle, ['email', 'name', 'mobile', 'password'])
+            writer.writeheader()
+            writer.writerows(self.entries(4))
+        self.addCleanup(os.unlink, handle.name)
+        out = StringIO()
+        call_command('provision_users', handle.name, '--workers', '2', stdout=out, stderr=StringIO())
+        rows = list(csv.DictReader(StringIO(out.getvalue())))
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(User.objects.get(email=rows[0]['email']).check_password('secret-0'))
+
+
+class DebtMatrixTests(TestCase):
+    def setUp(self):
+        from .throttling import buckets
+        buckets.clear()
+        self.client = APIClient()
+        self.users = [
+            User.objects.create_user(email=f'user{i}@example.com', password='testpass123', name=f'User {i}')
+            for i in range(4)
+        ]
+        self.client.force_authenticate(user=self.users[0])
+
+    def create_expense(self, creator, shares):
+        expense = Expense.objects.create(
+            total_amount=sum(Decimal(amount) for amount in shares.values()),
+            split_method='exact',
+            created_by=creator,
+            category='Food',
+            split_details={str(user.id): amount for user, amount in shares.items()},
+        )
+        expense.participants.set(shares)
+
+    def test_debts_net_out_per_pair(self):
+        """Test that debts in both directions cancel and only non-zero pairs are returned"""
+        a, b, c, d = self.users
+        self.create_expense(a, {a: '10.00', b: '30.00', c: '20.00'})
+        self.create_expense(b, {a: '5.00', b: '5.00'})
+        self.create_expense(c, {a: '20.00'})
+        res = self.client.get('/api/balances/matrix/')
+        self.assertEqual(res.status_code, status.HTTP_200_OK)
+        self.assertEqual(res.data['users'], [a.id, b.id])
+        self.assertEqual(res.data['edges'], [[b.id, a.id, '25.00']])
+
+        res = self.client.get('/api/balances/matrix/', {'layout': 'csr'})
+        self.assertEqual(res.data['indptr'], [0, 0, 1])
+        self.assertEqual(res.data['indices'], [0])
+        self.assertEqual(res.data['data'], ['25.00'])
+
+    def test_matrix_restricted_to_users(self):
+        """Test that ?users= only counts debts among the given users"""
+        a, b, c, d = self.users
+        self.create_expense(a, {b: '30.00', c: '20.00'})
+        self.create_expense(d, {b: '7.00'})
+        res = self.client.get('/api/balances/matrix/', {'users': f'{a.id},{c.id},{d.id}'})
+        self.assertEqual(res.data['edges'], [[c.id, a.id, '20.00']])
+        res = self.client.get('/api/balances/matrix/', {'users': 'x'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class PaymentTests(TestCase):
+    def setUp(self):
+        from .throttling import buckets
+        buckets.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/expenses/', {
+                'total_amount': '100.00',
+                'split_method': 'equal',
+                'category': 'Food',
+                'participants': [self.user.id, self.other.id],
+            }, format='json')
+
+    def pay(self, amount, **fields):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/payments/', {'amount': amount, **fields}, format='json')
+
+    def test_payment_settles_balances(self):
+        """Test that a payment is recorded in the ledger and offsets every balance view"""
+        from .models import LedgerEvent, UserBalance
+        from .projections import catch_up_all
+        self.client.force_authenticate(user=self.other)
+        res = self.pay('30.00', payee=self.user.id, note='Dinner')
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['payer'], self.other.id)
+        self.assertEqual(LedgerEvent.objects.filter(kind=LedgerEvent.PAYMENT_RECORDED).count(), 1)
+        catch_up_all()
+        self.assertEqual(UserBalance.objects.get(user=self.other).net, Decimal('-20'))
+        self.assertEqual(UserBalance.objects.get(user=self.user).net, Decimal('20'))
+
+        res = self.client.get('/api/balances/')
+        self.assertEqual(Decimal(res.data[self.user.email]), Decimal('-20'))
+        res = self.client.get('/api/balances/matrix/')
+        self.assertEqual(res.data['edges'], [[self.other.id, self.user.id, '20.00']])
+        res = self.client.get('/api/balance-sheet/?format=jsonl')
+        lines = [json.loads(line) for line in b''.join(res.streaming_content).splitlines()]
+        self.assertEqual([line['type'] for line in lines], ['summary', 'expense', 'payment', 'balance', 'balance'])
+        self.assertEqual(lines[-1]['paid'], '30.00')
+
+        res = self.client.get('/api/payments/')
+        self.assertEqual([payment['note'] for payment in res.data], ['Dinner'])
+
+    def test_invalid_payments_are_rejected(self):
+        """Test that payments to oneself, between other users or of non-positive amounts are rejected"""
+        third = User.objects.create_user(email='third@example.com', password='testpass123', name='Third User')
+        self.assertEqual(self.pay('10.00', payee=self.user.id).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.pay('10.00', payer=self.other.id, payee=third.id).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.pay('0', payee=self.other.id).status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.pay('10.00', payer=self.other.id, payee=self.user.id).status_code, status.HTTP_201_CREATED)
+
+
+class ArchiveTests(TestCase):
+    def setUp(self):
+        import datetime
+        from django.utils import timezone
+        from .throttling import buckets
+        buckets.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        for amount, category in (('100.00', 'Rent'), ('40.00', 'Food')):
+            with self.captureOnCommitCallbacks(execute=True):
+                self.client.post('/api/expenses/', {
+                    'total_amount': amount,
+                    'split_method': 'equal',
+                    'category': category,
+                    'participants': [self.user.id, self.other.id],
+                }, format='json')
+        Expense.objects.filter(category='Rent').update(created_at=timezone.now() - datetime.timedelta(days=400))
+
+    def snapshot(self):
+        balances = self.client.get('/api/balances/').data
+        matrix = self.client.get('/api/balances/matrix/').data
+        statement = self.client.get('/api/statement/').data['results']
+        sheet = b''.join(self.client.get('/api/balance-sheet/?format=jsonl').streaming_content)
+        sheet = [line for line in map(json.loads, sheet.splitlines()) if line['type'] == 'balance']
+        return balances, matrix, statement[-1]['balance'], sheet
+
+    def test_archive_carries_balances_forward(self):
+        """Test that archiving moves old expenses but leaves every balance unchanged"""
+        import datetime
+        from django.core.management import call_command
+        from django.utils import timezone
+        from .audit import audit
+        from .models import ArchivedExpense, OpeningBalance
+        before = self.snapshot()
+        out = StringIO()
+        cutoff = (timezone.localdate() - datetime.timedelta(days=30)).isoformat()
+        call_command('archive_expenses', '--before', cutoff, stdout=out)
+        self.assertIn('Archived 1 expenses', out.getvalue())
+        self.assertEqual(list(Expense.objects.values_list('category', flat=True)), ['Food'])
+        archived = ArchivedExpense.objects.get()
+        self.assertEqual(set(archived.participants.values_list('id', flat=True)), {self.user.id, self.other.id})
+        self.assertEqual(OpeningBalance.objects.get(user=self.user).net, Decimal('50'))
+        self.assertEqual(self.snapshot(), before)
+
+        import tempfile
+        with tempfile.TemporaryDirectory() as directory:
+            summary = audit(f'{directory}/report.jsonl', f'{directory}/checkpoint', workers=1)
+        self.assertEqual(summary['issues'], {})
+
+    def test_archive_converts_at_the_expense_date(self):
+        """Test that archived foreign-currency expenses keep the rate of their own day, not the cutoff's"""
+        import datetime
+        from django.utils import timezone
+        from .archive import archive
+        from .fx import import_rates, rate_cache
+        created_at = timezone.now() - datetime.timedelta(days=400)
+        cutoff = timezone.now() - datetime.timedelta(days=30)
+        rate_cache.clear()
+        self.addCleanup(rate_cache.clear)
+        import_rates([
+            {'date': timezone.localdate(created_at).isoformat(), 'currency': 'EUR', 'rate': '1.0'},
+            {'date': timezone.localdate(cutoff).isoformat(), 'currency': 'EUR', 'rate': '2.0'},
+        ])
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post('/api/expenses/', {
+                'total_amount': '100.00', 'currency': 'EUR', 'split_method': 'equal',
+                'participants': [self.user.id, self.other.id],
+            }, format='json')
+        Expense.objects.filter(id=res.data['id']).update(created_at=created_at)
+        before = self.snapshot()
+        # 50 for the rent, 20 for the food and 50 EUR at 1.0
+        self.assertEqual(Decimal(before[0]['other@example.com']), Decimal('120'))
+
+        self.assertEqual(archive(cutoff), 2)
+        after = self.snapshot()
+        # Amounts may differ in trailing zeros only
+        self.assertEqual(Decimal(after[0]['other@example.com']), Decimal('120'))
+        self.assertEqual(after[1:], before[1:])
+
+    def test_include_archived(self):
+        """Test that archived expenses are only listed with ?include_archived=1"""
+        import datetime
+        from django.utils import timezone
+        from .archive import archive
+        archive(timezone.now() - datetime.timedelta(days=30))
+        res = self.client.get('/api/expenses/overall/')
+        self.assertEqual([row['category'] for row in res.data], ['Food'])
+        res = self.client.get('/api/expenses/overall/', {'include_archived': '1', 'category': 'Rent'})
+        self.assertEqual([(row['category'], row['total_amount']) for row in res.data], [('Rent', '100.00')])
+        self.assertEqual(sorted(res.data[0]['participants']), sorted([self.user.id, self.other.id]))
+        res = self.client.get('/api/expenses/user/', {'include_archived': 'true'})
+        self.assertEqual([row['category'] for row in res.data], ['Food', 'Rent'])
+        self.assertEqual(res.data[1]['participants'][0]['email'], 'other@example.com')
+        res = self.client.get('/api/expenses/user/', {'include_archived': 'maybe'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class AdminTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(email='admin@example.com', password='testpass123', name='Admin')
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.client.force_login(self.admin)
+        self.expense = Expense.objects.create(
+            total_amount=Decimal('10.00'),
+            split_method='equal',
+            created_by=self.user,
+            category='Food',
+            description='Lunch',
+            split_details={str(self.user.id): '10.00'},
+        )
+        self.expense.participants.add(self.user)
+
+    def test_changelists_avoid_full_counts(self):
+        """Test that the changelists and search work without an unbounded COUNT(*)"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        for url in ('/admin/expenses_app/user/', '/admin/expenses_app/expense/'):
+            with CaptureQueriesContext(connection) as queries:
+                res = self.client.get(url)
+            self.assertEqual(res.status_code, 200)
+            self.assertFalse([query['sql'] for query in queries if query['sql'].startswith('SELECT COUNT(*) AS "__count" FROM "expenses_app_')])
+        res = self.client.get('/admin/expenses_app/user/', {'q': 'test@'})
+        self.assertContains(res, 'test@example.com')
+        self.assertNotContains(res, 'admin@example.com</a>')
+        res = self.client.get('/admin/expenses_app/expense/', {'q': 'lunch'})
+        self.assertContains(res, f'/admin/expenses_app/expense/{self.expense.id}/change/')
+
+    def test_paginator_estimates_large_tables(self):
+        """Test that unfiltered lists use the estimate and filtered lists a capped count"""
+        from unittest import mock
+        from . import admin
+        with mock.patch.object(admin, 'EXACT_COUNT_LIMIT', 1):
+            self.assertEqual(admin.EstimatedCountPaginator(User.objects.order_by('id'), 10).count, User.objects.order_by('-id')[0].id)
+            self.assertEqual(admin.EstimatedCountPaginator(User.objects.filter(is_active=True).order_by('id'), 10).count, 2)
+
+    def test_edit_records_ledger_event(self):
+        """Test that editing an expense in the admin bumps its version and records the edit"""
+        from .models import LedgerEvent
+        url = f'/admin/expenses_app/expense/{self.expense.id}/change/'
+        res = self.client.get(url)
+        self.assertContains(res, f'{self.user.id}: 10.00')
+        res = self.client.post(url, {'category': 'Dinner', 'description': 'Lunch'})
+        self.assertEqual(res.status_code, 302)
+        self.expense.refresh_from_db()
+        self.assertEqual((self.expense.category, self.expense.version), ('Dinner', 2))
+        event = LedgerEvent.objects.get(kind=LedgerEvent.EXPENSE_EDITED)
+        self.assertEqual((event.payload['before']['category'], event.payload['after']['category']), ('Food', 'Dinner'))
+
+
+class DuplicateExpenseTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        self.data = {
+            'total_amount': '30.00',
+            'split_method': 'equal',
+            'category': 'Taxi',
+            'participants': [self.other.id],
+        }
+
+    def post(self, data):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/expenses/', data, format='json')
+
+    def test_duplicate_rejected(self):
+        """Test that a resubmitted expense is rejected unless explicitly allowed"""
+        first = self.post(self.data)
+        self.assertEqual(first.status_code, status.HTTP_201_CREATED)
+        res = self.post(dict(self.data, category=' taxi ', participants=[self.other.id, self.user.id]))
+        self.assertEqual(res.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(res.data['duplicate_of'], first.data['id'])
+        self.assertEqual(self.post(dict(self.data, total_amount='31.00')).status_code, status.HTTP_201_CREATED)
+        res = self.post(dict(self.data, allow_duplicate=True))
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertNotIn('duplicate_of', res.data)
+        self.assertEqual(Expense.objects.count(), 3)
+
+    def test_creator_locked_before_probing(self):
+        """Test that the creator's row is locked before the duplicate probe, so concurrent retries run one at a time"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(self.post(self.data).status_code, status.HTTP_201_CREATED)
+        statements = [query['sql'] for query in queries.captured_queries]
+        lock = next(i for i, sql in enumerate(statements) if sql.startswith('UPDATE "expenses_app_user"'))
+        probe = next(i for i, sql in enumerate(statements) if '"fingerprint" IN' in sql)
+        insert = next(i for i, sql in enumerate(statements) if sql.startswith('INSERT INTO "expenses_app_expense"'))
+        self.assertLess(lock, probe)
+        self.assertLess(probe, insert)
+        self.assertFalse(any(sql.startswith(('INSERT', 'UPDATE', 'DELETE')) for sql in statements[:lock]))
+
+    def test_duplicate_across_bucket_boundary(self):
+        """Test that an expense created in the previous time bucket is still found"""
+        import datetime
+        from django.utils import timezone
+        from .duplicates import refresh
+        first = self.post(self.data)
+        now = int(timezone.now().timestamp())
+        # One second before the current bucket starts
+        previous = datetime.datetime.fromtimestamp(now - now % 600 - 1, tz=datetime.timezone.utc)
+        Expense.objects.filter(id=first.data['id']).update(created_at=previous)
+        refresh(Expense.objects.get(id=first.data['id']))
+        with self.settings(DUPLICATE_EXPENSE_ACTION='flag', DUPLICATE_WINDOW_SECONDS=600):
+            res = self.post(self.data)
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['duplicate_of'], first.data['id'])
+
+    def test_find_duplicates_command(self):
+        """Test that the command fingerprints old expenses and reports clusters"""
+        from django.core.management import call_command
+        ids = [self.post(dict(self.data, allow_duplicate=True)).data['id'] for _ in range(2)]
+        self.post(dict(self.data, category='Rent'))
+        Expense.objects.update(fingerprint=None)
+        out = StringIO()
+        call_command('find_duplicates', stdout=out, stderr=StringIO())
+        clusters = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual([cluster['expenses'] for cluster in clusters], [ids])
+        self.assertFalse(Expense.objects.filter(fingerprint__isnull=True).exists())
+
+
+class SplitStrategyTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.third = User.objects.create_user(email='third@example.com', password='testpass123', name='Third User')
+        self.client.force_authenticate(user=self.user)
+        self.participants = [self.user.id, self.other.id, self.third.id]
+
+    def post(self, split_method, split_details=None):
+        data = {'total_amount': '100.00', 'split_method': split_method, 'participants': self.participants, 'allow_duplicate': True}
+        if split_details is not None:
+            data['split_details'] = split_details
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post('/api/expenses/', data, format='json')
+
+    def test_shares_and_adjusted_splits(self):
+        """Test that the new split methods allocate whole cents adding up to the total"""
+        res = self.post('shares', {str(self.user.id): 2, str(self.other.id): 1})
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['split_details'], {
+            str(self.user.id): '66.67', str(self.other.id): '33.33', str(self.third.id): '0.00',
+        })
+        res = self.post('adjusted', {str(self.other.id): '10.00'})
+        self.assertEqual(res.status_code, status.HTTP_201_CREATED)
+        self.assertEqual(res.data['split_details'], {
+            str(self.user.id): '30.00', str(self.other.id): '40.00', str(self.third.id): '30.00',
+        })
+        self.assertEqual(self.post('adjusted', {str(self.other.id): '-60.00'}).status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.post('shares', {'999': 1})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.post('shares').data['non_field_errors'], ['Split details are required for shares split'])
+
+    def test_existing_methods_unchanged(self):
+        """Test that the original split methods keep their outputs and messages"""
+        from .utils import calculate_split, validate_split_details
+        res = self.post('equal')
+        self.assertEqual(res.data['split_details'][str(self.other.id)], str(Decimal('100.00') / 3))
+        res = self.post('exact', {str(self.user.id): '60.00', str(self.other.id): '30.00'})
+        self.assertEqual(res.data['non_field_errors'], ['The sum of split amounts must equal the total amount'])
+        res = self.post('percentage', {str(self.user.id): 50, str(self.other.id): 25, str(self.third.id): 25})
+        self.assertEqual(res.data['split_details'][str(self.third.id)], '25.0000')
+        self.assertFalse(validate_split_details(Decimal('10'), 'percentage', {'1': 'ten'}, [self.user]))
+        with self.assertRaises(ValueError):
+            calculate_split(Decimal('10'), 'random', {}, [self.user])
+
+    def test_allocate_many(self):
+        """Test that a batch is allocated like its expenses one by one"""
+        from . import splits
+        rows = [
+            (Decimal('10.00'), {}, [self.user, self.other]),
+            (Decimal('10.00'), {}, [self.user.id, self.other.id]),
+            (Decimal('9.00'), {}, [self.user, self.other, self.third]),
+        ]
+        for name in ('equal', 'adjusted'):
+            split = splits.get(name)
+            self.assertEqual(split.allocate_many(rows), [split.allocate(*row) for row in rows])
+        self.assertEqual(dict(splits.choices())['shares'], 'Shares')
+
+
+class QueryBudgetTests(TestCase):
+    """
+    Query budgets for every route of expenses_app.urls, checked at two data
+    sizes: n other users, each sharing two expenses, a payment and a
+    recurring template with the test user.
+    """
+
+    # Route name -> most queries one request may run, given the data size.
+    # Work run on commit is part of the request's budget.
+    BUDGETS = {
+        'login': 3,
+        'generate-token': 2,
+        'token-revoke': 7,
+        'user-create': 4,
+        'user-bulk-create': 3,
+        'user-retrieve': 1,
+        'expense-create': 10,
+        'expense-detail': 13,
+        'recurring-expenses': 2,
+        'user-expenses': 2,
+        'overall-expenses': 2,
+        'payments': 1,
+        # Reads expenses and payments in chunks of exports.DEFAULT_CHUNK_SIZE
+        'balance-sheet': lambda n: 10 + 2 * (2 * n // 2000),
+        'user-balance': 4,
+        'debt-matrix': 5,
+        'statement': 2,
+        'sync': 3,
+    }
+
+    def setUp(self):
+        from .throttling import buckets
+        buckets.clear()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.admin = User.objects.create_superuser(email='admin@example.com', password='testpass123', name='Admin')
+        self.others = []
+        self.created = 0
+
+    def grow(self, size):
+        """Bring the data up to ``size`` other users, each sharing an expense and a payment with the test user"""
+        from django.db import transaction
+        from . import ledger
+        from .models import Payment, RecurringExpense
+        while len(self.others) < size:
+            index = len(self.others)
+            other = User.objects.create(email=f'user{index}@example.com', name=f'User {index}')
+            self.others.append(other)
+            with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+                for creator, debtor in ((self.user, other), (other, self.user)):
+                    expense = Expense.objects.create(
+                        total_amount=Decimal('20.00'), split_method='equal', created_by=creator, category=f'Item {index}',
+                        split_details={str(creator.id): '10.00', str(debtor.id): '10.00'},
+                    )
+                    expense.participants.add(creator, debtor)
+                    ledger.record_expense_created(expense)
+                payment = Payment.objects.create(payer=other, payee=self.user, amount=Decimal('5.00'), created_by=other)
+                ledger.record_payment_recorded(payment)
+            template = RecurringExpense.objects.create(
+                total_amount=Decimal('9.00'), split_method='equal', created_by=self.user, cadence='monthly',
+                start_date='2024-01-01', next_due='2024-01-01',
+            )
+            template.participants.add(self.user, other)
+
+    def routes(self):
+        """One request per route, as callables returning the response"""
+        from .sync import encode_token
+        self.created += 1
+        post = self.client.post
+        expense = Expense.objects.filter(created_by=self.user).order_by('-id')[0]
+        participants = [self.user.id] + [other.id for other in self.others]
+        return {
+            'login': lambda: post('/api/login/', {'email': 'test@example.com', 'password': 'testpass123'}, format='json'),
+            'generate-token': lambda: post('/api/generate-token/', {'email': 'test@example.com', 'password': 'testpass123'}, format='json'),
+            'token-revoke': lambda: post('/api/tokens/revoke/'),
+            'user-create': lambda: post('/api/users/', {
+                'email': f'new{self.created}@example.com', 'name': 'New', 'mobile': '1', 'password': 'testpass123',
+            }, format='json'),
+            'user-bulk-create': lambda: self.as_admin(lambda: post('/api/users/bulk/', [
+                {'email': f'bulk{self.created}-{i}@example.com', 'name': 'Bulk', 'mobile': '1', 'password': 'testpass123'}
+                for i in range(2)
+            ], format='json')),
+            'user-retrieve': lambda: self.client.get(f'/api/users/{self.user.id}/'),
+            'expense-create': lambda: post('/api/expenses/', {
+                'total_amount': f'{self.created}.00', 'split_method': 'equal', 'participants': participants,
+            }, format='json'),
+            'expense-detail': lambda: self.client.patch(f'/api/expenses/{expense.id}/', {
+                'participants': participants, 'version': expense.version,
+            }, format='json'),
+            'recurring-expenses': lambda: self.client.get('/api/expenses/recurring/'),
+            'user-expenses': lambda: self.client.get('/api/expenses/user/'),
+            'overall-expenses': lambda: self.client.get('/api/expenses/overall/'),
+            'payments': lambda: self.client.get('/api/payments/'),
+            'balance-sheet': lambda: self.client.get('/api/balance-sheet/'),
+            'user-balance': lambda: self.client.get('/api/balances/'),
+            'debt-matrix': lambda: self.client.get('/api/balances/matrix/'),
+            'statement': lambda: self.client.get('/api/statement/'),
+            'sync': lambda: self.client.get('/api/sync/', {'since': encode_token(self.user.id, 0)}),
+        }
+
+    def as_admin(self, request):
+        self.client.force_authenticate(user=self.admin)
+        try:
+            return request()
+        finally:
+            self.client.force_authenticate(user=self.user)
+
+    def test_every_route_has_a_budget(self):
+        """Test that no route is left without a query budget"""
+        from .urls import urlpatterns
+        self.assertEqual({pattern.name for pattern in urlpatterns}, set(self.BUDGETS))
+
+    def test_routes_within_budget(self):
+        """Test that every route stays within its budget without N+1 queries as the data grows"""
+        from .testing import query_budget
+        self.client.force_authenticate(user=self.user)
+        for size in (2, 8):
+            self.grow(size)
+            for name, request in self.routes().items():
+                with self.subTest(route=name, size=size):
+                    with query_budget(self.BUDGETS[name], size=size):
+                        with self.captureOnCommitCallbacks(execute=True):
+                            response = request()
+                        if response.streaming:
+                            b''.join(response.streaming_content)
+                    self.assertLess(response.status_code, 400, getattr(response, 'data', None))
+
+    def test_budget_reports_repeated_queries(self):
+        """Test that the helper fails on a query per row with the stack that issued it"""
+        from .testing import query_budget, query_shape
+        self.assertEqual(
+            query_shape("SELECT * FROM t WHERE id IN (%s, %s, %s) AND name = 'x' LIMIT 21"),
+            'SELECT * FROM t WHERE id IN (?, ...) AND name = ? LIMIT ?',
+        )
+        with self.assertRaises(AssertionError) as raised:
+            with query_budget(lambda n: n + 1, size=5):
+                for user_id in range(5):
+                    User.objects.filter(id=user_id).first()
+        self.assertIn('Query repeated 5 times', str(raised.exception))
+        self.assertIn('test_budget_reports_repeated_queries', str(raised.exception))
+        with self.assertRaises(AssertionError) as raised:
+            with query_budget(1):
+                User.objects.count()
+                Expense.objects.count()
+        self.assertIn('2 queries ran, the budget is 1', str(raised.exception))
+
+    def test_participants_looked_up_together(self):
+        """Test that participant ids are validated with one query and keep their error messages"""
+        self.client.force_authenticate(user=self.user)
+        res = self.client.post('/api/expenses/', {
+            'total_amount': '10.00', 'split_method': 'equal', 'participants': [self.user.id, 999],
+        }, format='json')
+        self.assertEqual(res.data['participants'], ['Invalid pk "999" - object does not exist.'])
+        res = self.client.post('/api/expenses/', {
+            'total_amount': '10.00', 'split_method': 'equal', 'participants': [True],
+        }, format='json')
+        self.assertEqual(res.data['participants'], ['Incorrect type. Expected pk value, received bool.'])
+
+
+class SyncTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+
+    def post(self, url, data, user=None):
+        self.client.force_authenticate(user=user or self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            res = self.client.post(url, data, format='json')
+        self.client.force_authenticate(user=self.user)
+        return res
+
+    def test_incremental_sync(self):
+        """Test that a sync returns only the changes since the token"""
+        from .projections import catch_up_all
+        kept = self.post('/api/expenses/', {
+            'total_amount': '100.00', 'split_method': 'equal', 'category': 'Rent', 'participants': [self.other.id],
+        }).data
+        catch_up_all()
+        full = self.client.get('/api/sync/').data
+        self.assertTrue(full['reset'])
+        self.assertEqual([expense['id'] for expense in full['expenses']], [kept['id']])
+        self.assertEqual(full['balances'], {'USD': '100.000000'})
+
+        shared = self.post('/api/expenses/', {
+            'total_amount': '30.00', 'split_method': 'equal', 'category': 'Taxi', 'participants': [self.user.id],
+        }, user=self.other).data
+        self.post('/api/expenses/', {
+            'total_amount': '8.00', 'split_method': 'equal', 'category': 'Solo', 'participants': [],
+        }, user=self.other)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.delete(f"/api/expenses/{kept['id']}/?version=1")
+        self.post('/api/payments/', {'payee': self.other.id, 'amount': '5.00'})
+
+        res = self.client.get('/api/sync/', {'since': full['token']})
+        self.assertFalse(res.data['reset'])
+        self.assertEqual([expense['id'] for expense in res.data['expenses']], [shared['id']])
+        self.assertEqual(sorted(res.data['expenses'][0]['participants']), sorted([self.user.id, self.other.id]))
+        self.assertEqual(res.data['removed'], [kept['id']])
+        # -30 share of the taxi, -100 for the deleted rent, +5 paid
+        self.assertEqual(Decimal(res.data['balances']['USD']), Decimal('-125'))
+        again = self.client.get('/api/sync/', {'since': res.data['token']}).data
+        self.assertEqual((again['expenses'], again['removed'], again['balances']), ([], [], {}))
+
+    def test_paging_and_invalid_tokens(self):
+        """Test that large syncs are split and foreign or forged tokens rejected"""
+        from .sync import changes_since, encode_token
+        for amount in ('10.00', '20.00', '30.00'):
+            self.post('/api/expenses/', {'total_amount': amount, 'split_method': 'equal', 'participants': [self.other.id]})
+        page = changes_since(self.user.id, 0, limit=2)
+        self.assertTrue(page['more'])
+        self.assertEqual(len(page['expenses']), 2)
+        res = self.client.get('/api/sync/', {'since': page['token']})
+        self.assertEqual((len(res.data['expenses']), res.data['more']), (1, False))
+        res = self.client.get('/api/sync/', {'since': 'forged'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        res = self.client.get('/api/sync/', {'since': encode_token(self.other.id, 0)})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+
+
+class SparseFieldsetTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='test@example.com', password='testpass123', name='Test User')
+        self.other = User.objects.create_user(email='other@example.com', password='testpass123', name='Other User')
+        self.client.force_authenticate(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.expense = self.client.post('/api/expenses/', {
+                'total_amount': '90.00', 'split_method': 'equal', 'category': 'Hotel',
+                'participants': [self.user.id, self.other.id],
+            }, format='json').data
+
+    def test_user_expenses_fields(self):
+        """Test that ?fields= narrows user expense entries without changing the shape of participants"""
+        full = self.client.get('/api/expenses/user/').data
+        self.assertEqual(full[0]['participants'][0]['name'], 'Other User')
+        self.assertNotIn('participant_ids', full[0])
+
+        res = self.client.get('/api/expenses/user/', {'fields': 'total_amount,category'})
+        self.assertEqual(res.data, [{'category': 'Hotel', 'total_amount': Decimal('90.00')}])
+        res = self.client.get('/api/expenses/user/', {'fields': 'your_share,participants'})
+        self.assertEqual(res.data, [{'your_share': full[0]['your_share'], 'participants': full[0]['participants']}])
+        res = self.client.get('/api/expenses/user/', {'fields': 'expense_id,participant_ids'})
+        self.assertEqual(res.data, [{'expense_id': self.expense['id'], 'participant_ids': [self.other.id]}])
+
+    def test_overall_expenses_fields(self):
+        """Test that ?fields= narrows overall expenses and ?expand= embeds participants"""
+        res = self.client.get('/api/expenses/overall/', {'fields': 'id,total_amount'})
+        self.assertEqual(res.data, [{'id': self.expense['id'], 'total_amount': '90.00'}])
+        res = self.client.get('/api/expenses/overall/', {'fields': 'category', 'expand': 'participants'})
+        self.assertEqual(res.data, [{'category': 'Hotel', 'participants': [
+            {'id': self.user.id, 'name': 'Test User', 'email': 'test@example.com'},
+            {'id': self.other.id, 'name': 'Other User', 'email': 'other@example.com'},
+        ]}])
+        res = self.client.get('/api/expenses/overall/')
+        self.assertEqual(res.data[0]['split_details'], self.expense['split_details'])
+
+    def test_fields_narrow_queries(self):
+        """Test that lists without participants skip the participants query and unselected columns"""
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+        for url in ('/api/expenses/user/', '/api/expenses/overall/'):
+            with CaptureQueriesContext(connection) as full:
+                self.client.get(url)
+            with CaptureQueriesContext(connection) as narrow:
+                self.client.get(url, {'fields': 'total_amount'})
+            self.assertEqual(len(narrow) + 1, len(full))
+            self.assertNotIn('split_details', narrow[-1]['sql'])
+
+    def test_unknown_fields(self):
+        """Test that unknown fields and expansions are rejected"""
+        res = self.client.get('/api/expenses/overall/', {'fields': 'id,secret'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertIn('secret', str(res.data['fields']))
+        res = self.client.get('/api/expenses/overall/', {'expand': 'category'})
+        self.assertEqual(res.status_code, status.HTTP_400_BAD_REQUEST)
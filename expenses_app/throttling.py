@@ -0,0 +1,103 @@
+"""
+Per-user token bucket throttling for expensive endpoints.
+
+Each user has one bucket per ``throttle_scope``, holding up to
+``capacity`` tokens and refilled continuously at ``refill_rate`` tokens
+per second; each request takes one token and is rejected with 429 and a
+``Retry-After`` when the bucket is empty. Short bursts are therefore
+allowed while the sustained rate stays bounded. Rates are configured per
+scope in ``TOKEN_BUCKET_RATES``.
+
+Buckets live in process memory, like the metrics registry; with several
+workers each enforces its own bucket.
+"""
+import threading
+import time
+
+from django.conf import settings
+from rest_framework.throttling import BaseThrottle
+
+from . import metrics
+
+
+THROTTLED_REQUESTS = metrics.registry.counter(
+    'throttled_requests_total',
+    'Requests rejected by the token bucket throttle, by scope.',
+    ('scope',),
+)
+
+# Full buckets are dropped once this many are held.
+MAX_BUCKETS = 10000
+
+
+class TokenBuckets:
+    """
+    Thread-safe set of token buckets keyed by (scope, user id).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    def take(self, key, capacity, refill_rate, now=None):
+        """
+        Take one token from a bucket.
+
+        :param key: Bucket key
+        :param capacity: Maximum number of tokens
+        :param refill_rate: Tokens added per second
+        :param now: Current monotonic time, for tests
+        :return: 0 if a token was taken, else seconds until one is available
+        """
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                wait = 0
+            else:
+                self._buckets[key] = (tokens, now)
+                wait = (1 - tokens) / refill_rate
+            if len(self._buckets) > MAX_BUCKETS:
+                self._prune(now, capacity, refill_rate)
+        return wait
+
+    def _prune(self, now, capacity, refill_rate):
+        idle = capacity / refill_rate
+        for key, (_, updated) in list(self._buckets.items()):
+            if now - updated >= idle:
+                del self._buckets[key]
+
+
+buckets = TokenBuckets()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    """
+    Throttle applying the bucket of the view's ``throttle_scope``.
+
+    Anonymous requests share one bucket per client address.
+    """
+
+    def allow_request(self, request, view):
+        scope = getattr(view, 'throttle_scope', None)
+        rate = settings.TOKEN_BUCKET_RATES.get(scope) if scope else None
+        if rate is None:
+            return True
+        if request.user and request.user.is_authenticated:
+            ident = request.user.pk
+        else:
+            ident = self.get_ident(request)
+        self._wait = buckets.take((scope, ident), rate['capacity'], rate['refill_rate'])
+        if self._wait:
+            THROTTLED_REQUESTS.inc(scope)
+            return False
+        return True
+
+    def wait(self):
+        return self._wait
@@ -1,15 +1,24 @@
 from django.urls import path
-from .views import LoginView, GenerateTokenView,UserCreateView, UserRetrieveView, ExpenseCreateView, UserExpensesView, OverallExpensesView, BalanceSheetView, UserBalanceView
+from .views import LoginView, GenerateTokenView, TokenRevokeView, UserCreateView, BulkUserCreateView, UserRetrieveView, ExpenseCreateView, ExpenseDetailView, RecurringExpenseListCreateView, PaymentListCreateView, UserExpensesView, OverallExpensesView, BalanceSheetView, UserBalanceView, DebtMatrixView, StatementView, SyncView
 
 
 urlpatterns = [
     path('login/', LoginView.as_view(), name='login'),
     path('generate-token/', GenerateTokenView.as_view(), name='generate-token'),
+    path('tokens/revoke/', TokenRevokeView.as_view(), name='token-revoke'),
     path('users/', UserCreateView.as_view(), name='user-create'),
+    path('users/bulk/', BulkUserCreateView.as_view(), name='user-bulk-create'),
     path('users/<int:pk>/', UserRetrieveView.as_view(), name='user-retrieve'),
     path('expenses/', ExpenseCreateView.as_view(), name='expense-create'),
+    path('expenses/<int:pk>/', ExpenseDetailView.as_view(), name='expense-detail'),
+    path('expenses/recurring/', RecurringExpenseListCreateView.as_view(), name='recurring-expenses'),
     path('expenses/user/', UserExpensesView.as_view(), name='user-expenses'),
     path('expenses/overall/', OverallExpensesView.as_view(), name='overall-expenses'),
+    path('payments/', PaymentListCreateView.as_view(), name='payments'),
     path('balance-sheet/', BalanceSheetView.as_view(), name='balance-sheet'),
+    path('balances/', UserBalanceView.as_view(), name='user-balance'),
+    path('balances/matrix/', DebtMatrixView.as_view(), name='debt-matrix'),
+    path('statement/', StatementView.as_view(), name='statement'),
+    path('sync/', SyncView.as_view(), name='sync'),
     
 ]
\ No newline at end of file
@@ -1,27 +1,11 @@
-from decimal import Decimal
+from . import splits
 
 def calculate_split(total_amount, split_method, split_details, participants):
-    if split_method == 'equal':
-        share = total_amount / len(participants)
-        return {str(user.id): str(share) for user in participants}
-    elif split_method == 'exact':
-        return split_details
-    elif split_method == 'percentage':
-        return {
-            user_id: str(Decimal(percent) / 100 * total_amount)
-            for user_id, percent in split_details.items()
-        }
-    else:
-        raise ValueError("Invalid split method")
+    return splits.get(split_method).allocate(total_amount, split_details, participants)
 
 def validate_split_details(total_amount, split_method, split_details, participants):
-    if split_method == 'equal':
-        return True
-    elif split_method == 'exact':
-        total_split = sum(Decimal(amount) for amount in split_details.values())
-        return total_split == total_amount
-    elif split_method == 'percentage':
-        total_percentage = sum(Decimal(percent) for percent in split_details.values())
-        return total_percentage == 100
-    else:
-        return False
\ No newline at end of file
+    try:
+        splits.get(split_method).validate(total_amount, split_details, participants)
+    except splits.SplitError:
+        return False
+    return True
@@ -1,20 +1,58 @@
-from django.shortcuts import render
-from rest_framework import generics, permissions, status, serializers
+from django.shortcuts import render, get_object_or_404
+from rest_framework import generics, permissions, status, serializers, exceptions
 from rest_framework.response import Response
-from .serializers import ExpenseSerializer
+from .serializers import ArchivedExpenseSerializer, ExpenseSerializer, PaymentSerializer, RecurringExpenseSerializer
 from django.db import transaction
-from django.http import HttpResponse
+from django.http import HttpResponse, StreamingHttpResponse
 from rest_framework.views import APIView
-from .models import Expense, User
+from .models import ArchivedExpense, Expense, Payment, RecurringExpense, User
 import csv
 from decimal import Decimal
 from django.db.models import Sum, F, Q, Sum, Min, Max
 from rest_framework.authtoken.models import Token
-from .serializers import UserSerializer
+from .serializers import BulkUserSerializer, UserSerializer
 from django.contrib.auth import authenticate
 from rest_framework.permissions import IsAuthenticated
 from collections import defaultdict
 from io import BytesIO, StringIO
+from django.conf import settings
+from django.utils import timezone
+from . import duplicates, exports, fx, ledger, metrics, sync
+from .authentication import issue_signed_token, revoke_signed_tokens
+from .filters import filter_expenses, include_archived, sparse_fieldset
+from .readers import ValuesReader, participant_details
+from .statements import StatementParamsSerializer, statement_page
+from .archive import opening_debts
+from .coalescing import SingleFlight
+from .debts import DebtMatrix, DebtMatrixParamsSerializer
+from .throttling import TokenBucketThrottle
+from rest_framework.utils.urls import replace_query_param
+from .renderers import FastJSONRenderer, PassthroughRenderer
+from rest_framework.settings import api_settings
+
+
+TOKEN_TYPES = ('key', 'signed')
+
+
+def issue_token(request, user):
+    """
+    Issue an auth token of the type requested by the client.
+
+    Clients may send ``token_type`` set to ``key`` (a stored authtoken key)
+    or ``signed`` (a stateless signed token); ``AUTH_TOKEN_TYPE`` is used
+    when they don't.
+
+    :param request: The HTTP request object
+    :param user: The authenticated user
+    :return: Token string
+    :raises ValidationError: If the requested token type is unknown
+    """
+    token_type = request.data.get('token_type', settings.AUTH_TOKEN_TYPE)
+    if token_type not in TOKEN_TYPES:
+        raise serializers.ValidationError({'token_type': f"Must be one of: {', '.join(TOKEN_TYPES)}"})
+    if token_type == 'signed':
+        return issue_signed_token(user)
+    return Token.objects.get_or_create(user=user)[0].key
 
 
 
@@ -47,7 +85,7 @@ class LoginView(APIView):
         user = authenticate(request, username=email, password=password)
         
         if user:
-            token = Token.objects.get_or_create(user=user)[0].key
+            token = issue_token(request, user)
             return Response({'token': token}, status=status.HTTP_200_OK)
         else:
              # Authentication failed
@@ -84,9 +122,9 @@ class GenerateTokenView(APIView):
         
         if user:
             # Generate or retrieve token for authenticated user
-            token, created = Token.objects.get_or_create(user=user)
+            token = issue_token(request, user)
             return Response({
-                'token': token.key,
+                'token': token,
                 'user_id': user.id,
                 'email': user.email
             }, status=status.HTTP_200_OK)
@@ -94,6 +132,30 @@ class GenerateTokenView(APIView):
             # Authentication failed
             return Response({'error': 'Invalid credentials'}, status=status.HTTP_401_UNAUTHORIZED)
 
+class TokenRevokeView(APIView):
+    """
+    API View for revoking all of the authenticated user's tokens.
+
+    This view handles POST requests to sign the user out everywhere. It
+    bumps the user's signed-token version, which invalidates every signed
+    token issued so far, and deletes the user's stored authtoken key.
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def post(self, request):
+        """
+        Handle POST request to revoke the user's tokens.
+
+        :param request: The HTTP request object
+        :return: Empty response with status 204
+        """
+
+        user = request.user
+        revoke_signed_tokens(user)
+        Token.objects.filter(user_id=user.id).delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
 class UserCreateView(generics.CreateAPIView):
     """
     API View for creating new users.
@@ -133,6 +195,25 @@ class UserCreateView(generics.CreateAPIView):
             'token': token.key
         }, status=status.HTTP_201_CREATED)
 
+class BulkUserCreateView(generics.CreateAPIView):
+    """
+    API View for registering many users at once.
+
+    This view handles POST requests with a list of users (``email``,
+    ``name``, ``mobile``, ``password``), e.g. to onboard a whole company.
+    Passwords are hashed in parallel on a process pool and the users and
+    their auth tokens are written in bulk. The list is created entirely or
+    not at all. Only staff users may access this view.
+    """
+
+    serializer_class = BulkUserSerializer
+    permission_classes = [permissions.IsAdminUser]
+
+    def get_serializer(self, *args, **kwargs):
+        kwargs.update(many=True, allow_empty=False, max_length=settings.BULK_USERS_MAX)
+        return super().get_serializer(*args, **kwargs)
+
+
 class UserRetrieveView(generics.RetrieveAPIView):
     """
     API View for retrieving user details.
@@ -151,6 +232,16 @@ class UserRetrieveView(generics.RetrieveAPIView):
     # based on the provided primary key (pk) in the URL.
     
 
+class DuplicateExpense(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'An identical expense was created moments ago. Send allow_duplicate to create it anyway.'
+    default_code = 'duplicate'
+
+    def __init__(self, duplicate_of):
+        super().__init__()
+        self.detail = {'detail': self.detail, 'duplicate_of': duplicate_of}
+
+
 class ExpenseCreateView(generics.CreateAPIView):
     """
     API View for creating new expenses.
@@ -158,44 +249,253 @@ class ExpenseCreateView(generics.CreateAPIView):
     This view handles POST requests to create a new expense.
     It uses the ExpenseSerializer for data validation and creation.
     Only authenticated users can access this view (IsAuthenticated permission).
+
+    An expense with the same creator, amount, currency, participants and
+    category as one created within ``DUPLICATE_WINDOW_SECONDS`` is a
+    duplicate, found with one probe of the fingerprint index. Depending on
+    ``DUPLICATE_EXPENSE_ACTION`` it is rejected with 409 Conflict or
+    created with ``duplicate_of`` in the response; ``allow_duplicate: true``
+    in the body creates it regardless.
     """
     
     serializer_class = ExpenseSerializer
     permission_classes = [permissions.IsAuthenticated]
 
+    def create(self, request, *args, **kwargs):
+        self.duplicate_of = None
+        response = super().create(request, *args, **kwargs)
+        if self.duplicate_of is not None:
+            response.data['duplicate_of'] = self.duplicate_of
+        return response
+
     def perform_create(self, serializer):
         """
         Custom method to perform the creation of a new expense.
         
         This method is called by CreateAPIView when saving the new expense instance.
-        It sets the created_by field to the current user and handles the association
-        of participants with the expense.
+        It sets the created_by field to the current user, handles the association
+        of participants with the expense and records the creation in the ledger,
+        all in one transaction.
         
         :param serializer: The validated serializer instance
+        :raises DuplicateExpense: If the expense is a duplicate and duplicates are rejected
         """
-        
-        # Save the expense with the current user as the creator
-        expense = serializer.save(created_by=self.request.user)
-        
-        # Get the list of participant IDs from the request data
-        participants = self.request.data.get('participants', [])
-        
-         # Ensure the creator is also a participant
-        if self.request.user.id not in participants:
-            participants.append(self.request.user.id)
-        
-         # Add all participants to the expense
-        expense.participants.add(*participants)
+
+        data = serializer.validated_data
+        created_at = timezone.now()
+        fingerprints = duplicates.candidate_fingerprints(
+            self.request.user.id,
+            data['total_amount'],
+            data.get('currency') or settings.DEFAULT_CURRENCY,
+            [user.id for user in data.get('participants', [])],
+            data.get('category', ''),
+            created_at,
+        )
+        try:
+            allow_duplicate = serializers.BooleanField().to_internal_value(self.request.data.get('allow_duplicate', False))
+        except serializers.ValidationError as exc:
+            raise serializers.ValidationError({'allow_duplicate': exc.detail})
+
+        with transaction.atomic():
+            if not allow_duplicate:
+                duplicates.lock_creator(self.request.user.id)
+                self.duplicate_of = duplicates.find_duplicate(fingerprints)
+                if self.duplicate_of is not None and settings.DUPLICATE_EXPENSE_ACTION == 'reject':
+                    raise DuplicateExpense(self.duplicate_of)
+
+            # Save the expense with the current user as the creator
+            expense = serializer.save(created_by=self.request.user, created_at=created_at, fingerprint=fingerprints[0])
+
+            # Get the list of participant IDs from the request data
+            participants = self.request.data.get('participants', [])
+
+            # Ensure the creator is also a participant
+            if self.request.user.id not in participants:
+                participants.append(self.request.user.id)
+
+            # Add all participants to the expense
+            expense.participants.add(*participants)
+
+            # Append the ledger event in the same transaction as the expense
+            ledger.record_expense_created(expense)
+        metrics.EXPENSE_SPLIT_SIZE.observe(len(set(participants)))
+
+
+class RecurringExpenseListCreateView(generics.ListCreateAPIView):
+    """
+    API View for listing and creating the user's recurring expense templates.
+
+    Occurrences are not created by this view; the materialize_recurring
+    management command, run on a schedule, turns each due occurrence into an
+    expense. Only authenticated users can access this view.
+    """
+
+    serializer_class = RecurringExpenseSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        return RecurringExpense.objects.filter(created_by=self.request.user.id).prefetch_related('participants').order_by('id')
+
+    def perform_create(self, serializer):
+        serializer.save(created_by=self.request.user)
+
+
+class PaymentListCreateView(generics.ListCreateAPIView):
+    """
+    API View for recording and listing settlements between users.
+
+    This view handles POST requests recording that the payer paid the payee
+    an amount outside of any expense, and GET requests listing the payments
+    the current user made or received, newest first. A payment is recorded
+    in the ledger in the same transaction, so balances are updated by the
+    projections incrementally instead of being recomputed.
+
+    Only authenticated users can access this view (IsAuthenticated permission).
+    """
+
+    serializer_class = PaymentSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        user_id = self.request.user.id
+        return Payment.objects.filter(Q(payer=user_id) | Q(payee=user_id)).order_by('-created_at', '-id')
+
+    def perform_create(self, serializer):
+        with transaction.atomic():
+            payment = serializer.save(created_by=self.request.user)
+            ledger.record_payment_recorded(payment)
+
+
+class ExpenseVersionConflict(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = 'The expense was changed by someone else. Reload it and try again.'
+    default_code = 'conflict'
+
+
+class ExpenseDetailView(generics.RetrieveUpdateDestroyAPIView):
+    """
+    API View for retrieving, editing and deleting a single expense.
+
+    Any participant or the creator can retrieve the expense; only the creator
+    can edit or delete it. Edits and deletes must send the ``version`` they are
+    based on (in the body, or as a query parameter for DELETE); if the expense
+    has changed since, the request fails with 409 Conflict.
+
+    The version check is the change's first write: a conditional UPDATE
+    bumps the version only if it still is the one sent (compare-and-swap),
+    so of two concurrent changes based on the same version exactly one
+    proceeds and the other gets 409. The change is recorded in the ledger
+    with its before and after states, so derived balances apply only the
+    difference instead of being recomputed.
+    """
+
+    serializer_class = ExpenseSerializer
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get_queryset(self):
+        """
+        Get the expenses the current user created or takes part in.
+
+        :return: QuerySet of Expense objects
+        """
+        user_id = self.request.user.id
+        return Expense.objects.filter(Q(created_by=user_id) | Q(participants=user_id)).distinct()
+
+    def claim_expense(self):
+        """
+        Bump the expense's version if it is still the one sent, and check the
+        caller may change it.
+
+        Must be called inside a transaction, before it reads anything: the
+        conditional UPDATE is both the version check and the write lock, and
+        SQLite can fail a transaction that reads before its first write with
+        "database is locked" when another writer gets in between.
+
+        :return: The Expense instance, with the new version and the other
+                 fields as before the change
+        :raises PermissionDenied: If the current user did not create the expense
+        :raises ValidationError: If no valid version was sent
+        :raises ExpenseVersionConflict: If the sent version is not the current one
+        """
+        pk = self.kwargs['pk']
+        try:
+            version = int(self.request.data.get('version', self.request.query_params.get('version')))
+        except (TypeError, ValueError):
+            version = None
+        if version is not None:
+            claimed = (
+                Expense.objects.filter(pk=pk, version=version, created_by=self.request.user.id)
+                .update(version=F('version') + 1)
+            )
+            if claimed:
+                return Expense.objects.get(pk=pk)
+
+        # Nothing changed: find out why
+        expense = get_object_or_404(self.get_queryset(), pk=pk)
+        if expense.created_by_id != self.request.user.id:
+            raise exceptions.PermissionDenied('Only the creator of an expense can change it.')
+        if version is None:
+            raise serializers.ValidationError({'version': 'The version of the expense being changed is required.'})
+        raise ExpenseVersionConflict()
+
+    def update(self, request, *args, **kwargs):
+        """
+        Handle PUT and PATCH requests to edit an expense.
+
+        :param request: The HTTP request object
+        :return: Response with the updated expense
+        """
+
+        partial = kwargs.pop('partial', False)
+        with transaction.atomic():
+            expense = self.claim_expense()
+            before = ledger.expense_state(expense)
+            serializer = self.get_serializer(expense, data=request.data, partial=partial)
+            serializer.is_valid(raise_exception=True)
+            expense = serializer.save()
+
+            # Keep the creator a participant, as on creation
+            expense.participants.add(request.user.id)
+            duplicates.refresh(expense)
+
+            ledger.record_expense_edited(before, expense)
+        return Response(serializer.data)
+
+    def destroy(self, request, *args, **kwargs):
+        """
+        Handle DELETE requests to remove an expense.
+
+        :param request: The HTTP request object
+        :return: Empty response with status 204
+        """
+
+        with transaction.atomic():
+            expense = self.claim_expense()
+            before = ledger.expense_state(expense)
+            expense_id = expense.id
+            expense.delete()
+            ledger.record_expense_deleted(before, expense_id)
+        return Response(status=status.HTTP_204_NO_CONTENT)
 
 class UserExpensesView(generics.ListAPIView):
     """
     API View for retrieving a list of expenses for the authenticated user.
     
     This view handles GET requests to fetch all expenses associated with the current user.
+    The list can be narrowed with the query parameters of ExpenseFilterSerializer;
+    ``?include_archived=1`` appends the user's archived expenses.
+
+    ``?fields=expense_id,total_amount`` returns only those keys of each
+    entry and reads only the columns they need. ``participants`` always
+    lists the other participants with their names, emails and shares;
+    ``participant_ids``, only returned when asked for, lists their ids
+    without reading users or shares.
     Only authenticated users can access this view (IsAuthenticated permission).
     """
     
     permission_classes = [permissions.IsAuthenticated]
+    default_fields = ['expense_id', 'category', 'total_amount', 'split_method', 'your_share', 'participants']
+    fields = default_fields + ['participant_ids']
 
     def list(self, request, *args, **kwargs):
         
@@ -211,31 +511,66 @@ class UserExpensesView(generics.ListAPIView):
         :return: Response with a list of expense data for the user
         """
         
-        user = request.user
-        expenses = Expense.objects.filter(participants=user)
+        user_id = request.user.id
+        fields, _ = sparse_fieldset(request.query_params, self.fields)
+        if fields is None:
+            fields = set(self.default_fields)
+        expense_data = self.describe(filter_expenses(self.get_queryset(), request.query_params), user_id, fields)
+        if include_archived(request.query_params):
+            archived = ArchivedExpense.objects.filter(participants=user_id)
+            expense_data += self.describe(filter_expenses(archived, request.query_params), user_id, fields)
+        return Response(expense_data)
 
-        expense_data = []
-        for expense in expenses:
-            # Prepare participant data, excluding the current user
-            participants = []
-            for participant in expense.participants.exclude(id=user.id):
-                participants.append({
-                    "id": participant.id,
-                    "name": participant.name or f"User {participant.id}",
-                    "email": participant.email,
-                    "share": Decimal(expense.split_details.get(str(participant.id), 0))
-                })
-            # Compile expense details
-            expense_data.append({
-                "expense_id": expense.id,
-                "category": expense.category,
-                "total_amount": expense.total_amount,
-                "split_method": expense.split_method,
-                "your_share": Decimal(expense.split_details.get(str(user.id), 0)),
-                "participants": participants
-            })
+    def describe(self, expenses, user_id, fields):
+        """
+        Build the response entries of a queryset of expenses.
 
-        return Response(expense_data)
+        :param expenses: Expense or ArchivedExpense queryset
+        :param user_id: Id of the current user
+        :param fields: Names of the keys to include
+        :return: list of expense dicts
+        """
+        # Select only the columns the requested keys are built from
+        needed = {'expense_id': 'id', 'category': 'category', 'total_amount': 'total_amount', 'split_method': 'split_method'}
+        columns = ['id'] + [column for key, column in needed.items() if key in fields and key != 'expense_id']
+        if 'your_share' in fields or 'participants' in fields:
+            columns.append('split_details')
+        rows = [dict(zip(columns, row)) for row in expenses.values_list(*columns)]
+
+        # Other participants of every listed expense, in one query; names
+        # and emails are joined only for ``participants``
+        participants = defaultdict(list)
+        if rows and 'participants' in fields:
+            participants.update(participant_details(expenses, exclude=user_id))
+        elif rows and 'participant_ids' in fields:
+            source = expenses.model._meta.get_field('participants').m2m_field_name()
+            others = (
+                expenses.model.participants.through.objects
+                .filter(**{f'{source}__in': expenses.order_by().values('pk')})
+                .exclude(user_id=user_id)
+                .order_by(f'{source}_id', 'user_id')
+                .values_list(f'{source}_id', 'user_id')
+            )
+            for expense_id, participant_id in others:
+                participants[expense_id].append((participant_id, None, None))
+
+        expense_data = []
+        for row in rows:
+            # Compile expense details, excluding the current user from the participants
+            entry = {key: row[column] for key, column in needed.items() if key in fields}
+            if 'your_share' in fields:
+                entry["your_share"] = Decimal(row['split_details'].get(str(user_id), 0))
+            if 'participants' in fields:
+                entry["participants"] = [{
+                    "id": participant_id,
+                    "name": name or f"User {participant_id}",
+                    "email": email,
+                    "share": Decimal(row['split_details'].get(str(participant_id), 0))
+                } for participant_id, name, email in participants[row['id']]]
+            if 'participant_ids' in fields:
+                entry["participant_ids"] = [participant_id for participant_id, _, _ in participants[row['id']]]
+            expense_data.append(entry)
+        return expense_data
     
     
     def get_queryset(self):
@@ -244,7 +579,7 @@ class UserExpensesView(generics.ListAPIView):
         
         :return: QuerySet of Expense objects associated with the current user
         """
-        return Expense.objects.filter(participants=self.request.user)
+        return Expense.objects.filter(participants=self.request.user.id)
     
 class OverallExpensesView(generics.ListAPIView):
     
@@ -254,107 +589,145 @@ class OverallExpensesView(generics.ListAPIView):
     This view handles GET requests to fetch all expenses, regardless of the user.
     Only authenticated users can access this view (IsAuthenticated permission).
     
-    It uses the ExpenseSerializer to serialize the expense data.
+    It uses the ExpenseSerializer to serialize the expense data. The list can be
+    narrowed with the query parameters of ExpenseFilterSerializer;
+    ``?include_archived=1`` appends the matching archived expenses.
+
+    ``?fields=id,total_amount,category`` returns only those fields and
+    selects only their columns; the participants query runs only when
+    ``participants`` is asked for. ``?expand=participants`` replaces the
+    participant ids with objects holding their ids, names and emails.
     """
     
     serializer_class = ExpenseSerializer
     permission_classes = [permissions.IsAuthenticated]
     queryset = Expense.objects.all()
-    # Note: This class uses the default implementation of ListAPIView
-    # It will return all expenses in the system, serialized using ExpenseSerializer
-    # The queryset is set to retrieve all Expense objects
-    # Additional filtering or ordering could be added by overriding get_queryset() if needed
+    reader = ValuesReader(ExpenseSerializer)
+    archived_reader = ValuesReader(ArchivedExpenseSerializer)
+
+    def get_queryset(self):
+        """
+        Get all expenses matching the request's filter parameters.
+
+        :return: Filtered QuerySet of Expense objects
+        """
+        return filter_expenses(super().get_queryset(), self.request.query_params)
+
+    def list(self, request, *args, **kwargs):
+        """
+        Handle GET requests with the read-only fast path.
+
+        The response is identical to ExpenseSerializer's, but is built from
+        ``values()`` rows by ValuesReader instead of serializing each expense.
+
+        :param request: The HTTP request object
+        :return: Response with the list of expenses
+        """
+        fields, expand = sparse_fieldset(request.query_params, ExpenseSerializer.Meta.fields, ['participants'])
+        querysets = [(self.reader, self.filter_queryset(self.get_queryset()))]
+        if include_archived(request.query_params):
+            querysets.append((self.archived_reader, filter_expenses(ArchivedExpense.objects.all(), request.query_params)))
+        expanded = 'participants' in expand
+        # Expanded participants are matched to their expense by id
+        read_fields = fields | {'id'} if expanded and fields is not None and 'id' not in fields else fields
+        data = []
+        for reader, queryset in querysets:
+            rows = reader.read(queryset, read_fields)
+            if expanded and rows:
+                details = participant_details(queryset)
+                for row in rows:
+                    row['participants'] = [
+                        {'id': user_id, 'name': name, 'email': email} for user_id, name, email in details.get(row['id'], [])
+                    ]
+                    if read_fields is not fields:
+                        del row['id']
+            data += rows
+        return Response(data)
      
 class BalanceSheetView(APIView):
     """
-    API View for generating a detailed balance sheet as a CSV file.
+    API View for generating a detailed balance sheet export.
     
     This view handles GET requests to create a comprehensive balance sheet
-    for all users and expenses in the system. The balance sheet is returned
-    as a downloadable CSV file.
+    for all users and expenses in the system. The balance sheet is streamed
+    as a downloadable file in the format chosen with ``?format=``: ``csv``
+    (the default), ``jsonl`` or ``npz`` (see expenses_app.exports). Adding
+    ``?compress=gzip`` gzips the file on the fly.
+
+    Concurrent identical requests share one computation (see
+    expenses_app.coalescing); requests are throttled per user with the
+    ``reports`` token bucket, and beyond ``COALESCE_MAX_IN_FLIGHT`` distinct
+    computations new ones are refused with 503.
+
+    Expense rows keep their own currency; the summary and the user balances
+    are converted into the reporting currency, chosen with ``?currency=``
+    and defaulting to ``REPORTING_CURRENCY``.
     
     Only authenticated users can access this view (IsAuthenticated permission).
     """
     
     permission_classes = [IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'reports'
+    flights = SingleFlight('balance_sheet')
+    renderer_classes = [
+        *api_settings.DEFAULT_RENDERER_CLASSES,
+        *(PassthroughRenderer.for_format(name, exporter.media_type) for name, exporter in exports.EXPORTERS.items()),
+    ]
+
+    def handle_exception(self, exc):
+        # Errors are reported as JSON whatever export format was requested.
+        response = super().handle_exception(exc)
+        self.request.accepted_renderer = FastJSONRenderer()
+        self.request.accepted_media_type = FastJSONRenderer.media_type
+        return response
 
     def get(self, request):
         """
-        Handle GET request to generate the balance sheet CSV.
+        Handle GET request to stream the balance sheet.
         
-        This method retrieves all expenses and users, calculates necessary totals,
-        and generates a CSV file with the following sections:
+        The CSV export has the following sections:
         1. Overall Expenses Summary
         2. Individual Expense Details
         3. User Balances
+
+        Expenses are read in chunks while the response is written, and a
+        coalesced response keeps a chunk only until every reader has sent
+        it, so memory use does not grow with the number of expenses.
         
         :param request: The HTTP request object
-        :return: HttpResponse with the CSV file as an attachment
+        :return: StreamingHttpResponse with the export as an attachment
         """
         
-        expenses = Expense.objects.all().order_by('created_at')
-        users = User.objects.all()
-
-        # Prepare CSV data
-        csv_buffer = StringIO()
-        writer = csv.writer(csv_buffer)
-
-        # 1. Overall Expenses Summary
-        total_expenses = expenses.aggregate(Sum('total_amount'))['total_amount__sum'] or Decimal('0')
-        expense_count = expenses.count()
-        date_range = expenses.aggregate(Min('created_at'), Max('created_at'))
-
-        writer.writerows([
-            ['Overall Expenses Summary'],
-            ['Total Expenses', f'{total_expenses:.2f}'],
-            ['Number of Expenses', expense_count],
-            []
-        ])
-
-        # 2. Individual Expense Details
-        user_names = [user.name for user in users]
-        writer.writerows([
-            ['Individual Expense Details'],
-            ['Date', 'Description', 'Total Amount', 'Paid By', 'Split Method', 'Participants'] + [f'{name} Share' for name in user_names]
-        ])
+        # ?format=json and ?format=api pass content negotiation but are not
+        # exports; they get the same 404 as any other unknown format.
+        exporter_class = exports.EXPORTERS.get(request.query_params.get('format', 'csv'))
+        if exporter_class is None:
+            raise exceptions.NotFound(f"Unknown export format. Use one of: {', '.join(exports.EXPORTERS)}.")
+        exporter = exporter_class()
+        compression = request.query_params.get('compress', '')
+        if compression not in ('', 'gzip'):
+            raise serializers.ValidationError({'compress': 'Must be gzip or empty.'})
+        currency = fx.reporting_currency(request)
 
-        for expense in expenses:
-            participants = expense.participants.all()
-            participant_shares = [f'{Decimal(expense.split_details.get(str(user.id), 0)):.2f}' for user in users]
-            writer.writerow([
-                expense.created_at.strftime('%Y-%m-%d'),
-                expense.category,
-                f'{expense.total_amount:.2f}',
-                expense.created_by.name,
-                expense.split_method,
-                ';'.join([user.name for user in participants]),
-            ] + participant_shares)
-
-        writer.writerow([])
-
-        # 3. User Balances 
-        writer.writerows([
-            ['User Balances'],
-            ['User', 'Total Paid', 'Total Owed']
-        ])
-
-        for i in range(len(users)):
-    user = users[i]
-    total_paid = expenses.filter(created_by=user).aggregate(Sum('total_amount'))['total_amount__sum'] or Decimal('0')
-    total_owed = 0
-    
-    for expense in expenses:
-        total_owed += Decimal(expense.split_details.get(str(user.id), 0))
-    
-    writer.writerow([
-        user.name,
-        f'{total_paid:.2f}',
-        f'{total_owed:.2f}'
-    ])
+        # The sheet is the same for every user: identical requests share one computation.
+        key = (exporter.format, compression, currency)
+        stream = self.flights.join(key)
+        if stream is None:
+            self.flights.reserve()
+            exporter.check()
+            source = exporter.stream(exports.BalanceSheet(currency))
+            if compression:
+                source = exports.compress(source)
+            stream = self.flights.start(key, source)
 
-        # Generate CSV response
-        response = HttpResponse(csv_buffer.getvalue(), content_type='text/csv')
-        response['Content-Disposition'] = 'attachment; filename="detailed_balance_sheet.csv"'
+        filename = f'detailed_balance_sheet.{exporter.extension}'
+        content_type = exporter.media_type
+        if compression:
+            filename += '.gz'
+            content_type = 'application/gzip'
+        response = StreamingHttpResponse(stream, content_type=content_type)
+        response['Content-Disposition'] = f'attachment; filename="{filename}"'
 
         return response
         
@@ -365,11 +738,15 @@ class UserBalanceView(APIView):
     
     This view handles GET requests to calculate and return the current user's
     balance with respect to all other users they have shared expenses with.
+    Amounts are converted into the reporting currency, chosen with
+    ``?currency=`` and defaulting to ``REPORTING_CURRENCY``.
     
     Only authenticated users can access this view (IsAuthenticated permission).
     """
     
     permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'reports'
 
     def get(self, request):
         """
@@ -377,38 +754,181 @@ class UserBalanceView(APIView):
         
         This method calculates the balance between the current user and all other users
         they have shared expenses with. It considers both expenses created by the user
-        and expenses where the user is a participant.
+        and expenses where the user is a participant, and the payments the user made
+        or received.
         
         :param request: The HTTP request object
-        :return: Response with a dictionary of balances, where keys are user IDs and
-                 values are the balance amounts (positive if owed to the current user,
-                 negative if the current user owes)
+        :return: Response with a dictionary of balances, where keys are the other
+                 users' emails and values are the balance amounts (positive if owed
+                 to the current user, negative if the current user owes)
         """
         
-        user = request.user
-        balances = {}
+        user_id = request.user.id
+        currency = fx.reporting_currency(request)
 
         # Retrieve all expenses where the user is either the creator or a participant
-        expenses = Expense.objects.filter(Q(created_by=user) | Q(participants=user)).distinct()
+        expenses = list(
+            Expense.objects.filter(Q(created_by=user_id) | Q(participants=user_id))
+            .distinct()
+            .values('created_by_id', 'currency', 'created_at', 'split_details')
+        )
+        payments = list(
+            Payment.objects.filter(Q(payer=user_id) | Q(payee=user_id))
+            .values('payer_id', 'payee_id', 'amount', 'currency', 'created_at')
+        )
+        converter = fx.Converter(currency, [row['created_at'] for row in expenses + payments])
 
+        balances = defaultdict(Decimal)
         for expense in expenses:
-            created_by = expense.created_by
-            for participant_id, amount in expense.split_details.items():
-                participant = User.objects.get(id=participant_id)
-                if participant != user:
-                    if participant not in balances:
-                        balances[participant] = Decimal('0')
-                    
-                    # Current user paid, so others owe them
-                    if created_by == user:
-                        balances[participant] += Decimal(amount)
-                    else:
-                        # Current user owes to the expense creator
-                        balances[participant] -= Decimal(amount)
-        # Convert User objects to string representations in the response
-        response_data = {}
-        for user, balance in balances.items():
-            response_data[str(user)] = str(balance)
-        return Response(response_data)
+            factor = converter.factor(expense['currency'], expense['created_at'])
+            created_by = expense['created_by_id']
+            for participant_id, amount in expense['split_details'].items():
+                participant_id = int(participant_id)
+                if participant_id == user_id:
+                    continue
+                # Current user paid, so others owe them
+                if created_by == user_id:
+                    balances[participant_id] += Decimal(amount) * factor
+                else:
+                    # Current user owes to the expense creator
+                    balances[participant_id] -= Decimal(amount) * factor
+        # Archived expenses are carried forward as opening debts
+        for participant_id, amount in opening_debts(user_id, currency).items():
+            balances[participant_id] += amount
+        # Paying someone settles what the current user owes them, and vice versa
+        for payment in payments:
+            amount = payment['amount'] * converter.factor(payment['currency'], payment['created_at'])
+            if payment['payer_id'] == user_id:
+                balances[payment['payee_id']] += amount
+            else:
+                balances[payment['payer_id']] -= amount
+        emails = dict(User.objects.filter(id__in=balances).values_list('id', 'email'))
+        return Response({emails[participant_id]: str(balance) for participant_id, balance in balances.items() if participant_id in emails})
 
-    
+
+class DebtMatrixView(APIView):
+    """
+    API View for the pairwise "who owes whom" matrix.
+
+    This view handles GET requests and returns the net debt between every pair
+    of users who share expenses, computed in one pass over the shares (see
+    expenses_app.debts) and converted into the reporting currency
+    (``?currency=``). ``?users=1,2,3`` restricts it to debts among those users.
+
+    The matrix is sparse: ``users`` lists the ids of users with a debt or
+    credit, and the debts are returned either as ``edges`` (``[debtor,
+    creditor, amount]``, the default) or, with ``?layout=csr``, as the
+    ``indptr``/``indices``/``data`` arrays of a compressed sparse row matrix
+    whose rows are debtors and columns creditors, numbered by position in
+    ``users``.
+
+    Only authenticated users can access this view (IsAuthenticated permission).
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'reports'
+
+    def get(self, request):
+        params = DebtMatrixParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        matrix = DebtMatrix(fx.reporting_currency(request), params.validated_data.get('users'))
+        data = {'currency': matrix.currency, 'users': matrix.users}
+        if params.validated_data['layout'] == 'csr':
+            data.update(matrix.csr())
+        else:
+            data['edges'] = matrix.edges()
+        return Response(data)
+
+
+class StatementView(APIView):
+    """
+    API View for the authenticated user's chronological statement.
+
+    This view handles GET requests and returns, oldest first, every expense the
+    user created or takes part in with the amount they paid, their share, the
+    resulting change to their balance and their running balance in the
+    expense's currency. Running balances are computed by the database with a
+    window function (see expenses_app.statements).
+
+    Query parameters: ``date_from`` and ``date_to`` (inclusive), ``page_size``
+    and ``cursor``. Follow ``next`` for the following page; it carries the
+    balances forward, so later pages never re-read earlier rows.
+
+    Only authenticated users can access this view (IsAuthenticated permission).
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+    throttle_classes = [TokenBucketThrottle]
+    throttle_scope = 'reports'
+
+    def get(self, request):
+        """
+        Handle GET request to return one page of the statement.
+
+        :param request: The HTTP request object
+        :return: Response with ``results`` and the ``next`` page URL (or None)
+        """
+
+        params = StatementParamsSerializer(data=request.query_params)
+        params.is_valid(raise_exception=True)
+        results, cursor = statement_page(request.user.id, params.validated_data)
+        next_url = None
+        if cursor is not None:
+            next_url = replace_query_param(request.build_absolute_uri(), 'cursor', cursor)
+        return Response({'results': results, 'next': next_url})
+
+
+class SyncView(APIView):
+    """
+    API View for incremental sync of the authenticated user's data.
+
+    This view handles GET requests from clients that keep a local copy of the
+    user's expenses and balances. Without ``?since=`` it returns everything
+    with ``reset: true``; with the ``token`` of the previous sync it returns
+    only the expenses, removals and balance changes since then, read from the
+    per-user change sequence (see expenses_app.sync). While ``more`` is true
+    the client should sync again with the new token.
+
+    Only authenticated users can access this view (IsAuthenticated permission).
+    """
+
+    permission_classes = [permissions.IsAuthenticated]
+
+    def get(self, request):
+        """
+        Handle GET request to return the changes since a token.
+
+        :param request: The HTTP request object
+        :return: Response with ``expenses``, ``removed``, ``balances``, ``token``, ``more`` and ``reset``
+        """
+
+        user_id = request.user.id
+        since = request.query_params.get('since')
+        if not since:
+            return Response(sync.full_sync(user_id))
+        return Response(sync.changes_since(user_id, sync.decode_token(since, user_id)))
+
+
+class MetricsView(APIView):
+    """
+    API View exposing the in-process metrics registry.
+
+    This view handles GET requests from a Prometheus-compatible scraper and
+    returns every registered counter and histogram in the text exposition
+    format. No authentication is required so scrapers need no credentials;
+    restrict access to the path at the proxy if it must not be public.
+    """
+
+    authentication_classes = []
+    permission_classes = [permissions.AllowAny]
+
+    def get(self, request):
+        """
+        Handle GET request to render the current metric values.
+
+        :param request: The HTTP request object
+        :return: HttpResponse with the metrics in Prometheus text format
+        """
+
+        return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')